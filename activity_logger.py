@@ -0,0 +1,134 @@
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class ActivityLogger:
+    """In-memory buffer that writes activity events in batches
+
+    Events are queued and handed to ``flush`` as one list, so a whole batch
+    costs a single transaction instead of one commit per click. A batch is
+    flushed when ``batch_size`` events are waiting, when ``flush_interval``
+    seconds have passed, or on close().
+
+    The queue is bounded by ``max_queue``. When it is full the 'drop' policy
+    discards the new event, while 'block' waits up to ``block_timeout``
+    seconds for room before discarding it. Callers on an event loop must
+    not wait in log(); they pass block=False and wait for ``on_drain``,
+    which the flusher thread calls whenever it has taken a batch off the
+    queue.
+    """
+
+    POLICIES = ('drop', 'block')
+
+    def __init__(self, flush, batch_size=100, flush_interval=2.0,
+                 max_queue=10000, policy='drop', block_timeout=1.0, on_drain=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+
+        self._flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.on_drain = on_drain
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name='activity-logger', daemon=True
+        )
+        self._thread.start()
+
+    def log(self, user_id, action, details=None, block=None):
+        """Queue one event; returns False if it had to be dropped
+
+        block defaults to the queue policy; with block=False a full queue
+        drops the event right away.
+        """
+        if block is None:
+            block = self.policy == 'block'
+        event = (user_id, action, details, int(time.time()))
+
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return False
+
+            if len(self._queue) >= self.max_queue:
+                # Wake the flusher so room frees up as soon as possible
+                self._cond.notify_all()
+                if block:
+                    self._cond.wait_for(
+                        lambda: len(self._queue) < self.max_queue or self._closed,
+                        timeout=self.block_timeout
+                    )
+                if len(self._queue) >= self.max_queue or self._closed:
+                    self.dropped += 1
+                    return False
+
+            self._queue.append(event)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def _run(self):
+        """Flusher thread: drain the queue on size, time or close"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._queue) >= self.batch_size,
+                    timeout=self.flush_interval
+                )
+                batch = list(self._queue)
+                self._queue.clear()
+                closed = self._closed
+                self._cond.notify_all()
+
+            if batch:
+                if self.on_drain is not None:
+                    self.on_drain()
+                self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch):
+        try:
+            self._flush(batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Failed to write {len(batch)} activity events: {e}")
+
+    def has_room(self):
+        """Whether log() would queue an event without waiting"""
+        return len(self._queue) < self.max_queue and not self._closed
+
+    def stats(self):
+        """Counters for monitoring the buffer"""
+        with self._cond:
+            queued = len(self._queue)
+        return {
+            'queued': queued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def close(self):
+        """Flush everything still queued and stop the flusher thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        logger.info(f"Activity logger closed ({self.written} events written, {self.dropped} dropped)")
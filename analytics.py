@@ -2,15 +2,18 @@ import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')  # Use non-GUI backend
 from datetime import datetime, timedelta
-from database import Database
-from config import DATABASE_FILE
+from storage import open_storage
+from config import DATABASE_FILE, DATABASE_URL, DATABASE_SHARDS
 import io
 
-db = Database(DATABASE_FILE)
+db = open_storage(DATABASE_FILE, DATABASE_URL, shards=DATABASE_SHARDS)
 
 def generate_analytics_report():
     """Generate comprehensive analytics report"""
     
+    # Bring the daily rollups up to date with the activity log
+    db.refresh_rollups()
+    
     # Basic stats
     total_users = db.get_total_users()
     active_users_7d = db.get_active_users(7)
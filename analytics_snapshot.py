@@ -0,0 +1,76 @@
+import asyncio
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AnalyticsSnapshot:
+    """Precomputed /analytics dashboard, refreshed in the background
+
+    The whole dashboard is computed in one read transaction on a database
+    reader thread and stored, so /analytics only formats the latest
+    snapshot. A background task recomputes it every ``refresh_interval``
+    seconds, after bringing the daily rollups up to date. A snapshot older
+    than ``max_age`` seconds is recomputed on demand before it is served.
+    """
+
+    def __init__(self, db, refresh_interval=900, max_age=3600):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.snapshot = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def age(self):
+        """Seconds since the current snapshot was generated"""
+        if self.snapshot is None:
+            return None
+        return time.time() - self.snapshot['generated_at']
+
+    async def get(self, force=False):
+        """Latest snapshot, recomputed first if forced or stale"""
+        if self.snapshot is None:
+            self.snapshot = await self.db.get_analytics_snapshot()
+        if force or self.snapshot is None or self.age() > self.max_age:
+            await self.refresh()
+        return self.snapshot
+
+    async def refresh(self):
+        """Recompute and store the snapshot; concurrent calls share one run"""
+        if self._lock.locked():
+            async with self._lock:
+                return self.snapshot
+
+        async with self._lock:
+            started = asyncio.get_running_loop().time()
+            snapshot = await self.db.compute_analytics_snapshot()
+            await self.db.save_analytics_snapshot(snapshot)
+            self.snapshot = snapshot
+            elapsed = asyncio.get_running_loop().time() - started
+            logger.info(f"Analytics snapshot refreshed in {elapsed:.2f}s")
+            return snapshot
+
+    async def _run(self):
+        while True:
+            try:
+                await self.db.refresh_rollups()
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Analytics snapshot refresh failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        """Start the background refresh task on the running loop"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Cancel the background refresh task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from storage import open_storage
+from cache import LRUCache
+from activity_logger import ActivityLogger
+from export import write_export, read_import
+
+logger = logging.getLogger(__name__)
+
+class AsyncDatabase:
+    """Awaitable version of a storage backend for use inside async handlers
+
+    Exposes the same methods as the backend (the SQLite Database,
+    ShardedDatabase when shards > 1, or PostgresDatabase when database_url
+    is set), but each call returns an awaitable. Writes are queued on a
+    dedicated writer thread, one per backend write lane, so writes for
+    users on different shards run side by side. Reads are spread over a
+    small pool of threads, each using its own connection, so database work
+    never blocks the event loop.
+
+    log_user_activity() does not touch the database directly: events go to
+    an ActivityLogger and are written in batches on the first writer thread.
+    It never blocks the event loop; with the 'block' queue policy a handler
+    that finds the queue full awaits room while the others keep running.
+
+    Every write for a user bumps that user's data_version(), so rendered
+    views keyed by it are never served after the data changed.
+    """
+
+    def __init__(self, database_file='notes.db', read_workers=4,
+                 activity_options=None, profile_cache_size=10000,
+                 profile_cache_ttl=600, database_url=None, pool_size=10, shards=1,
+                 version_cache_size=10000):
+        self.database_file = database_file
+        self.db = open_storage(
+            database_file, database_url, pool_size=pool_size, shards=shards,
+            profile_cache_size=profile_cache_size, profile_cache_ttl=profile_cache_ttl
+        )
+        self._write_executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'db-writer-{lane}')
+            for lane in range(self.db.write_lanes)
+        ]
+        self._write_executor = self._write_executors[0]
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=read_workers, thread_name_prefix='db-reader'
+        )
+        self.activity_logger = ActivityLogger(
+            self._write_activity, on_drain=self._activity_drained, **(activity_options or {})
+        )
+        # Set from the flusher thread when the activity queue has room again
+        self._activity_room = None
+        self._loop = None
+        # Data versions of recently written users. A user evicted from the
+        # LRU gets the floor, which moves past every version handed out on
+        # each eviction, so views keyed by an older version never match.
+        self._versions = LRUCache(maxsize=version_cache_size)
+        self._version_stamp = 0
+        self._version_floor = 0
+
+    @property
+    def supports_backup(self):
+        """Whether the backend has an online backup"""
+        return self.db.supports_backup
+
+    def __getattr__(self, name):
+        method = getattr(type(self.db), name, None)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+
+        target = getattr(self.db, name)
+        if name in self.db.WRITE_METHODS:
+            signature = inspect.signature(target)
+
+            @functools.wraps(method)
+            async def call(*args, **kwargs):
+                user_id = signature.bind(*args, **kwargs).arguments.get('user_id')
+                try:
+                    return await self._run(self._write_executors[self.db.write_lane(user_id)],
+                                           functools.partial(target, *args, **kwargs))
+                finally:
+                    if user_id is not None:
+                        self.bump_version(user_id)
+        else:
+            @functools.wraps(method)
+            async def call(*args, **kwargs):
+                return await self._run(self._read_executor,
+                                       functools.partial(target, *args, **kwargs))
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, call)
+        return call
+
+    async def _run(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+    def data_version(self, user_id):
+        """Counter that changes whenever the user's data was written"""
+        return self._versions.get(user_id, self._version_floor)
+
+    def bump_version(self, user_id):
+        """Mark the user's data as changed"""
+        self._version_stamp += 1
+        evictions = self._versions.evictions
+        self._versions.set(user_id, self._version_stamp)
+        if self._versions.evictions != evictions:
+            self._version_floor = self._version_stamp
+
+    async def get_user_language(self, user_id):
+        """Get user's preferred language, without a thread hop when cached"""
+        profile = self.db.profiles.get(user_id)
+        if profile is None:
+            profile = await self._run(self._read_executor, self.db.load_user_profile, user_id)
+        return profile['language']
+
+    async def ensure_user(self, user_id, username, first_name, language='en'):
+        """Create user if doesn't exist; known users cost no database work"""
+        profile = self.db.profiles.get(user_id)
+        if profile is not None and profile['exists']:
+            return
+        await self._run(self._write_executors[self.db.write_lane(user_id)],
+                        self.db.create_user, user_id, username, first_name, language)
+
+    async def export_notes(self, user_id, path, fmt='jsonl'):
+        """Stream a user's notes into a JSONL or CSV file; returns the count
+
+        Bulk jobs run on the loop's default executor so they never hold up
+        the reader and writer threads that serve handlers.
+        """
+        def export():
+            return write_export(self.db.iter_notes_export(user_id), path, fmt)
+        return await self._run(None, export)
+
+    async def import_notes(self, user_id, path, source, fmt='jsonl', progress=None):
+        """Import an export file in batches; see StorageBackend.import_notes
+
+        The file is read one record at a time. Each batch takes the writer
+        only for its own transaction, so other writes go in between.
+        """
+        try:
+            return await self._run(None, self.db.import_notes, user_id,
+                                   read_import(path, fmt), source, 500, progress)
+        finally:
+            self.bump_version(user_id)
+
+    async def backup(self, backup_dir, compress=True, keep=7):
+        """Online backup of the database files on the default executor"""
+        return await self._run(None, functools.partial(
+            self.db.backup, backup_dir, compress=compress, keep=keep
+        ))
+
+    def metrics(self):
+        """Cache and buffer counters for the /metrics command"""
+        return {
+            'profile_cache': self.db.profiles.stats(),
+            'activity_logger': self.activity_logger.stats(),
+        }
+
+    async def log_user_activity(self, user_id, action, details=None):
+        """Queue an activity event for the next batched write"""
+        activity = self.activity_logger
+        if activity.policy != 'block' or activity.has_room():
+            activity.log(user_id, action, details, block=False)
+            return
+        try:
+            await asyncio.wait_for(self._log_when_room(user_id, action, details),
+                                   activity.block_timeout)
+        except asyncio.TimeoutError:
+            # Queued if room appeared just now, otherwise counted as dropped
+            activity.log(user_id, action, details, block=False)
+
+    async def _log_when_room(self, user_id, action, details):
+        if self._activity_room is None:
+            self._loop = asyncio.get_running_loop()
+            self._activity_room = asyncio.Event()
+        while True:
+            # Cleared before checking, so a drain in between still wakes us
+            self._activity_room.clear()
+            if self.activity_logger.has_room():
+                self.activity_logger.log(user_id, action, details, block=False)
+                return
+            await self._activity_room.wait()
+
+    def _activity_drained(self):
+        """Flusher thread: wake handlers waiting for room in the activity queue"""
+        if self._activity_room is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._activity_room.set)
+            except RuntimeError:
+                pass  # Loop already closed
+
+    def _write_activity(self, events):
+        """Flush a batch of activity events through the writer thread"""
+        self._write_executor.submit(self.db.log_activity_batch, events).result()
+
+    def close(self):
+        """Flush buffered activity, wait for queued work, then close all connections"""
+        self.activity_logger.close()
+        for executor in self._write_executors:
+            executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.db.close()
+        logger.info("Async database closed")
@@ -0,0 +1,239 @@
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import logging
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Pages copied per backup step (1 MB with 4 KB pages) and the pause after
+# each step. Every step is a short read transaction on the live database.
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.05
+
+# A write through another connection than the one copied from makes SQLite
+# start the copy over. After this many restarts it is done in one step.
+MAX_RESTARTS = 5
+
+class BackupRestarting(Exception):
+    """Raised from the progress callback to stop a backup that keeps restarting"""
+
+def backup_prefix(database_file):
+    """File name prefix of the backups of one database: notes.db -> notes-"""
+    return os.path.splitext(os.path.basename(database_file))[0] + '-'
+
+def integrity_check(path):
+    """Result of PRAGMA integrity_check on a database file, 'ok' when healthy"""
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+        return '; '.join(row[0] for row in rows)
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    finally:
+        conn.close()
+
+def backup_database(database_file, backup_dir, compress=True, keep=7,
+                    pages=BACKUP_PAGES, sleep=BACKUP_SLEEP, connection=None, lock=None):
+    """Copy a live database into backup_dir with the online backup API
+
+    The copy is made ``pages`` pages at a time with a ``sleep`` pause
+    between steps, so the bot keeps serving requests meanwhile. Pass the
+    connection the bot writes through as ``connection``: its commits then
+    update the copy as it runs instead of restarting it. ``lock`` is the
+    lock that guards that connection; each step holds it and the pauses
+    release it, so a step never runs inside another thread's transaction.
+    The copy
+    is checked with PRAGMA integrity_check, optionally gzipped and then
+    renamed into place, so a file named notes-YYYYMMDD-HHMMSS.db[.gz]
+    is always complete. Only the ``keep`` newest backups are kept.
+
+    Returns the path, size, page count, steps, restarts and seconds taken.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.perf_counter()
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(backup_dir, f"{backup_prefix(database_file)}{stamp}.db")
+    partial = path + '.partial'
+
+    stats = {'pages': 0, 'steps': 0, 'restarts': 0}
+    last_remaining = [None]
+
+    def progress(status, remaining, total):
+        stats['steps'] += 1
+        stats['pages'] = total
+        if last_remaining[0] is not None and remaining > last_remaining[0]:
+            stats['restarts'] += 1
+            if stats['restarts'] > MAX_RESTARTS:
+                raise BackupRestarting()
+        last_remaining[0] = remaining
+        if remaining:
+            if lock is not None:
+                lock.release()
+            try:
+                time.sleep(sleep)
+            finally:
+                if lock is not None:
+                    lock.acquire()
+
+    source = connection or sqlite3.connect(database_file)
+    target = sqlite3.connect(partial)
+    try:
+        try:
+            with lock or nullcontext():
+                source.backup(target, pages=pages, progress=progress, sleep=sleep)
+        except BackupRestarting:
+            # Under WAL one full step reads a single snapshot and does not
+            # block writers; it only takes longer than a paced step. It
+            # reads through a connection of its own, so the writer lock is
+            # not held for the whole copy
+            logger.warning(f"Backup of {database_file} kept restarting, copying in one step")
+            snapshot = sqlite3.connect(database_file)
+            try:
+                snapshot.backup(target)
+            finally:
+                snapshot.close()
+            stats['steps'] += 1
+    finally:
+        target.close()
+        if connection is None:
+            source.close()
+
+    result = integrity_check(partial)
+    if result != 'ok':
+        os.remove(partial)
+        raise ValueError(f"Backup of {database_file} failed integrity check: {result}")
+
+    if compress:
+        path += '.gz'
+        with open(partial, 'rb') as src, gzip.open(path + '.partial', 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.remove(partial)
+        partial = path + '.partial'
+    os.replace(partial, path)
+
+    removed = rotate_backups(backup_dir, database_file, keep)
+    stats.update(
+        path=path,
+        bytes=os.path.getsize(path),
+        seconds=round(time.perf_counter() - started, 3),
+        removed=removed,
+    )
+    logger.info(f"Backup {path} written in {stats['seconds']:.2f}s "
+                f"({stats['pages']} pages, {stats['steps']} steps, {stats['restarts']} restarts)")
+    return stats
+
+def list_backups(backup_dir, database_file):
+    """Complete backups of a database, oldest first"""
+    prefix = backup_prefix(database_file)
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(
+        os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+        if name.startswith(prefix) and name.endswith(('.db', '.db.gz'))
+    )
+
+def rotate_backups(backup_dir, database_file, keep):
+    """Delete all but the newest ``keep`` backups; returns the removed paths"""
+    backups = list_backups(backup_dir, database_file)
+    removed = backups[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+def restore_backup(backup_path, database_file):
+    """Verify a backup and copy it over database_file
+
+    The bot must be stopped. The backup (gunzipped first if needed) must
+    pass PRAGMA integrity_check before anything is overwritten, and the
+    restored database is checked again. The copy goes through the backup
+    API, so the target's WAL files are handled by SQLite.
+    """
+    started = time.perf_counter()
+    directory = os.path.dirname(os.path.abspath(database_file))
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        candidate = backup_path
+        if backup_path.endswith('.gz'):
+            candidate = os.path.join(tmp, 'restore.db')
+            with gzip.open(backup_path, 'rb') as src, open(candidate, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        result = integrity_check(candidate)
+        if result != 'ok':
+            raise ValueError(f"Backup {backup_path} failed integrity check: {result}")
+
+        source = sqlite3.connect(candidate)
+        target = sqlite3.connect(database_file)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+    result = integrity_check(database_file)
+    if result != 'ok':
+        raise ValueError(f"Restored {database_file} failed integrity check: {result}")
+    seconds = round(time.perf_counter() - started, 3)
+    logger.info(f"Restored {database_file} from {backup_path} in {seconds:.2f}s")
+    return seconds
+
+class BackupScheduler:
+    """Periodic online backups while the bot runs
+
+    Every ``interval`` seconds the database is backed up on the loop's
+    default executor. The stats of the last run are kept for /metrics.
+    """
+
+    def __init__(self, db, backup_dir, interval, keep=7, compress=True):
+        self.db = db
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+        self.compress = compress
+        self.last = None
+        self.failures = 0
+        self._task = None
+
+    async def run_once(self):
+        """Back up every database file now; returns their stats"""
+        results = await self.db.backup(self.backup_dir, compress=self.compress, keep=self.keep)
+        self.last = {
+            'finished_at': time.time(),
+            'seconds': sum(result['seconds'] for result in results),
+            'bytes': sum(result['bytes'] for result in results),
+            'restarts': sum(result['restarts'] for result in results),
+            'files': len(results),
+        }
+        return results
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Scheduled backup failed: {e}")
+
+    def start(self):
+        """Start the periodic backups on the running loop"""
+        if self._task is None and self.interval > 0:
+            if not self.db.supports_backup:
+                logger.info("Scheduled backups off: the storage backend has no online backup")
+                return
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Cancel the periodic backups"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,857 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from database import Database
+from async_database import AsyncDatabase
+from backup import backup_database, BACKUP_PAGES, BACKUP_SLEEP
+from update_processor import PerUserUpdateProcessor
+from send_scheduler import SendScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+WORDS = ['meeting', 'idea', 'recipe', 'todo', 'book', 'travel', 'work', 'call']
+
+def random_text():
+    """Build a short random note body"""
+    return ' '.join(random.choice(WORDS) for _ in range(12))
+
+async def monitor_loop_lag(samples, interval=0.005):
+    """Record how late the event loop wakes up from short sleeps"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append((loop.time() - start - interval) * 1000)
+
+async def simulate_user(call, user_id, operations):
+    """Mix of writes and reads similar to one busy user"""
+    for _ in range(operations):
+        note_id = await call('save_note', user_id, random_text())
+        await call('add_tag', note_id, random.choice(WORDS), user_id)
+        await call('log_user_activity', user_id, 'note_created', 'type:text')
+        await call('get_recent_notes', user_id, 5, 0)
+        await call('search_notes', user_id, random.choice(WORDS))
+        # Stand-in for the Telegram API round trip of a real handler
+        await asyncio.sleep(0)
+
+async def run_loop_lag(db_call, users, operations):
+    """Run concurrent users while measuring event loop lag"""
+    samples = []
+    monitor = asyncio.create_task(monitor_loop_lag(samples))
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        simulate_user(db_call, user_id, operations)
+        for user_id in range(1, users + 1)
+    ])
+    elapsed = time.perf_counter() - start
+    # Let the monitor record its last (possibly very late) wake-up
+    await asyncio.sleep(0.05)
+    monitor.cancel()
+    return elapsed, samples
+
+def report(title, elapsed, samples, total_ops):
+    """Print loop lag percentiles for one run"""
+    samples = sorted(samples) or [0.0]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"\n{title}")
+    print(f"   Duration: {elapsed:.2f}s ({total_ops / elapsed:.0f} ops/s)")
+    print(f"   Loop lag p50: {statistics.median(samples):.2f} ms")
+    print(f"   Loop lag p99: {p99:.2f} ms")
+    print(f"   Loop lag max: {samples[-1]:.2f} ms")
+
+def loop_lag(args):
+    """Compare loop lag of the sync Database against AsyncDatabase"""
+    total_ops = args.users * args.operations * 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'sync.db'))
+
+        async def sync_call(name, *call_args):
+            return getattr(db, name)(*call_args)
+
+        elapsed, samples = asyncio.run(
+            run_loop_lag(sync_call, args.users, args.operations)
+        )
+        db.close()
+        report("🐢 Database (blocking calls)", elapsed, samples, total_ops)
+
+        async def run_async():
+            adb = AsyncDatabase(os.path.join(tmp, 'async.db'))
+
+            async def async_call(name, *call_args):
+                return await getattr(adb, name)(*call_args)
+
+            try:
+                return await run_loop_lag(async_call, args.users, args.operations)
+            finally:
+                adb.close()
+
+        elapsed, samples = asyncio.run(run_async())
+        report("🚀 AsyncDatabase", elapsed, samples, total_ops)
+
+def stress(args):
+    """Hammer one Database from many reader and writer threads"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'stress.db'))
+        deadline = time.perf_counter() + args.seconds
+        lock = threading.Lock()
+        counts = {'writes': 0, 'reads': 0, 'notes': 0}
+        errors = []
+        latencies = []
+
+        def writer(user_id):
+            while time.perf_counter() < deadline:
+                try:
+                    start = time.perf_counter()
+                    note_id = db.save_note(user_id, random_text())
+                    db.add_tag(note_id, random.choice(WORDS), user_id)
+                    db.toggle_pin(note_id, user_id)
+                    db.log_user_activity(user_id, 'note_created', 'type:text')
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        counts['writes'] += 4
+                        counts['notes'] += 1
+                        latencies.append(elapsed * 1000)
+                except Exception as e:
+                    errors.append(f"writer: {e}")
+
+        def reader(user_id):
+            while time.perf_counter() < deadline:
+                try:
+                    db.get_recent_notes(user_id, 5, 0)
+                    db.get_pinned_notes(user_id)
+                    db.search_notes(user_id, random.choice(WORDS))
+                    db.get_user_stats(user_id)
+                    with lock:
+                        counts['reads'] += 4
+                except Exception as e:
+                    errors.append(f"reader: {e}")
+
+        threads = [
+            threading.Thread(target=writer, args=(i % 10 + 1,))
+            for i in range(args.writers)
+        ] + [
+            threading.Thread(target=reader, args=(i % 10 + 1,))
+            for i in range(args.readers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stored = db.get_total_notes_all_users()
+        db.close()
+
+    latencies.sort()
+    print(f"\n🔥 STRESS ({args.writers} writers, {args.readers} readers, {args.seconds}s)")
+    print(f"   Writes: {counts['writes']} ({counts['writes'] / args.seconds:.0f}/s)")
+    print(f"   Reads: {counts['reads']} ({counts['reads'] / args.seconds:.0f}/s)")
+    if latencies:
+        print(f"   Write batch p50: {statistics.median(latencies):.2f} ms")
+        print(f"   Write batch max: {latencies[-1]:.2f} ms")
+    print(f"   Notes written/stored: {counts['notes']}/{stored}")
+    print(f"   Errors: {len(errors)}")
+    for error in errors[:5]:
+        print(f"      {error}")
+
+    if errors or stored != counts['notes']:
+        raise SystemExit(1)
+
+def chi_square(counts, draws):
+    """(chi-square of counts against a uniform draw, its 99.9% critical value)"""
+    expected = draws / len(counts)
+    chi2 = sum((observed - expected) ** 2 / expected for observed in counts.values())
+    dof = len(counts) - 1
+    if dof == 0:
+        return chi2, 0.0
+    # Wilson-Hilferty approximation of the chi-square 99.9th percentile
+    critical = dof * (1 - 2 / (9 * dof) + 3.09 * (2 / (9 * dof)) ** 0.5) ** 3
+    return chi2, critical
+
+def random_uniformity(args):
+    """Chi-square check that get_random_note is uniform despite id gaps and exclusions"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'random.db'))
+        user_id = 1
+        note_ids = []
+        for i in range(args.notes):
+            note_ids.append(db.save_note(user_id, random_text()))
+            # Interleave another user so this user's ids have gaps
+            db.save_note(user_id + 1, random_text())
+        for note_id in random.sample(note_ids, len(note_ids) // 3):
+            db.delete_note(note_id, user_id)
+            note_ids.remove(note_id)
+
+        counts = {note_id: 0 for note_id in note_ids}
+        start = time.perf_counter()
+        for _ in range(args.draws):
+            counts[db.get_random_note(user_id)[0]] += 1
+        elapsed = time.perf_counter() - start
+
+        # A small collection with most notes excluded, like the 🎲 Another
+        # button's recent history: only the others may come up, all equally
+        small_user = user_id + 2
+        small_ids = [db.save_note(small_user, random_text()) for _ in range(args.small_notes)]
+        db.delete_note(small_ids.pop(0), small_user)
+        excluded = random.sample(small_ids, len(small_ids) - args.small_left)
+        small_counts = {note_id: 0 for note_id in small_ids if note_id not in excluded}
+        small_draws = args.draws // 10
+        misses = 0
+        for _ in range(small_draws):
+            row = db.get_random_note(small_user, excluded)
+            if row is None or row[0] not in small_counts:
+                misses += 1
+            else:
+                small_counts[row[0]] += 1
+        everything_excluded = db.get_random_note(small_user, small_ids)
+        db.close()
+
+    chi2, critical = chi_square(counts, args.draws)
+    print(f"\n🎲 RANDOM NOTE UNIFORMITY ({len(counts)} notes, {args.draws} draws)")
+    print(f"   Per draw: {elapsed / args.draws * 1e6:.0f} µs")
+    print(f"   Chi-square: {chi2:.1f} (99.9% critical value {critical:.1f})")
+    failed = chi2 > critical
+
+    small_chi2, small_critical = chi_square(small_counts, small_draws - misses)
+    print(f"   {len(small_ids)} notes with {len(excluded)} excluded, {small_draws} draws: "
+          f"{misses} empty or excluded picks, chi-square {small_chi2:.1f} "
+          f"(critical {small_critical:.1f})")
+    failed = failed or misses or small_chi2 > small_critical
+    if everything_excluded is None:
+        print("   All notes excluded: no note returned")
+        failed = True
+
+    if failed:
+        print("   ❌ Distribution is not uniform")
+        raise SystemExit(1)
+    print("   ✅ Uniform")
+
+def percentile(samples, fraction):
+    """Value at a fraction of sorted samples"""
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def backup_impact(args):
+    """Handler latency with no backup, a paced backup and a one-step backup"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'backup.db'))
+        users = 50
+        for i in range(args.notes):
+            db.save_note(i % users + 1, random_text() * 4)
+        size = os.path.getsize(db.database_file) / 1048576
+
+        def run(title, pages=None, sleep=0.0):
+            latencies = {'read': [], 'write': []}
+            done = threading.Event()
+            result = {}
+
+            def worker(kind):
+                while not done.is_set():
+                    user_id = random.randint(1, users)
+                    start = time.perf_counter()
+                    if kind == 'write':
+                        db.save_note(user_id, random_text())
+                    else:
+                        db.get_recent_notes(user_id, 5, 0)
+                        db.search_notes(user_id, random.choice(WORDS))
+                    latencies[kind].append((time.perf_counter() - start) * 1000)
+
+            threads = [threading.Thread(target=worker, args=('write',))] + [
+                threading.Thread(target=worker, args=('read',)) for _ in range(args.readers)
+            ]
+            for thread in threads:
+                thread.start()
+            started = time.perf_counter()
+            if pages is not None:
+                connection, lock = db.pool.backup_source()
+                result = backup_database(db.database_file, os.path.join(tmp, 'backups'),
+                                         compress=False, keep=1, pages=pages, sleep=sleep,
+                                         connection=connection, lock=lock)
+            time.sleep(max(0.0, args.seconds - (time.perf_counter() - started)))
+            done.set()
+            for thread in threads:
+                thread.join()
+
+            print(f"\n{title}")
+            if result:
+                print(f"   Backup: {result['seconds']:.2f}s, {result['steps']} steps, "
+                      f"{result['restarts']} restarts")
+            for kind, samples in latencies.items():
+                samples.sort()
+                print(f"   {kind.title()} p50/p99/max: {statistics.median(samples):.2f} / "
+                      f"{percentile(samples, 0.99):.2f} / {samples[-1]:.2f} ms ({len(samples)} ops)")
+
+        print(f"\n💾 BACKUP IMPACT ({args.notes} notes, {size:.1f} MB, {args.readers} readers + 1 writer)")
+        run("⚪ No backup")
+        run(f"🐢 Paced backup ({BACKUP_PAGES} pages/step, {BACKUP_SLEEP * 1000:.0f} ms pause)",
+            BACKUP_PAGES, BACKUP_SLEEP)
+        run("⚡ One-step backup", -1)
+        db.close()
+
+class FakeBotApi:
+    """Local stand-in for api.telegram.org that answers every method
+
+    Counts sendMessage calls so a benchmark can tell when the bot has
+    replied to every update it was sent, and logs when each arrived for
+    which chat. With flood_every=N every Nth sendMessage is refused with
+    429 Too Many Requests, like Telegram's flood control.
+    """
+
+    def __init__(self, flood_every=0):
+        self.sent = 0
+        self.calls = Counter()
+        self.flood_every = flood_every
+        self.attempts = []
+        self._sent_lock = threading.Condition()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or '{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body).items()}
+                fake.calls[method] += 1
+                if fake.flooded(method, params):
+                    self._reply(None, status=429)
+                else:
+                    self._reply(fake.result(method, params))
+
+            do_GET = do_POST
+
+            def _reply(self, result, status=200):
+                if status == 429:
+                    payload = json.dumps({
+                        'ok': False, 'error_code': 429,
+                        'description': 'Too Many Requests: retry after 1',
+                        'parameters': {'retry_after': 1},
+                    }).encode()
+                else:
+                    payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # Bursts of concurrent requests overflow the default backlog of 5
+            request_queue_size = 1024
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def flooded(self, method, params):
+        """Log a sendMessage attempt; True if it gets a 429"""
+        if method != 'sendMessage':
+            return False
+        with self._sent_lock:
+            self.attempts.append((time.monotonic(), int(params.get('chat_id', 1))))
+            return bool(self.flood_every) and len(self.attempts) % self.flood_every == 0
+
+    def result(self, method, params):
+        """Minimal valid result for a Bot API method"""
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        if method == 'sendMessage':
+            with self._sent_lock:
+                self.sent += 1
+                self._sent_lock.notify_all()
+            return {
+                'message_id': self.sent, 'date': int(time.time()), 'text': params.get('text', ''),
+                'chat': {'id': int(params.get('chat_id', 1)), 'type': 'private'},
+            }
+        return True
+
+    def wait_for_sent(self, count, timeout):
+        """Block until count messages were sent; False on timeout"""
+        with self._sent_lock:
+            return self._sent_lock.wait_for(lambda: self.sent >= count, timeout)
+
+    def close(self):
+        self.server.shutdown()
+
+def text_update(update_id, user_id, text):
+    """Bot API JSON of a private text message"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'}, 'from': user,
+        },
+    }
+
+def callback_update(update_id, user_id, message_id, data):
+    """Bot API JSON of a button click on one of the bot's messages"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': data,
+            'message': {
+                'message_id': message_id, 'date': int(time.time()), 'text': 'menu',
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Fake'},
+            },
+        },
+    }
+
+def webhook(args):
+    """Updates per second end to end: HTTP POST -> handler -> sendMessage"""
+    import httpx
+    from telegram.ext import Application
+
+    token = '123456:BENCHMARK'
+    secret = 'benchmark-secret'
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py opens its database at import time
+        os.environ['BOT_TOKEN'] = token
+        os.environ['DATABASE_FILE'] = os.path.join(tmp, 'webhook.db')
+        import bot
+
+        fake = FakeBotApi()
+        url = f"http://127.0.0.1:{args.port}/telegram"
+
+        async def run():
+            # No flood limits: this measures the bot, not Telegram's quotas
+            unlimited = SendScheduler(global_rate=1e9, chat_rate=1e9, chat_burst=1e9, global_burst=1e9)
+            application = bot.build_application(
+                Application.builder().token(token).base_url(f"{fake.url}/bot"),
+                send_scheduler=unlimited,
+            )
+            async with application:
+                await application.start()
+                await application.updater.start_webhook(
+                    listen='127.0.0.1', port=args.port, url_path='telegram',
+                    webhook_url=url, secret_token=secret,
+                )
+                loop = asyncio.get_running_loop()
+                async with httpx.AsyncClient() as client:
+                    forged = await client.post(
+                        url, json=text_update(0, 1, 'forged'),
+                        headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'},
+                    )
+                    limit = asyncio.Semaphore(args.concurrency)
+                    latencies = []
+
+                    async def post(update_id):
+                        user_id = update_id % args.users + 1
+                        async with limit:
+                            start = loop.time()
+                            response = await client.post(
+                                url, json=text_update(update_id, user_id, f"note {update_id} #bench"),
+                                headers={'X-Telegram-Bot-Api-Secret-Token': secret},
+                            )
+                            latencies.append((loop.time() - start) * 1000)
+                            response.raise_for_status()
+
+                    start = loop.time()
+                    await asyncio.gather(*[post(i) for i in range(1, args.updates + 1)])
+                    accepted = loop.time() - start
+                    handled = await loop.run_in_executor(
+                        None, fake.wait_for_sent, args.updates, args.timeout
+                    )
+                    elapsed = loop.time() - start
+                await application.updater.stop()
+                await application.stop()
+            await bot.shutdown(application)
+            return forged.status_code, accepted, handled, elapsed, sorted(latencies)
+
+        forged_status, accepted, handled, elapsed, latencies = asyncio.run(run())
+        fake.close()
+
+    print(f"\n🌐 WEBHOOK ({args.updates} updates from {args.users} users, "
+          f"{args.concurrency} concurrent POSTs)")
+    print(f"   Forged secret token: HTTP {forged_status}")
+    print(f"   Accepted: {args.updates / accepted:.0f} updates/s "
+          f"(POST p50 {statistics.median(latencies):.2f} ms, "
+          f"p99 {percentile(latencies, 0.99):.2f} ms)")
+    print(f"   Replied: {fake.sent}/{args.updates} in {elapsed:.2f}s "
+          f"({fake.sent / elapsed:.0f} updates/s end to end)")
+    if forged_status != 403 or not handled:
+        raise SystemExit(1)
+
+def update_order(args):
+    """Per-user ordering and throughput of the update processors"""
+    from telegram import Update
+    from telegram.ext import SimpleUpdateProcessor
+
+    # A share of the updates comes from one busy user, the rest are spread out
+    rng = random.Random(args.seed)
+    senders = [
+        1 if rng.random() < args.hot_share else rng.randint(2, args.users)
+        for _ in range(args.updates)
+    ]
+    updates = [
+        Update.de_json(text_update(update_id, user_id, f"note {update_id}"), None)
+        for update_id, user_id in enumerate(senders, start=1)
+    ]
+    delays = [rng.uniform(0, args.handler_ms * 2) / 1000 for _ in updates]
+
+    async def run(processor):
+        started = {}
+        running = set()
+        violations = []
+        finished = asyncio.Event()
+        handled = [0]
+
+        async def handle(update, delay):
+            user_id = update.effective_user.id
+            # Updates of a user must start in arrival order and never overlap
+            if user_id in running or started.get(user_id, 0) > update.update_id:
+                violations.append(update.update_id)
+            started[user_id] = update.update_id
+            running.add(user_id)
+            await asyncio.sleep(delay)
+            running.discard(user_id)
+            handled[0] += 1
+            if handled[0] == len(updates):
+                finished.set()
+
+        # The same calls Application makes for every fetched update
+        start = time.perf_counter()
+        tasks = [
+            asyncio.create_task(processor.process_update(update, handle(update, delay)))
+            for update, delay in zip(updates, delays)
+        ]
+        await asyncio.gather(*tasks)
+        # Queued updates of a busy user return before they are handled
+        await finished.wait()
+        return time.perf_counter() - start, len(violations)
+
+    print(f"\n🔀 UPDATE ORDER ({args.updates} updates from {args.users} users, "
+          f"{args.hot_share:.0%} from one user, ~{args.handler_ms:g} ms per handler)")
+    processors = [
+        ("Sequential", SimpleUpdateProcessor(1)),
+        (f"Concurrent x{args.concurrency}", SimpleUpdateProcessor(args.concurrency)),
+        (f"Per-user x{args.concurrency}", PerUserUpdateProcessor(args.concurrency)),
+    ]
+    failed = False
+    for title, processor in processors:
+        elapsed, violations = asyncio.run(run(processor))
+        status = "✅" if not violations else "❌"
+        print(f"   {status} {title}: {args.updates / elapsed:.0f} updates/s, "
+              f"{violations} out-of-order updates")
+        if isinstance(processor, PerUserUpdateProcessor):
+            metrics = processor.metrics()
+            print(f"      peak running {metrics['max_active']}, {metrics['queued']} waited for "
+                  f"their user, longest queue {metrics['max_queue']}")
+            failed = bool(violations)
+    if failed:
+        raise SystemExit(1)
+
+def click_storm(args):
+    """Button mashing with and without coalescing: edits sent and database reads"""
+    from telegram import Update
+    from telegram.ext import Application
+
+    token = '123456:BENCHMARK'
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py opens its database at import time
+        os.environ['BOT_TOKEN'] = token
+        os.environ['DATABASE_FILE'] = os.path.join(tmp, 'clicks.db')
+        import bot
+        from message_edits import MessageEdits
+
+        fake = FakeBotApi()
+        menus = ['menu_notes', 'menu_pinned', 'menu_stats', 'menu_home']
+
+        async def storm(coalesce, first_message):
+            bot.renders.clear()
+            bot.edits = MessageEdits(maxsize=100000 if coalesce else 0)
+            application = bot.build_application(
+                Application.builder().token(token).base_url(f"{fake.url}/bot"),
+                send_scheduler=SendScheduler(global_rate=1e9, chat_rate=1e9, chat_burst=1e9,
+                                             global_burst=1e9),
+            )
+            if not coalesce:
+                application.update_processor.coalesce = None
+            reads = [0]
+            run = bot.db._run
+
+            async def counted(executor, func, *call_args):
+                reads[0] += executor is bot.db._read_executor
+                return await run(executor, func, *call_args)
+
+            bot.db._run = counted
+            before = Counter(fake.calls)
+            async with application:
+                await application.start()
+                # Half the users mash Next on one page, the others flip through the menu
+                next_pages = {}
+                for user_id in range(1, args.users + 1):
+                    _, markup, _ = await bot.render_notes(user_id, 0, 5, 'en', None, 'older')
+                    next_pages[user_id] = markup.inline_keyboard[-2][-1].callback_data
+                update_id = first_message * 1000
+                for click in range(args.clicks):
+                    for user_id in range(1, args.users + 1):
+                        update_id += 1
+                        data = next_pages[user_id] if user_id % 2 else menus[click % len(menus)]
+                        await application.update_queue.put(Update.de_json(
+                            callback_update(update_id, user_id, first_message + user_id, data),
+                            application.bot,
+                        ))
+                total = args.users * args.clicks
+                while application.update_processor.processed < total:
+                    await asyncio.sleep(0.01)
+                await application.stop()
+            bot.db._run = run
+            calls = fake.calls - before
+            return calls['editMessageText'], reads[0], application.update_processor.superseded_clicks
+
+        async def run():
+            for user_id in range(1, args.users + 1):
+                await bot.db.ensure_user(user_id, f'user{user_id}', f'User{user_id}')
+                for i in range(30):
+                    note_id = await bot.db.save_note(user_id, random_text())
+                    if i % 5 == 0:
+                        await bot.db.toggle_pin(note_id, user_id)
+            plain = await storm(False, 100000)
+            coalesced = await storm(True, 200000)
+            await bot.shutdown(None)
+            return plain, coalesced
+
+        (plain_edits, plain_reads, _), (edits, reads, skipped) = asyncio.run(run())
+        fake.close()
+
+    clicks = args.users * args.clicks
+    print(f"\n🖱️ CLICK STORM ({args.clicks} rapid clicks from each of {args.users} users)")
+    print(f"   Without coalescing: {plain_edits} edits, {plain_reads} database reads")
+    print(f"   With coalescing:    {edits} edits, {reads} database reads "
+          f"({skipped} of {clicks} clicks skipped for a newer one)")
+
+def bucket_excess(times, rate, capacity, jitter):
+    """Most sends in any window beyond what a token bucket allows
+
+    A bucket lets through at most capacity + rate * T sends in any window
+    of T seconds. jitter widens each window for the time the requests
+    spent between the scheduler and the fake server.
+    """
+    worst = float('-inf')
+    for i, first in enumerate(times):
+        for j in range(i, len(times)):
+            allowed = capacity + rate * (times[j] - first + jitter)
+            worst = max(worst, j - i + 1 - allowed)
+    return worst
+
+def max_per_second(times):
+    """Largest number of sends within any one second"""
+    most, start = 0, 0
+    for end, at in enumerate(times):
+        while at - times[start] >= 1:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+def send_limits(args):
+    """Burst of sends through SendScheduler against a fake Bot API with flood errors"""
+    from telegram.ext import ExtBot
+
+    fake = FakeBotApi(flood_every=args.flood_every)
+    scheduler = SendScheduler(global_rate=args.global_rate, chat_rate=args.chat_rate,
+                              chat_burst=args.chat_burst)
+    bot = ExtBot('123456:BENCHMARK', base_url=f"{fake.url}/bot", rate_limiter=scheduler)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        waits = {PRIORITY_INTERACTIVE: [], PRIORITY_BACKGROUND: []}
+
+        async def send(i):
+            # Every third message is a background send, queued among the replies
+            priority = PRIORITY_BACKGROUND if i % 3 == 0 else PRIORITY_INTERACTIVE
+            start = loop.time()
+            await bot.send_message(i % args.chats + 1, f"message {i}",
+                                   rate_limit_args={'priority': priority})
+            waits[priority].append(loop.time() - start)
+
+        async with bot:
+            start = loop.time()
+            await asyncio.gather(*[send(i) for i in range(args.messages)])
+            elapsed = loop.time() - start
+        return elapsed, waits
+
+    elapsed, waits = asyncio.run(run())
+    fake.close()
+
+    attempts = sorted(fake.attempts)
+    times = [at for at, _ in attempts]
+    by_chat = {}
+    for at, chat_id in attempts:
+        by_chat.setdefault(chat_id, []).append(at)
+    global_excess = bucket_excess(times, args.global_rate, 1, args.jitter)
+    chat_excess = max(bucket_excess(t, args.chat_rate, args.chat_burst, args.jitter)
+                      for t in by_chat.values())
+
+    print(f"\n📤 SEND LIMITS ({args.messages} messages to {args.chats} chats at once, "
+          f"{args.global_rate:g}/s overall, {args.chat_rate:g}/s per chat, "
+          f"burst {args.chat_burst}, 429 on every {args.flood_every}th)")
+    print(f"   Delivered: {fake.sent}/{args.messages} in {elapsed:.2f}s "
+          f"({len(attempts)} attempts, {scheduler.retries} retried after 429)")
+    print(f"   Busiest second: {max_per_second(times)} sends overall, "
+          f"{max(max_per_second(t) for t in by_chat.values())} to one chat")
+    for priority, name in ((PRIORITY_INTERACTIVE, 'Interactive'), (PRIORITY_BACKGROUND, 'Background')):
+        samples = sorted(waits[priority])
+        print(f"   {name} wait: p50 {statistics.median(samples):.2f}s, "
+              f"p99 {percentile(samples, 0.99):.2f}s")
+    within = global_excess <= 0 and chat_excess <= 0
+    print(f"   {'✅' if within else '❌'} Token bucket limits "
+          f"{'held' if within else 'exceeded'} overall and in every chat")
+    if not within or fake.sent != args.messages:
+        raise SystemExit(1)
+
+def legacy_get_text(lang, key, *args):
+    """get_text as it was before the catalogs were compiled, for comparison"""
+    from languages import LANGUAGES
+    if lang not in LANGUAGES:
+        lang = 'en'
+    text = LANGUAGES[lang].get(key, LANGUAGES['en'].get(key, key))
+    if args:
+        try:
+            return text.format(*args)
+        except Exception:
+            return text
+    return text
+
+def i18n(args):
+    """CPU per update spent on texts and static keyboards, before and after caching"""
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py opens its database at import time
+        os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+        os.environ['DATABASE_FILE'] = os.path.join(tmp, 'i18n.db')
+        import bot
+        from languages import get_text, LANGUAGES
+
+        languages = list(LANGUAGES)
+        keyboards = [bot.get_home_keyboard, bot.get_back_keyboard, bot.get_settings_keyboard]
+
+        # Roughly what one button press renders: a few texts, one keyboard
+        def update(lang, text, keyboard):
+            text(lang, 'recent_notes', 1, 4)
+            text(lang, 'btn_previous')
+            text(lang, 'btn_next')
+            text(lang, 'menu_home')
+            text(lang, 'note_saved', 42)
+            text(lang, 'export_done', 7)  # English fallback outside 'en'
+            keyboard(lang)
+
+        def measure(text, build):
+            start = time.process_time()
+            for i in range(args.updates):
+                update(languages[i % len(languages)], text, build[i % len(build)])
+            return (time.process_time() - start) / args.updates * 1e6
+
+        uncached = [keyboard.__wrapped__ for keyboard in keyboards]
+        bot.get_text = legacy_get_text
+        try:
+            before = measure(legacy_get_text, uncached)
+        finally:
+            bot.get_text = get_text
+        after = measure(get_text, keyboards)
+        bot.db.close()
+
+    print(f"\n🌍 TEXTS AND KEYBOARDS ({args.updates} simulated updates, {len(languages)} languages)")
+    print(f"   Before: {before:.1f} µs CPU per update")
+    print(f"   After:  {after:.1f} µs CPU per update ({before / after:.1f}x less)")
+
+def main():
+    """Performance benchmarks"""
+    parser = argparse.ArgumentParser(description="Note Saver Bot benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    lag_parser = subparsers.add_parser(
+        'loop-lag', help="Event loop lag under concurrent database load"
+    )
+    lag_parser.add_argument('--users', type=int, default=50)
+    lag_parser.add_argument('--operations', type=int, default=20)
+    lag_parser.set_defaults(func=loop_lag)
+
+    stress_parser = subparsers.add_parser(
+        'stress', help="Concurrent readers and writers on one database"
+    )
+    stress_parser.add_argument('--writers', type=int, default=4)
+    stress_parser.add_argument('--readers', type=int, default=8)
+    stress_parser.add_argument('--seconds', type=float, default=5.0)
+    stress_parser.set_defaults(func=stress)
+
+    random_parser = subparsers.add_parser(
+        'random-uniformity', help="Statistical check of random note selection"
+    )
+    random_parser.add_argument('--notes', type=int, default=300)
+    random_parser.add_argument('--draws', type=int, default=60000)
+    random_parser.add_argument('--small-notes', type=int, default=7)
+    random_parser.add_argument('--small-left', type=int, default=2)
+    random_parser.set_defaults(func=random_uniformity)
+
+    backup_parser = subparsers.add_parser(
+        'backup-impact', help="Handler latency while an online backup runs"
+    )
+    backup_parser.add_argument('--notes', type=int, default=50000)
+    backup_parser.add_argument('--readers', type=int, default=4)
+    backup_parser.add_argument('--seconds', type=float, default=3.0)
+    backup_parser.set_defaults(func=backup_impact)
+
+    webhook_parser = subparsers.add_parser(
+        'webhook', help="End-to-end webhook throughput against a fake Bot API"
+    )
+    webhook_parser.add_argument('--updates', type=int, default=2000)
+    webhook_parser.add_argument('--users', type=int, default=100)
+    webhook_parser.add_argument('--concurrency', type=int, default=20)
+    webhook_parser.add_argument('--port', type=int, default=8444)
+    webhook_parser.add_argument('--timeout', type=float, default=120.0)
+    webhook_parser.set_defaults(func=webhook)
+
+    order_parser = subparsers.add_parser(
+        'update-order', help="Check per-user update ordering and measure throughput"
+    )
+    order_parser.add_argument('--updates', type=int, default=5000)
+    order_parser.add_argument('--users', type=int, default=200)
+    order_parser.add_argument('--hot-share', type=float, default=0.2)
+    order_parser.add_argument('--concurrency', type=int, default=64)
+    order_parser.add_argument('--handler-ms', type=float, default=2.0)
+    order_parser.add_argument('--seed', type=int, default=1)
+    order_parser.set_defaults(func=update_order)
+
+    i18n_parser = subparsers.add_parser(
+        'i18n', help="CPU per update for translated texts and static keyboards"
+    )
+    i18n_parser.add_argument('--updates', type=int, default=100000)
+    i18n_parser.set_defaults(func=i18n)
+
+    send_parser = subparsers.add_parser(
+        'send-limits', help="Check outbound flood limits under a burst of sends"
+    )
+    send_parser.add_argument('--messages', type=int, default=300)
+    send_parser.add_argument('--chats', type=int, default=50)
+    send_parser.add_argument('--global-rate', type=float, default=30)
+    send_parser.add_argument('--chat-rate', type=float, default=1)
+    send_parser.add_argument('--chat-burst', type=int, default=3)
+    send_parser.add_argument('--flood-every', type=int, default=100)
+    send_parser.add_argument('--jitter', type=float, default=0.02,
+                             help="Seconds of network delay tolerated per window")
+    send_parser.set_defaults(func=send_limits)
+
+    storm_parser = subparsers.add_parser(
+        'click-storm', help="Edits and database reads while users mash buttons"
+    )
+    storm_parser.add_argument('--users', type=int, default=40)
+    storm_parser.add_argument('--clicks', type=int, default=20)
+    storm_parser.set_defaults(func=click_storm)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
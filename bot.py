@@ -1,29 +1,160 @@
+import asyncio
 import logging
+import os
+import sys
+import tempfile
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     CallbackQueryHandler, ContextTypes, filters
 )
-from database import Database
-from config import BOT_TOKEN, DATABASE_FILE
+from async_database import AsyncDatabase
+from config import (
+    BOT_TOKEN, DATABASE_FILE, DATABASE_URL, DATABASE_POOL_SIZE, DATABASE_SHARDS,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET,
+    CONCURRENT_UPDATES,
+    ACTIVITY_BATCH_SIZE, ACTIVITY_FLUSH_INTERVAL, ACTIVITY_QUEUE_SIZE,
+    ACTIVITY_QUEUE_POLICY, ANALYTICS_REFRESH_INTERVAL, ANALYTICS_MAX_AGE,
+    BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP, BACKUP_COMPRESS,
+    RENDER_CACHE_SIZE, RENDER_CACHE_MB, SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_RATE,
+    SEND_CHAT_BURST
+)
+from analytics_snapshot import AnalyticsSnapshot
+from backup import BackupScheduler
+from cache import LRUCache
+from export import EXPORT_FORMATS, import_format
+from update_processor import PerUserUpdateProcessor
+from router import CallbackRouter, Int, Text
+from message_edits import MessageEdits
+from send_scheduler import SendScheduler, PRIORITY_BACKGROUND
+from storage import SNIPPET_START, SNIPPET_END
 from languages import get_text, get_available_languages
 import re
-from datetime import datetime
+from collections import deque
+from functools import lru_cache
+from datetime import datetime, timezone
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-db = Database(DATABASE_FILE)
+db = AsyncDatabase(
+    DATABASE_FILE,
+    database_url=DATABASE_URL,
+    pool_size=DATABASE_POOL_SIZE,
+    shards=DATABASE_SHARDS,
+    activity_options={
+        'batch_size': ACTIVITY_BATCH_SIZE,
+        'flush_interval': ACTIVITY_FLUSH_INTERVAL,
+        'max_queue': ACTIVITY_QUEUE_SIZE,
+        'policy': ACTIVITY_QUEUE_POLICY,
+    },
+)
+analytics = AnalyticsSnapshot(
+    db, refresh_interval=ANALYTICS_REFRESH_INTERVAL, max_age=ANALYTICS_MAX_AGE
+)
+backups = BackupScheduler(
+    db, BACKUP_DIR, BACKUP_INTERVAL, keep=BACKUP_KEEP, compress=BACKUP_COMPRESS
+)
+
+# Rendered note lists as (text, reply_markup, parse_mode). Keys carry the
+# user's data version, so entries of older versions are never looked up
+# again and age out of the LRU.
+renders = LRUCache(maxsize=RENDER_CACHE_SIZE, maxbytes=int(RENDER_CACHE_MB * 1048576))
+
+# Button callback data -> handler, see the routes below button_callback
+router = CallbackRouter()
+
+# Last content of messages edited from button clicks; unchanged edits are skipped
+edits = MessageEdits(maxsize=RENDER_CACHE_SIZE)
 
 # ADMIN USER IDS - Add your Telegram user ID here
 ADMIN_USER_IDS = [6653573130]  # Replace with your actual user ID
 
+# How many recent notes the 🎲 Random button avoids repeating
+RANDOM_HISTORY = 5
+
+@lru_cache(maxsize=4096)
+def format_day(day):
+    """'Jan 05, 2024' for a UTC day number (epoch seconds // 86400)"""
+    return datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%b %d, %Y')
+
+def format_note_date(created_at):
+    """Display date of an epoch timestamp; formatted once per day, not per note"""
+    return format_day(created_at // 86400) if created_at is not None else ''
+
+def format_snippet(snippet, limit=80):
+    """Markdown for a search snippet: matched words in bold, at most limit characters
+    
+    The plain text is cut first and escaped afterwards, so a cut never
+    leaves a '*' or an escape open.
+    """
+    parts = re.split(f'([{SNIPPET_START}{SNIPPET_END}])', snippet)
+    shown = 0
+    bold = False
+    formatted = []
+    for part in parts:
+        if part in (SNIPPET_START, SNIPPET_END):
+            bold = part == SNIPPET_START
+            continue
+        if not part:
+            continue
+        if shown >= limit:
+            formatted.append('...')
+            break
+        text = part[:limit - shown]
+        shown += len(text)
+        escaped = escape_markdown(text)
+        formatted.append(f'*{escaped}*' if bold else escaped)
+        if len(text) < len(part):
+            formatted.append('...')
+            break
+    return ''.join(formatted)
+
+# Rough size of an InlineKeyboardButton without its strings
+BUTTON_BYTES = 400
+
+def render_size(rendered):
+    """Approximate bytes held by a cached (text, reply_markup, parse_mode)"""
+    text, reply_markup, _ = rendered
+    size = sys.getsizeof(text)
+    for row in reply_markup.inline_keyboard:
+        for button in row:
+            size += BUTTON_BYTES + sys.getsizeof(button.text) + sys.getsizeof(button.callback_data)
+    return size
+
+async def cached_render(user_id, view, lang, render):
+    """A view from the render cache, or await render() and cache it
+    
+    view is a tuple naming the view and its page or cursor. render() returns
+    (text, reply_markup, parse_mode), or None for nothing to show.
+    """
+    # Read the version first: a write while render() runs bumps it past this key
+    key = (user_id, view, lang, db.data_version(user_id))
+    rendered = renders.get(key)
+    if rendered is None:
+        rendered = await render()
+        if rendered is not None:
+            renders.set(key, rendered, render_size(rendered))
+    return rendered
+
+async def edit_rendered(query, rendered):
+    """Show a rendered view in the query's message"""
+    text, reply_markup, parse_mode = rendered
+    await edits.edit(query, text, parse_mode=parse_mode, reply_markup=reply_markup)
+
 # Helper function to get user's language
-def get_user_lang(user_id):
+async def get_user_lang(user_id):
     """Get user's language preference"""
-    return db.get_user_language(user_id)
+    return await db.get_user_language(user_id)
+
+# Static keyboards depend only on the language. PTB's InlineKeyboardMarkup
+# is immutable, so each is built once per language and shared by all messages.
 
 # Language selection keyboard
+@lru_cache(maxsize=1)
 def get_language_keyboard():
     """Create language selection keyboard"""
     languages = get_available_languages()
@@ -31,7 +162,7 @@ def get_language_keyboard():
     
     row = []
     for code, flag, name in languages:
-        row.append(InlineKeyboardButton(f"{flag} {name}", callback_data=f"lang_{code}"))
+        row.append(InlineKeyboardButton(f"{flag} {name}", callback_data=router.data("lang", code)))
         if len(row) == 2:
             keyboard.append(row)
             row = []
@@ -42,6 +173,7 @@ def get_language_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 # Keyboard layouts
+@lru_cache(maxsize=64)
 def get_home_keyboard(lang='en'):
     """Main menu keyboard"""
     keyboard = [
@@ -68,29 +200,32 @@ def get_note_actions_keyboard(note_id, is_pinned=False, lang='en'):
     pin_text = "📌 Unpin" if is_pinned else "📌 Pin"
     keyboard = [
         [
-            InlineKeyboardButton("🏷️ Add Tags", callback_data=f"tag_{note_id}"),
-            InlineKeyboardButton(pin_text, callback_data=f"pin_{note_id}")
+            InlineKeyboardButton("🏷️ Add Tags", callback_data=router.data("tag", note_id)),
+            InlineKeyboardButton(pin_text, callback_data=router.data("pin", note_id))
         ],
         [
-            InlineKeyboardButton("🗑️ Delete", callback_data=f"delete_{note_id}"),
+            InlineKeyboardButton("🗑️ Delete", callback_data=router.data("delete", note_id)),
             InlineKeyboardButton(get_text(lang, 'menu_home'), callback_data="menu_home")
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=64)
 def get_back_keyboard(lang='en'):
     """Simple back button"""
     keyboard = [[InlineKeyboardButton(get_text(lang, 'menu_home'), callback_data="menu_home")]]
     return InlineKeyboardMarkup(keyboard)
 
-def get_search_keyboard(user_id, lang='en'):
+async def get_search_keyboard(user_id, lang='en'):
     """Quick search filters"""
-    tags = db.get_popular_tags(user_id, limit=6)
+    tags = await db.get_popular_tags(user_id, limit=6)
     keyboard = []
     
+    # Tags too long for Telegram's 64-byte callback data get no button
+    tags = [tag for tag in tags if router.fits("search_tag", tag)]
     tag_row = []
     for i, tag in enumerate(tags):
-        tag_row.append(InlineKeyboardButton(f"#{tag}", callback_data=f"search_tag_{tag}"))
+        tag_row.append(InlineKeyboardButton(f"#{tag}", callback_data=router.data("search_tag", tag)))
         if (i + 1) % 3 == 0:
             keyboard.append(tag_row)
             tag_row = []
@@ -105,6 +240,7 @@ def get_search_keyboard(user_id, lang='en'):
     
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=64)
 def get_settings_keyboard(lang='en'):
     """Settings menu keyboard"""
     keyboard = [
@@ -122,10 +258,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send welcome message with language selection"""
     user = update.effective_user
     
-    user_lang = db.get_user_language(user.id)
+    user_lang = await db.get_user_language(user.id)
     
     if not user_lang or user_lang == 'en':
-        db.ensure_user(user.id, user.username, user.first_name, 'en')
+        await db.ensure_user(user.id, user.username, user.first_name, 'en')
         
         await update.message.reply_text(
             f"👋 Welcome {user.first_name}!\n\n🌐 Please choose your language:",
@@ -135,7 +271,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_welcome(update.message, user, user_lang)
     
     # Log activity
-    db.log_user_activity(user.id, 'bot_started')
+    await db.log_user_activity(user.id, 'bot_started')
 
 async def show_welcome(message, user, lang):
     """Show welcome message after language is set"""
@@ -152,7 +288,7 @@ async def show_welcome(message, user, lang):
     )
 
 async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show analytics (admin only)"""
+    """Show analytics (admin only); "/analytics refresh" recomputes first"""
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_USER_IDS:
@@ -160,19 +296,21 @@ async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Log admin access
-    db.log_user_activity(user_id, 'admin_analytics_viewed')
-    
-    # Generate stats
-    total_users = db.get_total_users()
-    active_7d = db.get_active_users(7)
-    active_30d = db.get_active_users(30)
-    total_notes = db.get_total_notes_all_users()
-    new_users_today = db.get_new_users_today()
-    notes_today = db.get_notes_created_today()
-    languages = db.get_language_distribution()
-    note_types = db.get_notes_by_type_stats()
-    top_users = db.get_top_users(5)
-    popular_tags = db.get_popular_tags_global(10)
+    await db.log_user_activity(user_id, 'admin_analytics_viewed')
+    
+    # Latest precomputed stats
+    force = bool(context.args) and context.args[0].lower() == 'refresh'
+    snapshot = await analytics.get(force=force)
+    total_users = snapshot['total_users']
+    active_7d = snapshot['active_7d']
+    active_30d = snapshot['active_30d']
+    total_notes = snapshot['total_notes']
+    new_users_today = snapshot['new_users_today']
+    notes_today = snapshot['notes_today']
+    languages = snapshot['languages']
+    note_types = snapshot['note_types']
+    top_users = snapshot['top_users']
+    popular_tags = snapshot['popular_tags']
     
     # Calculate percentages
     activity_rate_7d = (active_7d / total_users * 100) if total_users > 0 else 0
@@ -243,16 +381,206 @@ async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += f"{i}. #{tag}: `{count}` uses\n"
     
     text += "\n━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-    text += f"📅 Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    generated = datetime.fromtimestamp(snapshot['generated_at'], timezone.utc)
+    text += f"📅 Generated: {generated.strftime('%Y-%m-%d %H:%M:%S')} UTC ({int(analytics.age() // 60)} min ago)\n"
+    text += "🔄 /analytics refresh to recompute now"
     
     await update.message.reply_text(text, parse_mode='Markdown')
 
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show cache and queue counters (admin only)"""
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ Access denied! You are not authorized to view metrics.")
+        return
+    
+    metrics = db.metrics()
+    profiles = metrics['profile_cache']
+    activity = metrics['activity_logger']
+    updates = context.application.update_processor.metrics()
+    rendered = renders.stats()
+    edited = edits.stats()
+    
+    text = (
+        "📈 *BOT METRICS*\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        
+        "👤 *PROFILE CACHE*\n"
+        f"├ Size: `{profiles['size']}/{profiles['maxsize']}`\n"
+        f"├ Hits: `{profiles['hits']}`\n"
+        f"├ Misses: `{profiles['misses']}`\n"
+        f"├ Evictions: `{profiles['evictions']}`\n"
+        f"└ Hit Rate: `{profiles['hit_rate']:.1f}%`\n\n"
+        
+        "🖼️ *RENDER CACHE*\n"
+        f"├ Pages: `{rendered['size']}/{rendered['maxsize']}`\n"
+        f"├ Memory: `{rendered['bytes'] / 1048576:.1f}/{rendered['maxbytes'] / 1048576:.0f} MB`\n"
+        f"├ Hits: `{rendered['hits']}`\n"
+        f"├ Misses: `{rendered['misses']}`\n"
+        f"├ Evictions: `{rendered['evictions']}`\n"
+        f"└ Hit Rate: `{rendered['hit_rate']:.1f}%`\n\n"
+        
+        "📝 *ACTIVITY BUFFER*\n"
+        f"├ Queued: `{activity['queued']}`\n"
+        f"├ Written: `{activity['written']}`\n"
+        f"├ Dropped: `{activity['dropped']}`\n"
+        f"└ Failed: `{activity['failed']}`\n\n"
+        
+        "⚙️ *UPDATES*\n"
+        f"├ Running: `{updates['active']}/{updates['limit']}` (peak `{updates['max_active']}`)\n"
+        f"├ Processed: `{updates['processed']}`\n"
+        f"├ Users Busy: `{updates['users']}`\n"
+        f"├ Waited For Own Earlier Update: `{updates['queued']}` (longest queue `{updates['max_queue']}`)\n"
+        f"└ Clicks Skipped For A Newer One: `{updates['superseded']}`\n\n"
+        
+        "✏️ *MESSAGE EDITS*\n"
+        f"├ Sent: `{edited['sent']}`\n"
+        f"├ Skipped Unchanged: `{edited['unchanged']}`\n"
+        f"└ Not Modified Errors: `{edited['not_modified']}`\n"
+    )
+    
+    sends = context.bot.rate_limiter.metrics()
+    text += (
+        "\n📤 *SEND QUEUE*\n"
+        f"├ Waiting: `{sends['waiting']}` (peak `{sends['max_waiting']}`)\n"
+        f"├ Sent: `{sends['sent']}`\n"
+        f"├ Avg Wait: `{sends['interactive_wait_ms']:.0f} ms` interactive, "
+        f"`{sends['background_wait_ms']:.0f} ms` background\n"
+        f"├ Flood Retries: `{sends['retries']}`\n"
+        f"└ Paused: `{sends['paused']:.1f}s`\n"
+    )
+    
+    routes = [route for route in router.stats() if route['calls']][:8]
+    if routes:
+        text += "\n🔀 *BUTTON ROUTES*\n"
+        for route in routes:
+            text += (f"• `{route['name']}`: `{route['calls']}` calls, "
+                     f"avg `{route['avg_ms']:.1f} ms`, max `{route['max_ms']:.0f} ms`")
+            if route['errors'] or route['invalid']:
+                text += f", `{route['errors']}` errors, `{route['invalid']}` bad data"
+            text += "\n"
+        if router.unknown:
+            text += f"• Unknown data: `{router.unknown}`\n"
+    
+    if backups.last:
+        last = backups.last
+        finished = datetime.fromtimestamp(last['finished_at'], timezone.utc)
+        text += (
+            "\n💾 *LAST BACKUP*\n"
+            f"├ Finished: `{finished.strftime('%Y-%m-%d %H:%M')} UTC`\n"
+            f"├ Duration: `{last['seconds']:.1f}s`\n"
+            f"├ Size: `{last['bytes'] / 1048576:.1f} MB` in {last['files']} files\n"
+            f"├ Restarts: `{last['restarts']}`\n"
+            f"└ Failed runs: `{backups.failures}`\n"
+        )
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send all of the user's notes as a JSONL file, or CSV with /export csv"""
+    user_id = update.effective_user.id
+    lang = await get_user_lang(user_id)
+    
+    fmt = context.args[0].lower() if context.args else 'jsonl'
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(get_text(lang, 'export_usage'))
+        return
+    
+    status = await update.message.reply_text(get_text(lang, 'export_started'))
+    
+    # Notes are streamed into a temp file, never held in memory together
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        count = await db.export_notes(user_id, path, fmt)
+        if not count:
+            await status.edit_text(get_text(lang, 'no_notes'))
+            return
+        
+        filename = f"notes-{datetime.now(timezone.utc).strftime('%Y-%m-%d')}.{fmt}"
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document, filename=filename, caption=get_text(lang, 'export_done', count)
+            )
+        await status.delete()
+    finally:
+        os.remove(path)
+    
+    await db.log_user_activity(user_id, 'notes_exported', f'format:{fmt}')
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ask for an export file; the next document sent is imported"""
+    user_id = update.effective_user.id
+    lang = await get_user_lang(user_id)
+    
+    context.user_data['awaiting_import'] = True
+    await update.message.reply_text(get_text(lang, 'import_prompt'))
+
+async def import_notes_file(update: Update, context: ContextTypes.DEFAULT_TYPE, lang):
+    """Import the document of the message, editing a status message as it goes"""
+    user_id = update.effective_user.id
+    document = update.message.document
+    
+    fmt = import_format(document.file_name)
+    if fmt is None:
+        await update.message.reply_text(get_text(lang, 'import_bad_file'))
+        return
+    del context.user_data['awaiting_import']
+    
+    status = await update.message.reply_text(get_text(lang, 'import_started'))
+    loop = asyncio.get_running_loop()
+    last_update = [time.monotonic()]
+    
+    async def show_progress(rows_done):
+        try:
+            await status.edit_text(get_text(lang, 'import_progress', rows_done),
+                                   rate_limit_args={'priority': PRIORITY_BACKGROUND})
+        except TelegramError:
+            pass
+    
+    def progress(rows_done):
+        # Called on the import thread after every batch; edits are throttled
+        now = time.monotonic()
+        if now - last_update[0] >= 3:
+            last_update[0] = now
+            asyncio.run_coroutine_threadsafe(show_progress(rows_done), loop)
+    
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        # The same file always has the same file_unique_id, so sending it
+        # again resumes an interrupted import instead of starting over
+        result = await db.import_notes(user_id, path, document.file_unique_id, fmt, progress)
+    except ValueError as e:
+        await status.edit_text(get_text(lang, 'import_failed', e))
+        return
+    finally:
+        os.remove(path)
+    
+    if result is None:
+        text = get_text(lang, 'import_already_done')
+    elif result[1]:
+        text = get_text(lang, 'import_resumed', result[0], result[1])
+    else:
+        text = get_text(lang, 'import_done', result[0])
+    await status.edit_text(text, reply_markup=get_home_keyboard(lang))
+    
+    if result:
+        await db.log_user_activity(user_id, 'notes_imported', f'count:{result[0]}')
+
 # Message handler - save notes
 async def save_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Save any forwarded or sent message"""
     user_id = update.effective_user.id
     message = update.message
-    lang = get_user_lang(user_id)
+    lang = await get_user_lang(user_id)
+    
+    if message.document and context.user_data.get('awaiting_import'):
+        await import_notes_file(update, context, lang)
+        return
     
     content = ""
     message_type = "text"
@@ -290,7 +618,7 @@ async def save_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     hashtags = re.findall(r'#(\w+)', content)
     
-    note_id = db.save_note(
+    note_id = await db.save_note(
         user_id=user_id,
         content=content,
         message_type=message_type,
@@ -300,10 +628,10 @@ async def save_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     for tag in hashtags:
-        db.add_tag(note_id, tag.lower())
+        await db.add_tag(note_id, tag.lower(), user_id)
     
     # Log activity
-    db.log_user_activity(user_id, 'note_created', f'type:{message_type}')
+    await db.log_user_activity(user_id, 'note_created', f'type:{message_type}')
     
     response_text = get_text(lang, 'note_saved', note_id)
     if hashtags:
@@ -317,8 +645,8 @@ async def save_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def view_note_original(query, user_id, note_id, context):
     """Resend the original message"""
-    lang = get_user_lang(user_id)
-    note = db.get_note(note_id, user_id)
+    lang = await get_user_lang(user_id)
+    note = await db.get_note(note_id, user_id)
     
     if not note:
         await query.answer("Note not found!")
@@ -328,23 +656,17 @@ async def view_note_original(query, user_id, note_id, context):
     
     chat_id = query.message.chat_id
     
-    if isinstance(created_at, str):
-        try:
-            created_at = datetime.fromisoformat(created_at)
-        except:
-            created_at = datetime.now()
-    
     tag_text = " ".join([f"#{t}" for t in tags]) if tags else ""
     caption_text = (
         f"📌 *Note #{note_id}*\n"
-        f"📅 {created_at.strftime('%b %d, %Y')}\n"
+        f"📅 {format_note_date(created_at)}\n"
     )
     if tag_text:
         caption_text += f"{tag_text}\n"
     caption_text += f"\n{content}"
     
     # Log activity
-    db.log_user_activity(user_id, 'note_viewed', f'note_id:{note_id}')
+    await db.log_user_activity(user_id, 'note_viewed', f'note_id:{note_id}')
     
     try:
         if message_type == "photo" and file_id:
@@ -403,127 +725,179 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    user_id = query.from_user.id
-    data = query.data
-    lang = get_user_lang(user_id)
-    
-    # Language selection
-    if data.startswith("lang_"):
-        new_lang = data.split("_")[1]
-        db.set_user_language(user_id, new_lang)
-        db.log_user_activity(user_id, 'language_changed', f'to:{new_lang}')
-        
-        await query.edit_message_text(
-            get_text(new_lang, 'language_selected')
-        )
-        
-        user = query.from_user
-        await show_welcome(query.message, user, new_lang)
+    # A newer click on this message is already queued and redraws it anyway
+    if router.coalesces(query.data) and context.application.update_processor.superseded(update):
         return
     
-    # Menu navigation
-    if data == "menu_home":
-        db.log_user_activity(user_id, 'menu_home')
-        await show_home(query, lang)
-    
-    elif data == "menu_notes":
-        db.log_user_activity(user_id, 'view_notes')
-        await show_notes(query, user_id, page=0, lang=lang)
-    
-    elif data == "menu_search":
-        db.log_user_activity(user_id, 'search_initiated')
-        await show_search_menu(query, user_id, context, lang)
-    
-    elif data == "menu_pinned":
-        db.log_user_activity(user_id, 'view_pinned')
-        await show_pinned_notes(query, user_id, lang)
-    
-    elif data == "menu_stats":
-        db.log_user_activity(user_id, 'view_stats')
-        await show_stats(query, user_id, lang)
-    
-    elif data == "menu_random":
-        db.log_user_activity(user_id, 'random_note')
-        await show_random_note(query, user_id, lang)
-    
-    elif data == "menu_help":
-        db.log_user_activity(user_id, 'view_help')
-        await show_help(query, lang)
-    
-    elif data == "menu_settings":
-        db.log_user_activity(user_id, 'view_settings')
-        await show_settings(query, lang)
-    
-    elif data == "settings_language":
-        await query.edit_message_text(
-            get_text(lang, 'choose_language'),
-            reply_markup=get_language_keyboard()
-        )
-    
-    # Note actions
-    elif data.startswith("view_"):
-        note_id = int(data.split("_")[1])
-        await view_note_original(query, user_id, note_id, context)
-    
-    elif data.startswith("tag_"):
-        note_id = int(data.split("_")[1])
-        context.user_data['awaiting_tags'] = note_id
-        await query.edit_message_text(
-            get_text(lang, 'send_tags'),
-            reply_markup=get_back_keyboard(lang)
-        )
+    user_id = query.from_user.id
+    lang = await get_user_lang(user_id)
+    await router.dispatch(query.data, query, context, user_id, lang)
+
+# Button routes: each gets (query, context, user_id, lang, *arguments)
+@router.route("lang", Text(8))
+async def on_language(query, context, user_id, lang, new_lang):
+    """Language selection"""
+    await db.set_user_language(user_id, new_lang)
+    await db.log_user_activity(user_id, 'language_changed', f'to:{new_lang}')
+    
+    await edits.edit(
+        query,
+        get_text(new_lang, 'language_selected')
+    )
     
-    elif data.startswith("pin_"):
-        note_id = int(data.split("_")[1])
-        db.toggle_pin(note_id)
-        db.log_user_activity(user_id, 'note_pinned', f'note_id:{note_id}')
-        await query.answer(get_text(lang, 'pin_updated'))
-        await show_notes(query, user_id, page=0, lang=lang)
-    
-    elif data.startswith("delete_"):
-        note_id = int(data.split("_")[1])
-        
-        keyboard = [
-            [
-                InlineKeyboardButton(get_text(lang, 'btn_yes_delete'), callback_data=f"confirm_delete_{note_id}"),
-                InlineKeyboardButton(get_text(lang, 'btn_cancel'), callback_data="menu_notes")
-            ]
+    user = query.from_user
+    await show_welcome(query.message, user, new_lang)
+
+# Menu navigation
+@router.route("menu_home", coalesce=True)
+async def on_menu_home(query, context, user_id, lang):
+    """Main menu"""
+    await db.log_user_activity(user_id, 'menu_home')
+    await show_home(query, lang)
+
+@router.route("menu_notes", coalesce=True)
+async def on_menu_notes(query, context, user_id, lang):
+    """First page of notes"""
+    await db.log_user_activity(user_id, 'view_notes')
+    await show_notes(query, user_id, page=0, lang=lang)
+
+@router.route("menu_search", coalesce=True)
+async def on_menu_search(query, context, user_id, lang):
+    """Search options"""
+    await db.log_user_activity(user_id, 'search_initiated')
+    await show_search_menu(query, user_id, context, lang)
+
+@router.route("menu_pinned", coalesce=True)
+async def on_menu_pinned(query, context, user_id, lang):
+    """Pinned notes"""
+    await db.log_user_activity(user_id, 'view_pinned')
+    await show_pinned_notes(query, user_id, lang)
+
+@router.route("menu_stats", coalesce=True)
+async def on_menu_stats(query, context, user_id, lang):
+    """User statistics"""
+    await db.log_user_activity(user_id, 'view_stats')
+    await show_stats(query, user_id, lang)
+
+@router.route("menu_random", coalesce=True)
+async def on_menu_random(query, context, user_id, lang):
+    """Random note"""
+    await db.log_user_activity(user_id, 'random_note')
+    await show_random_note(query, user_id, context, lang)
+
+@router.route("menu_help", coalesce=True)
+async def on_menu_help(query, context, user_id, lang):
+    """Help"""
+    await db.log_user_activity(user_id, 'view_help')
+    await show_help(query, lang)
+
+@router.route("menu_settings", coalesce=True)
+async def on_menu_settings(query, context, user_id, lang):
+    """Settings"""
+    await db.log_user_activity(user_id, 'view_settings')
+    await show_settings(query, lang)
+
+@router.route("settings_language", coalesce=True)
+async def on_settings_language(query, context, user_id, lang):
+    """Language selection from settings"""
+    await edits.edit(
+        query,
+        get_text(lang, 'choose_language'),
+        reply_markup=get_language_keyboard()
+    )
+
+# Note actions
+@router.route("view", int)
+async def on_view(query, context, user_id, lang, note_id):
+    """Send the original message of a media note"""
+    await view_note_original(query, user_id, note_id, context)
+
+@router.route("tag", int)
+async def on_tag(query, context, user_id, lang, note_id):
+    """Ask for tags for a note"""
+    context.user_data['awaiting_tags'] = note_id
+    await edits.edit(
+        query,
+        get_text(lang, 'send_tags'),
+        reply_markup=get_back_keyboard(lang)
+    )
+
+@router.route("pin", int)
+async def on_pin(query, context, user_id, lang, note_id):
+    """Pin or unpin a note"""
+    await db.toggle_pin(note_id, user_id)
+    await db.log_user_activity(user_id, 'note_pinned', f'note_id:{note_id}')
+    await query.answer(get_text(lang, 'pin_updated'))
+    await show_notes(query, user_id, page=0, lang=lang)
+
+@router.route("delete", int)
+async def on_delete(query, context, user_id, lang, note_id):
+    """Ask before deleting a note"""
+    keyboard = [
+        [
+            InlineKeyboardButton(get_text(lang, 'btn_yes_delete'), callback_data=router.data("confirm_delete", note_id)),
+            InlineKeyboardButton(get_text(lang, 'btn_cancel'), callback_data="menu_notes")
         ]
-        
-        await query.edit_message_text(
-            get_text(lang, 'delete_confirm', note_id),
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    
-    elif data.startswith("confirm_delete_"):
-        note_id = int(data.split("_")[2])
-        db.delete_note(note_id)
-        db.log_user_activity(user_id, 'note_deleted', f'note_id:{note_id}')
-        await query.answer(get_text(lang, 'note_deleted'))
-        await show_notes(query, user_id, page=0, lang=lang)
-    
-    # Pagination
-    elif data.startswith("notes_page_"):
-        page = int(data.split("_")[2])
-        await show_notes(query, user_id, page, lang)
-    
-    # Search
-    elif data.startswith("search_tag_"):
-        tag = data.split("_", 2)[2]
-        db.log_user_activity(user_id, 'search_by_tag', f'tag:{tag}')
-        await search_by_tag(query, user_id, tag, lang)
-    
-    elif data == "search_week":
-        db.log_user_activity(user_id, 'search_week')
-        await search_this_week(query, user_id, lang)
+    ]
     
-    elif data == "noop":
-        pass
+    await edits.edit(
+        query,
+        get_text(lang, 'delete_confirm', note_id),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@router.route("confirm_delete", int)
+async def on_confirm_delete(query, context, user_id, lang, note_id):
+    """Delete a note"""
+    await db.delete_note(note_id, user_id)
+    await db.log_user_activity(user_id, 'note_deleted', f'note_id:{note_id}')
+    await query.answer(get_text(lang, 'note_deleted'))
+    await show_notes(query, user_id, page=0, lang=lang)
+
+# Pagination
+async def on_first_page(query, context, user_id, lang):
+    """Buttons from before keyset pagination or epoch timestamps: restart from the first page"""
+    await show_notes(query, user_id, page=0, lang=lang)
+
+@router.route("notes_older", Int(6), Int(12), Int(12), fallback=on_first_page, coalesce=True)
+async def on_notes_older(query, context, user_id, lang, page, created_at, note_id):
+    """Next page of notes"""
+    await show_notes(query, user_id, page, lang=lang,
+                     cursor=(created_at, note_id), direction='older')
+
+@router.route("notes_newer", Int(6), Int(12), Int(12), fallback=on_first_page, coalesce=True)
+async def on_notes_newer(query, context, user_id, lang, page, created_at, note_id):
+    """Previous page of notes"""
+    await show_notes(query, user_id, page, lang=lang,
+                     cursor=(created_at, note_id), direction='newer')
+
+@router.route("notes_page", Text(20), coalesce=True)
+async def on_notes_page(query, context, user_id, lang, page):
+    """Page buttons from before keyset pagination"""
+    await on_first_page(query, context, user_id, lang)
+
+# Search
+@router.route("search_tag", Text(48), coalesce=True)
+async def on_search_tag(query, context, user_id, lang, tag):
+    """Notes with a tag"""
+    await db.log_user_activity(user_id, 'search_by_tag', f'tag:{tag}')
+    await search_by_tag(query, user_id, tag, lang)
+
+@router.route("search_week", coalesce=True)
+async def on_search_week(query, context, user_id, lang):
+    """Notes from the last 7 days"""
+    await db.log_user_activity(user_id, 'search_week')
+    await search_this_week(query, user_id, lang)
+
+@router.route("noop")
+async def on_noop(query, context, user_id, lang):
+    """Page counter button, does nothing"""
 
 # Menu display functions
 async def show_home(query, lang='en'):
     """Show main menu"""
-    await query.edit_message_text(
+    await edits.edit(
+        query,
         f"{get_text(lang, 'welcome_title')}\n\n{get_text(lang, 'menu_home')}:",
         parse_mode='Markdown',
         reply_markup=get_home_keyboard(lang)
@@ -531,25 +905,34 @@ async def show_home(query, lang='en'):
 
 async def show_settings(query, lang='en'):
     """Show settings menu"""
-    await query.edit_message_text(
+    await edits.edit(
+        query,
         get_text(lang, 'settings_title'),
         parse_mode='Markdown',
         reply_markup=get_settings_keyboard(lang)
     )
 
-async def show_notes(query, user_id, page=0, per_page=5, lang='en'):
-    """Show recent notes with pagination"""
-    offset = page * per_page
-    notes = db.get_recent_notes(user_id, limit=per_page, offset=offset)
-    total_count = db.get_note_count(user_id)
-    total_pages = max(1, (total_count + per_page - 1) // per_page)
+async def show_notes(query, user_id, page=0, per_page=5, lang='en',
+                     cursor=None, direction='older'):
+    """Show recent notes with keyset pagination"""
+    rendered = await cached_render(
+        user_id, ('notes', page, per_page, cursor, direction), lang,
+        lambda: render_notes(user_id, page, per_page, lang, cursor, direction)
+    )
+    await edit_rendered(query, rendered)
+
+async def render_notes(user_id, page, per_page, lang, cursor, direction):
+    """Text and buttons of one page of recent notes"""
+    notes, has_older, has_newer = await db.get_notes_page(
+        user_id, limit=per_page, cursor=cursor, direction=direction
+    )
+    if not has_newer:
+        page = 0
+    total_count = await db.get_note_count(user_id)
+    total_pages = max(1, (total_count + per_page - 1) // per_page, page + 1 + has_older)
     
     if not notes:
-        await query.edit_message_text(
-            get_text(lang, 'no_notes'),
-            reply_markup=get_back_keyboard(lang)
-        )
-        return
+        return get_text(lang, 'no_notes'), get_back_keyboard(lang), None
     
     text = get_text(lang, 'recent_notes', page + 1, total_pages) + "\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -557,12 +940,6 @@ async def show_notes(query, user_id, page=0, per_page=5, lang='en'):
     for i, note in enumerate(notes):
         note_id, content, created_at, pinned, message_type, file_id, tags = note
         
-        if isinstance(created_at, str):
-            try:
-                created_at = datetime.fromisoformat(created_at)
-            except:
-                created_at = datetime.now()
-        
         display_content = content[:100] + "..." if len(content) > 100 else content
         
         media_icons = {
@@ -585,7 +962,7 @@ async def show_notes(query, user_id, page=0, per_page=5, lang='en'):
         if tag_text:
             text += f"{tag_text}\n"
         
-        text += f"📅 {created_at.strftime('%b %d, %Y')}\n"
+        text += f"📅 {format_note_date(created_at)}\n"
         
         if i < len(notes) - 1:
             text += "\n─────────────────\n\n"
@@ -602,55 +979,64 @@ async def show_notes(query, user_id, page=0, per_page=5, lang='en'):
         
         if message_type != "text":
             keyboard.append([
-                InlineKeyboardButton(f"👁️ View #{note_id}", callback_data=f"view_{note_id}"),
-                InlineKeyboardButton(f"🏷️ #{note_id}", callback_data=f"tag_{note_id}"),
-                InlineKeyboardButton(f"🗑️ #{note_id}", callback_data=f"delete_{note_id}")
+                InlineKeyboardButton(f"👁️ View #{note_id}", callback_data=router.data("view", note_id)),
+                InlineKeyboardButton(f"🏷️ #{note_id}", callback_data=router.data("tag", note_id)),
+                InlineKeyboardButton(f"🗑️ #{note_id}", callback_data=router.data("delete", note_id))
             ])
         else:
             keyboard.append([
-                InlineKeyboardButton(f"🏷️ Tag #{note_id}", callback_data=f"tag_{note_id}"),
-                InlineKeyboardButton(f"{pin_icon} #{note_id}", callback_data=f"pin_{note_id}"),
-                InlineKeyboardButton(f"🗑️ #{note_id}", callback_data=f"delete_{note_id}")
+                InlineKeyboardButton(f"🏷️ Tag #{note_id}", callback_data=router.data("tag", note_id)),
+                InlineKeyboardButton(f"{pin_icon} #{note_id}", callback_data=router.data("pin", note_id)),
+                InlineKeyboardButton(f"🗑️ #{note_id}", callback_data=router.data("delete", note_id))
             ])
     
+    # Page buttons carry the (created_at, note_id) cursor of the edge note
     nav_row = []
-    if page > 0:
-        nav_row.append(InlineKeyboardButton(get_text(lang, 'btn_previous'), callback_data=f"notes_page_{page-1}"))
+    if has_newer:
+        first = notes[0]
+        nav_row.append(InlineKeyboardButton(
+            get_text(lang, 'btn_previous'),
+            callback_data=router.data("notes_newer", page - 1, first[2], first[0])
+        ))
     
     nav_row.append(InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data="noop"))
     
-    if page < total_pages - 1:
-        nav_row.append(InlineKeyboardButton(get_text(lang, 'btn_next'), callback_data=f"notes_page_{page+1}"))
+    if has_older:
+        last = notes[-1]
+        nav_row.append(InlineKeyboardButton(
+            get_text(lang, 'btn_next'),
+            callback_data=router.data("notes_older", page + 1, last[2], last[0])
+        ))
     
     keyboard.append(nav_row)
     keyboard.append([InlineKeyboardButton(get_text(lang, 'menu_home'), callback_data="menu_home")])
     
-    await query.edit_message_text(
-        text,
-        parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    return text, InlineKeyboardMarkup(keyboard), 'Markdown'
 
 async def show_search_menu(query, user_id, context, lang='en'):
     """Show search options"""
     context.user_data['awaiting_search'] = True
     
-    await query.edit_message_text(
+    await edits.edit(
+        query,
         get_text(lang, 'search_prompt'),
         parse_mode='Markdown',
-        reply_markup=get_search_keyboard(user_id, lang)
+        reply_markup=await get_search_keyboard(user_id, lang)
     )
 
 async def show_pinned_notes(query, user_id, lang='en'):
     """Show all pinned notes"""
-    notes = db.get_pinned_notes(user_id)
+    rendered = await cached_render(
+        user_id, ('pinned',), lang, lambda: render_pinned_notes(user_id, lang)
+    )
+    await edit_rendered(query, rendered)
+
+async def render_pinned_notes(user_id, lang):
+    """Text and buttons of the pinned notes list"""
+    notes = await db.get_pinned_notes(user_id)
     
     if not notes:
-        await query.edit_message_text(
-            get_text(lang, 'no_pinned'),
-            reply_markup=get_back_keyboard(lang)
-        )
-        return
+        return get_text(lang, 'no_pinned'), get_back_keyboard(lang), None
     
     text = get_text(lang, 'pinned_notes') + "\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -670,15 +1056,11 @@ async def show_pinned_notes(query, user_id, lang='en'):
         else:
             text += "\n"
     
-    await query.edit_message_text(
-        text,
-        parse_mode='Markdown',
-        reply_markup=get_back_keyboard(lang)
-    )
+    return text, get_back_keyboard(lang), 'Markdown'
 
 async def show_stats(query, user_id, lang='en'):
     """Show user statistics"""
-    stats = db.get_user_stats(user_id)
+    stats = await db.get_user_stats(user_id)
     
     text = (
         f"{get_text(lang, 'statistics')}\n"
@@ -696,21 +1078,24 @@ async def show_stats(query, user_id, lang='en'):
     else:
         text += get_text(lang, 'no_tags_yet')
     
-    await query.edit_message_text(
+    await edits.edit(
+        query,
         text,
         parse_mode='Markdown',
         reply_markup=get_back_keyboard(lang)
     )
 
-async def show_random_note(query, user_id, lang='en'):
-    """Show a random note"""
-    note = db.get_random_note(user_id)
+async def show_random_note(query, user_id, context, lang='en'):
+    """Show a random note, avoiding the last few shown"""
+    recent = context.user_data.setdefault('recent_random', deque(maxlen=RANDOM_HISTORY))
+    note = await db.get_random_note(user_id, exclude=tuple(recent))
     
     if not note:
         await query.answer("No notes found!")
         return
     
     note_id, content, tags = note
+    recent.append(note_id)
     tag_text = " ".join([f"#{t}" for t in tags]) if tags else ""
     
     text = (
@@ -727,7 +1112,8 @@ async def show_random_note(query, user_id, lang='en'):
         [InlineKeyboardButton(get_text(lang, 'menu_home'), callback_data="menu_home")]
     ]
     
-    await query.edit_message_text(
+    await edits.edit(
+        query,
         text,
         parse_mode='Markdown',
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -735,7 +1121,8 @@ async def show_random_note(query, user_id, lang='en'):
 
 async def show_help(query, lang='en'):
     """Show help message"""
-    await query.edit_message_text(
+    await edits.edit(
+        query,
         f"{get_text(lang, 'help_title')}\n"
         "━━━━━━━━━━━━━━━━━━━━\n\n"
         f"{get_text(lang, 'help_text')}",
@@ -745,11 +1132,20 @@ async def show_help(query, lang='en'):
 
 async def search_by_tag(query, user_id, tag, lang='en'):
     """Search notes by tag"""
-    notes = db.search_by_tag(user_id, tag)
-    
-    if not notes:
+    rendered = await cached_render(
+        user_id, ('tag', tag), lang, lambda: render_search_by_tag(user_id, tag, lang)
+    )
+    if rendered is None:
         await query.answer(get_text(lang, 'no_notes_tag', tag))
         return
+    await edit_rendered(query, rendered)
+
+async def render_search_by_tag(user_id, tag, lang):
+    """Text and buttons of the notes with a tag, None if there are none"""
+    notes = await db.search_by_tag(user_id, tag)
+    
+    if not notes:
+        return None
     
     text = get_text(lang, 'notes_tagged', tag) + "\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -764,19 +1160,26 @@ async def search_by_tag(query, user_id, tag, lang='en'):
         else:
             text += "\n"
     
-    await query.edit_message_text(
-        text,
-        parse_mode='Markdown',
-        reply_markup=get_back_keyboard(lang)
-    )
+    return text, get_back_keyboard(lang), 'Markdown'
 
 async def search_this_week(query, user_id, lang='en'):
     """Search notes from this week"""
-    notes = db.search_this_week(user_id)
-    
-    if not notes:
+    # The 7-day window moves with the clock, so the hour is part of the key
+    rendered = await cached_render(
+        user_id, ('week', int(time.time()) // 3600), lang,
+        lambda: render_search_this_week(user_id, lang)
+    )
+    if rendered is None:
         await query.answer(get_text(lang, 'no_notes_week'))
         return
+    await edit_rendered(query, rendered)
+
+async def render_search_this_week(user_id, lang):
+    """Text and buttons of the last 7 days' notes, None if there are none"""
+    notes = await db.search_this_week(user_id)
+    
+    if not notes:
+        return None
     
     text = get_text(lang, 'week_notes') + "\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -791,18 +1194,14 @@ async def search_this_week(query, user_id, lang='en'):
         else:
             text += "\n"
     
-    await query.edit_message_text(
-        text,
-        parse_mode='Markdown',
-        reply_markup=get_back_keyboard(lang)
-    )
+    return text, get_back_keyboard(lang), 'Markdown'
 
 # Text handler
 async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text input for search or tagging"""
     user_id = update.effective_user.id
     text = update.message.text
-    lang = get_user_lang(user_id)
+    lang = await get_user_lang(user_id)
     
     if 'awaiting_tags' in context.user_data:
         note_id = context.user_data['awaiting_tags']
@@ -810,9 +1209,9 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         for tag in tags:
             if tag:
-                db.add_tag(note_id, tag)
+                await db.add_tag(note_id, tag, user_id)
         
-        db.log_user_activity(user_id, 'tags_added', f'note_id:{note_id}')
+        await db.log_user_activity(user_id, 'tags_added', f'note_id:{note_id}')
         del context.user_data['awaiting_tags']
         
         await update.message.reply_text(
@@ -822,9 +1221,9 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if context.user_data.get('awaiting_search'):
-        results = db.search_notes(user_id, text)
+        results = await db.search_notes(user_id, text)
         
-        db.log_user_activity(user_id, 'search_performed', f'query:{text}')
+        await db.log_user_activity(user_id, 'search_performed', f'query:{text}')
         
         if not results:
             await update.message.reply_text(
@@ -837,8 +1236,8 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         result_text += "━━━━━━━━━━━━━━━━━━━━\n\n"
         
         for i, note in enumerate(results[:10]):
-            note_id, content, created_at = note
-            display_content = content[:80] + "..." if len(content) > 80 else content
+            note_id, content, created_at, snippet = note
+            display_content = format_snippet(snippet)
             result_text += f"*Note #{note_id}*\n{display_content}\n"
             
             if i < min(len(results), 10) - 1:
@@ -857,14 +1256,48 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await save_message(update, context)
 
-# Main function
-def main():
-    """Start the bot"""
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application):
+    """Start background jobs once the event loop is running"""
+    analytics.start()
+    backups.start()
+
+async def shutdown(application):
+    """Flush buffered activity and release database connections
+    
+    run_polling() stops on SIGINT/SIGTERM and then calls this hook.
+    """
+    await analytics.stop()
+    await backups.stop()
+    db.close()
+
+def build_application(builder=None, send_scheduler=None):
+    """Application with every handler registered
+    
+    benchmark.py passes a builder pointed at a fake Bot API server, and a
+    send_scheduler without Telegram's limits.
+    """
+    builder = builder or Application.builder().token(BOT_TOKEN)
+    send_scheduler = send_scheduler or SendScheduler(
+        global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, group_rate=SEND_GROUP_RATE,
+        chat_burst=SEND_CHAT_BURST
+    )
+    application = (
+        builder
+        .concurrent_updates(PerUserUpdateProcessor(
+            CONCURRENT_UPDATES, coalesce=lambda update: router.coalesces(update.callback_query.data)
+        ))
+        .rate_limiter(send_scheduler)
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+        .build()
+    )
     
     # Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("analytics", analytics_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", import_command))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, 
@@ -875,9 +1308,27 @@ def main():
         filters.VOICE | filters.AUDIO,
         save_message
     ))
-    
-    logger.info("Bot started with multi-language support and analytics!")
-    application.run_polling()
+    return application
+
+# Main function
+def main():
+    """Start the bot with long polling or behind a webhook"""
+    application = build_application()
+    
+    if BOT_MODE == 'webhook':
+        # Tornado server from python-telegram-bot[webhooks]; updates
+        # without the secret token header are rejected with 403
+        logger.info(f"Bot started in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        logger.info("Bot started with multi-language support and analytics!")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional time-to-live
+
+    Holds at most ``maxsize`` entries and, when ``maxbytes`` is set, at most
+    that many bytes as estimated by the callers of set(); the least recently
+    used entry is evicted first. Entries older than ``ttl`` seconds count as
+    misses. Hit, miss and eviction counters are kept for monitoring.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value, or default on a miss"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires, _ = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, nbytes=0):
+        """Store a value of about nbytes, evicting least recently used entries if full"""
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires, nbytes)
+            self.bytes += nbytes
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.bytes > self.maxbytes and len(self._data) > 1
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.bytes -= self._data.pop(key)[2]
+
+    def pop(self, key):
+        """Drop one entry if present"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._remove(key)
+        return entry[0] if entry else None
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Counters for monitoring the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups * 100) if lookups else 0.0,
+            }
@@ -1,174 +1,323 @@
 import sqlite3
-from datetime import datetime, timedelta
+import re
+import os
+import gzip
+import json
+import time
+import threading
+from contextlib import contextmanager
+from migrations import (
+    migrate, check_query_plans, activity_partition_name, create_activity_partition
+)
+from storage import StorageBackend, epoch_now, SNIPPET_START, SNIPPET_END
+from backup import backup_database
+from datetime import datetime, timezone
 import logging
 
 logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self, database_file='notes.db'):
+# Correlated aggregate that loads a note's tags in the same statement as the
+# note itself. Tags never contain the unit separator, so it is a safe delimiter.
+TAGS_COLUMN = "(SELECT group_concat(t.tag, char(31)) FROM tags t WHERE t.note_id = notes.note_id)"
+
+# What user_stats / user_tag_counts should contain, computed from scratch,
+# and what they actually contain. Used to detect and repair drift.
+USER_STATS_TRUTH = """
+    SELECT n.user_id, COUNT(*), SUM(CASE WHEN n.pinned = 1 THEN 1 ELSE 0 END),
+           (SELECT COUNT(DISTINCT t.tag) FROM tags t
+            JOIN notes tn ON tn.note_id = t.note_id WHERE tn.user_id = n.user_id),
+           MIN(n.created_at)
+    FROM notes n
+    GROUP BY n.user_id
+"""
+USER_STATS_STORED = """
+    SELECT user_id, total_notes, pinned_count, unique_tags, first_note_at
+    FROM user_stats
+    WHERE total_notes != 0 OR pinned_count != 0 OR unique_tags != 0
+"""
+TAG_COUNTS_TRUTH = """
+    SELECT n.user_id, t.tag, COUNT(*)
+    FROM tags t
+    JOIN notes n ON n.note_id = t.note_id
+    GROUP BY n.user_id, t.tag
+"""
+TAG_COUNTS_STORED = "SELECT user_id, tag, count FROM user_tag_counts"
+
+# Activity events folded into the daily rollups per transaction
+ROLLUP_BATCH_SIZE = 50000
+
+# Notes read per query when exporting
+EXPORT_CHUNK_SIZE = 500
+
+def activity_month(timestamp):
+    """'YYYYMM' partition key of an epoch activity timestamp"""
+    return time.strftime('%Y%m', time.gmtime(timestamp))
+
+def split_tags(value):
+    """Turn the TAGS_COLUMN aggregate back into a list"""
+    return value.split('\x1f') if value else []
+
+def build_fts_query(user_id, text):
+    """Turn a user's free text into a safe FTS5 MATCH expression
+    
+    Every word is quoted so FTS5 operators in the input are taken
+    literally, and the last word matches as a prefix. The words must
+    match together with the user's owner token, so other users' notes
+    never come back from the index.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = ['"' + word + '"' for word in words]
+    terms[-1] += '*'
+    return f'owner : "u{user_id}" AND content : ({" ".join(terms)})'
+
+class ConnectionPool:
+    """WAL-mode connections for one SQLite file
+    
+    There is a single writer connection, and writer() serializes access to
+    it with a lock. Every thread that reads gets its own read connection
+    from reader(), so readers never wait on each other or on the writer.
+    """
+    
+    WRITER_PRAGMAS = {
+        'busy_timeout': 5000,
+        'synchronous': 'NORMAL',  # Durable enough under WAL, far fewer fsyncs
+        'cache_size': -16000,     # 16 MB
+    }
+    READER_PRAGMAS = {
+        'busy_timeout': 5000,
+        'cache_size': -8000,      # 8 MB per reader
+        'query_only': 'ON',
+    }
+    
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        
+        self._writer = self._open(self.WRITER_PRAGMAS)
+        mode = self._writer.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != 'wal':
+            logger.warning(f"WAL not available for {database_file}, using {mode} journal")
+    
+    def _open(self, pragmas):
+        conn = sqlite3.connect(self.database_file, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+    
+    @contextmanager
+    def writer(self):
+        """Exclusive access to the writer connection
+        
+        Commits when the outermost block exits, rolls back on error.
+        """
+        with self._write_lock:
+            self._write_depth += 1
+            try:
+                yield self._writer
+                if self._write_depth == 1:
+                    self._writer.commit()
+            except Exception:
+                if self._write_depth == 1:
+                    self._writer.rollback()
+                raise
+            finally:
+                self._write_depth -= 1
+    
+    def reader(self):
+        """Read connection owned by the calling thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open(self.READER_PRAGMAS)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+    
+    def backup_source(self):
+        """The writer connection and its lock, as the source of online backups
+        
+        Commits made through the writer while a backup runs are applied to
+        the copy too, where commits from any other connection restart it.
+        Each backup step holds the lock only for its own pages.
+        """
+        return self._writer, self._write_lock
+    
+    def close(self):
+        """Close the writer and every read connection"""
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        with self._write_lock:
+            self._writer.close()
+
+class Database(StorageBackend):
+    """SQLite storage backend"""
+    
+    supports_backup = True
+    supports_archive = True
+    
+    def __init__(self, database_file='notes.db', profile_cache_size=10000,
+                 profile_cache_ttl=600):
+        super().__init__(profile_cache_size, profile_cache_ttl)
         self.database_file = database_file
-        self.conn = None
+        self.pool = None
+        # Months whose activity partition is known to exist (writer only)
+        self._activity_months = set()
         self.connect()
         self.create_tables()
     
     def connect(self):
         """Connect to SQLite database"""
         try:
-            self.conn = sqlite3.connect(self.database_file, check_same_thread=False)
-            self.conn.row_factory = sqlite3.Row
+            self.pool = ConnectionPool(self.database_file)
             logger.info(f"Database connected: {self.database_file}")
         except Exception as e:
             logger.error(f"Database connection failed: {e}")
             raise
     
     def create_tables(self):
-        """Create tables if they don't exist"""
-        cursor = self.conn.cursor()
-        
-        # Users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                language TEXT DEFAULT 'en',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Notes table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS notes (
-                note_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                content TEXT NOT NULL,
-                message_type TEXT DEFAULT 'text',
-                file_id TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                pinned INTEGER DEFAULT 0,
-                source_chat_id INTEGER,
-                source_chat_title TEXT,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        # Tags table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tags (
-                tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                note_id INTEGER,
-                tag TEXT NOT NULL,
-                FOREIGN KEY (note_id) REFERENCES notes(note_id) ON DELETE CASCADE,
-                UNIQUE(note_id, tag)
-            )
-        """)
-        
-        # Activity log table for analytics
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS activity_log (
-                log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action TEXT NOT NULL,
-                details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        # Create indexes
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_notes_user_id ON notes(user_id)
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_notes_created_at ON notes(created_at)
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags(tag)
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_tags_note_id ON tags(note_id)
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_activity_user_id ON activity_log(user_id)
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_activity_timestamp ON activity_log(timestamp)
-        """)
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_activity_action ON activity_log(action)
-        """)
+        """Create the schema or upgrade it to the latest version"""
+        with self.pool.writer() as conn:
+            version = migrate(conn)
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'
+            """)
+            self.fts_enabled = cursor.fetchone() is not None
+        logger.info(f"Database tables created/verified (schema v{version})")
+    
+    def check_query_plans(self):
+        """Hot queries whose plan falls back to a scan or a temp sort"""
+        return check_query_plans(self.pool.reader().cursor())
+    
+    def rebuild_search_index(self):
+        """Backfill the FTS5 index from existing notes"""
+        if not self.fts_enabled:
+            logger.warning("FTS5 not available, nothing to rebuild")
+            return False
         
-        self.conn.commit()
-        logger.info("Database tables created/verified")
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+            cursor.execute("INSERT INTO notes_fts(notes_fts) VALUES ('optimize')")
+        logger.info("Search index rebuilt")
+        return True
     
-    def ensure_user(self, user_id, username, first_name, language='en'):
-        """Create user if doesn't exist"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (user_id, username, first_name, language)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, username, first_name, language))
-        self.conn.commit()
+    def create_user(self, user_id, username, first_name, language='en'):
+        """Insert the user row unless it exists, bypassing the profile cache"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR IGNORE INTO users (user_id, username, first_name, language, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (user_id, username, first_name, language, epoch_now()))
+        # The row may have existed with other values; reload on next access
+        self.profiles.pop(user_id)
     
     def set_user_language(self, user_id, language):
         """Set user's preferred language"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            UPDATE users
-            SET language = ?
-            WHERE user_id = ?
-        """, (language, user_id))
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users
+                SET language = ?
+                WHERE user_id = ?
+            """, (language, user_id))
+            updated = cursor.rowcount
+        self._cache_language(user_id, language, updated)
     
-    def get_user_language(self, user_id):
-        """Get user's preferred language"""
-        cursor = self.conn.cursor()
+    def load_user_profile(self, user_id):
+        """Read user's profile from the database and cache it"""
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT language FROM users WHERE user_id = ?
+            SELECT language, username FROM users WHERE user_id = ?
         """, (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result and result[0] else 'en'
+        return self._cache_profile(user_id, cursor.fetchone())
+    
+    def log_activity_batch(self, events):
+        """Write many (user_id, action, details, timestamp) events in one transaction
+        
+        Each event goes to the partition of its month. A partition is
+        created the first time an event for its month arrives, so the
+        log rolls over to a new table on the first event of every month.
+        """
+        by_month = {}
+        for event in events:
+            by_month.setdefault(activity_month(event[3]), []).append(event)
+        
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            for month, month_events in by_month.items():
+                name = self._activity_partition(cursor, month)
+                cursor.executemany(f"""
+                    INSERT INTO {name} (user_id, action, details, timestamp)
+                    VALUES (?, ?, ?, ?)
+                """, month_events)
     
-    def log_user_activity(self, user_id, action, details=None):
-        """Log user activity for analytics"""
-        cursor = self.conn.cursor()
+    def _activity_partition(self, cursor, month):
+        """Name of the live partition for a month, creating it if needed"""
+        name = activity_partition_name(month)
+        if month not in self._activity_months:
+            cursor.execute("SELECT archive FROM activity_partitions WHERE month = ?", (month,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                # Late events for an archived month start a fresh table;
+                # the next archive run writes them to a second file.
+                cursor.execute("""
+                    UPDATE activity_partitions SET archive = NULL, archived_at = NULL
+                    WHERE month = ?
+                """, (month,))
+            create_activity_partition(cursor, month)
+            self._activity_months.add(month)
+        return name
+    
+    def _live_activity_partitions(self, cursor, since_month=None):
+        """[(month, table name)] of unarchived partitions, oldest first"""
         cursor.execute("""
-            INSERT INTO activity_log (user_id, action, details, timestamp)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        """, (user_id, action, details))
-        self.conn.commit()
+            SELECT month, name FROM activity_partitions
+            WHERE archive IS NULL AND month >= ?
+            ORDER BY month
+        """, (since_month or '',))
+        return cursor.fetchall()
     
     def save_note(self, user_id, content, message_type='text', 
                   file_id=None, source_chat_id=None, source_chat_title=None):
         """Save a new note"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT INTO notes (user_id, content, message_type, file_id, 
-                             source_chat_id, source_chat_title)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, content, message_type, file_id, 
-              source_chat_id, source_chat_title))
-        note_id = cursor.lastrowid
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO notes (user_id, content, message_type, file_id, 
+                                 source_chat_id, source_chat_title, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, content, message_type, file_id, 
+                  source_chat_id, source_chat_title, epoch_now()))
+            note_id = cursor.lastrowid
         logger.info(f"Note {note_id} saved for user {user_id}")
         return note_id
     
-    def add_tag(self, note_id, tag):
-        """Add a tag to a note"""
-        cursor = self.conn.cursor()
+    def add_tag(self, note_id, tag, user_id):
+        """Add a tag to a user's note"""
         try:
-            cursor.execute("""
-                INSERT OR IGNORE INTO tags (note_id, tag)
-                VALUES (?, ?)
-            """, (note_id, tag.lower()))
-            self.conn.commit()
+            with self.pool.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT OR IGNORE INTO tags (note_id, tag)
+                    SELECT note_id, ? FROM notes WHERE note_id = ? AND user_id = ?
+                """, (tag.lower(), note_id, user_id))
         except Exception as e:
             logger.error(f"Error adding tag: {e}")
-            self.conn.rollback()
     
     def get_tags_for_note(self, note_id):
         """Get all tags for a note"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
             SELECT tag FROM tags WHERE note_id = ?
         """, (note_id,))
@@ -176,36 +325,91 @@ class Database:
     
     def get_recent_notes(self, user_id, limit=5, offset=0):
         """Get recent notes with tags, message_type and file_id"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT note_id, content, created_at, pinned, message_type, file_id
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f"""
+            SELECT note_id, content, created_at, pinned, message_type, file_id,
+                   {TAGS_COLUMN}
             FROM notes
             WHERE user_id = ?
-            ORDER BY created_at DESC
+            ORDER BY created_at DESC, note_id DESC
             LIMIT ? OFFSET ?
         """, (user_id, limit, offset))
         
-        notes = []
-        for row in cursor.fetchall():
-            note_id = row[0]
-            tags = self.get_tags_for_note(note_id)
-            notes.append((row[0], row[1], row[2], row[3], row[4], row[5], tags))
+        return self._page_notes(cursor.fetchall())
+    
+    def get_notes_page(self, user_id, limit=5, cursor=None, direction='older'):
+        """Get one page of notes using keyset pagination
+        
+        cursor is the (created_at, note_id) of the last note shown when
+        moving 'older', or of the first note shown when moving 'newer'.
+        Each page is a single index range scan however deep the user goes,
+        and notes saved meanwhile do not shift the pages already visited.
+        
+        Returns (notes, has_older, has_newer) with notes in the same shape
+        as get_recent_notes.
+        """
+        db_cursor = self.pool.reader().cursor()
+        columns = f"note_id, content, created_at, pinned, message_type, file_id, {TAGS_COLUMN}"
+        
+        if cursor is not None and direction == 'newer':
+            db_cursor.execute(f"""
+                SELECT {columns}
+                FROM notes
+                WHERE user_id = ? AND (created_at, note_id) > (?, ?)
+                ORDER BY created_at ASC, note_id ASC
+                LIMIT ?
+            """, (user_id, cursor[0], cursor[1], limit + 1))
+            rows = db_cursor.fetchall()
+            if len(rows) > limit:
+                # The page we came from is still below this one
+                return self._page_notes(rows[:limit][::-1]), True, True
+            # Reached the newest notes: show a full first page instead
+            cursor = None
+        
+        if cursor is None:
+            db_cursor.execute(f"""
+                SELECT {columns}
+                FROM notes
+                WHERE user_id = ?
+                ORDER BY created_at DESC, note_id DESC
+                LIMIT ?
+            """, (user_id, limit + 1))
+        else:
+            db_cursor.execute(f"""
+                SELECT {columns}
+                FROM notes
+                WHERE user_id = ? AND (created_at, note_id) < (?, ?)
+                ORDER BY created_at DESC, note_id DESC
+                LIMIT ?
+            """, (user_id, cursor[0], cursor[1], limit + 1))
+        rows = db_cursor.fetchall()
         
-        return notes
+        if not rows and cursor is not None:
+            # Everything past the cursor was deleted
+            return self.get_notes_page(user_id, limit)
+        return self._page_notes(rows[:limit]), len(rows) > limit, cursor is not None
+    
+    def _page_notes(self, rows):
+        return [
+            (row[0], row[1], row[2], row[3], row[4], row[5], split_tags(row[6]))
+            for row in rows
+        ]
     
     def get_note_count(self, user_id):
         """Get total note count for user"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT COUNT(*) FROM notes WHERE user_id = ?
+            SELECT total_notes FROM user_stats WHERE user_id = ?
         """, (user_id,))
-        return cursor.fetchone()[0]
+        row = cursor.fetchone()
+        return row[0] if row else 0
     
     def get_note(self, note_id, user_id):
         """Get a single note with tags"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT content, created_at, pinned, message_type, file_id
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f"""
+            SELECT content, created_at, pinned, message_type, file_id,
+                   {TAGS_COLUMN}
             FROM notes
             WHERE note_id = ? AND user_id = ?
         """, (note_id, user_id))
@@ -214,33 +418,56 @@ class Database:
         if not row:
             return None
         
-        tags = self.get_tags_for_note(note_id)
-        return (row[0], row[1], row[2], tags, row[3], row[4])
+        return (row[0], row[1], row[2], split_tags(row[5]), row[3], row[4])
     
-    def toggle_pin(self, note_id):
-        """Toggle pin status of a note"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            UPDATE notes
-            SET pinned = CASE WHEN pinned = 1 THEN 0 ELSE 1 END
-            WHERE note_id = ?
-        """, (note_id,))
-        self.conn.commit()
+    def toggle_pin(self, note_id, user_id):
+        """Toggle pin status of a user's note"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE notes
+                SET pinned = CASE WHEN pinned = 1 THEN 0 ELSE 1 END
+                WHERE note_id = ? AND user_id = ?
+            """, (note_id, user_id))
     
-    def delete_note(self, note_id):
-        """Delete a note"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            DELETE FROM notes WHERE note_id = ?
-        """, (note_id,))
-        self.conn.commit()
+    def delete_note(self, note_id, user_id):
+        """Delete a user's note"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM notes WHERE note_id = ? AND user_id = ?
+            """, (note_id, user_id))
         logger.info(f"Note {note_id} deleted")
     
-    def search_notes(self, user_id, query):
-        """Search notes by content"""
-        cursor = self.conn.cursor()
+    def search_notes(self, user_id, query, mode='fts'):
+        """Search notes by content
+        
+        Returns (note_id, content, created_at, snippet) rows. In 'fts' mode
+        the words must match together with the user's owner token, results
+        are BM25-ranked on the note text and the snippet has the matches
+        between SNIPPET_START and SNIPPET_END; 'substring' mode keeps the
+        plain LIKE semantics and returns the whole note as the snippet.
+        """
+        match = build_fts_query(user_id, query)
+        if mode == 'fts' and self.fts_enabled and match:
+            cursor = self.pool.reader().cursor()
+            try:
+                cursor.execute("""
+                    SELECT n.note_id, n.content, n.created_at,
+                           snippet(notes_fts, 0, ?, ?, '...', 12)
+                    FROM notes_fts
+                    JOIN notes n ON n.note_id = notes_fts.rowid
+                    WHERE notes_fts MATCH ? AND n.user_id = ?
+                    ORDER BY bm25(notes_fts, 1.0, 0.0)
+                    LIMIT 20
+                """, (SNIPPET_START, SNIPPET_END, match, user_id))
+                return cursor.fetchall()
+            except sqlite3.OperationalError as e:
+                logger.warning(f"FTS search failed, falling back to substring: {e}")
+        
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT note_id, content, created_at
+            SELECT note_id, content, created_at, content
             FROM notes
             WHERE user_id = ? AND content LIKE ?
             ORDER BY created_at DESC
@@ -250,9 +477,9 @@ class Database:
     
     def search_by_tag(self, user_id, tag):
         """Search notes by tag"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT DISTINCT n.note_id, n.content, n.created_at
+            SELECT n.note_id, n.content, n.created_at
             FROM notes n
             JOIN tags t ON n.note_id = t.note_id
             WHERE n.user_id = ? AND t.tag = ?
@@ -263,62 +490,80 @@ class Database:
     
     def search_this_week(self, user_id):
         """Get notes from this week"""
-        cursor = self.conn.cursor()
-        week_ago = (datetime.now() - timedelta(days=7)).isoformat()
+        cursor = self.pool.reader().cursor()
+        now = epoch_now()
         cursor.execute("""
             SELECT note_id, content, created_at
             FROM notes
-            WHERE user_id = ? AND created_at >= ?
+            WHERE user_id = ? AND created_at >= ? AND created_at < ?
             ORDER BY created_at DESC
-        """, (user_id, week_ago))
+        """, (user_id, now - 7 * 86400, now + 1))
         return cursor.fetchall()
     
     def get_pinned_notes(self, user_id):
         """Get all pinned notes"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT note_id, content, created_at
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f"""
+            SELECT note_id, content, created_at, {TAGS_COLUMN}
             FROM notes
             WHERE user_id = ? AND pinned = 1
             ORDER BY created_at DESC
         """, (user_id,))
         
-        notes = []
-        for row in cursor.fetchall():
-            note_id = row[0]
-            tags = self.get_tags_for_note(note_id)
-            notes.append((row[0], row[1], row[2], tags))
-        
-        return notes
+        return [
+            (row[0], row[1], row[2], split_tags(row[3]))
+            for row in cursor.fetchall()
+        ]
     
-    def get_random_note(self, user_id):
-        """Get a random note"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT note_id, content
-            FROM notes
-            WHERE user_id = ?
-            ORDER BY RANDOM()
-            LIMIT 1
-        """, (user_id,))
+    def get_random_note(self, user_id, exclude=()):
+        """Get a random note
         
+        Picks uniformly among the user's notes that are not in exclude
+        (e.g. the last few shown), or among all of them when exclude
+        covers every note. The user's notes are numbered 1..n by seq
+        without gaps. With the e excluded notes' seqs sorted, a uniform
+        k in 1..n-e is stepped past the j excluded seqs that come before
+        the k-th allowed one, where s_j - j < k. That is one statement of
+        index lookups, however many notes there are.
+        """
+        exclude = list(exclude)
+        placeholders = ', '.join('?' * len(exclude))
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f"""
+            WITH excluded(seq, rank) AS (
+                SELECT seq, ROW_NUMBER() OVER (ORDER BY seq)
+                FROM notes
+                WHERE note_id IN ({placeholders}) AND +user_id = ?
+            ),
+            counts(total, skipped) AS (
+                SELECT total, CASE WHEN skipped < total THEN skipped ELSE 0 END
+                FROM (SELECT (SELECT MAX(seq) FROM notes WHERE user_id = ?) AS total,
+                             (SELECT COUNT(*) FROM excluded) AS skipped)
+            ),
+            pick(k) AS MATERIALIZED (
+                SELECT 1 + (random() & 9223372036854775807) % (total - skipped)
+                FROM counts
+            )
+            SELECT note_id, content, {TAGS_COLUMN}
+            FROM pick, counts
+            JOIN notes ON notes.user_id = ? AND notes.seq = pick.k + (
+                SELECT COUNT(*) FROM excluded
+                WHERE counts.skipped > 0 AND excluded.seq - excluded.rank < pick.k
+            )
+        """, (*exclude, user_id, user_id, user_id))
         row = cursor.fetchone()
         if not row:
             return None
         
-        note_id = row[0]
-        tags = self.get_tags_for_note(note_id)
-        return (row[0], row[1], tags)
+        return (row[0], row[1], split_tags(row[2]))
     
     def get_popular_tags(self, user_id, limit=6):
         """Get most used tags"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT t.tag, COUNT(*) as count
-            FROM tags t
-            JOIN notes n ON t.note_id = n.note_id
-            WHERE n.user_id = ?
-            GROUP BY t.tag
+            SELECT tag
+            FROM user_tag_counts
+            WHERE user_id = ?
             ORDER BY count DESC
             LIMIT ?
         """, (user_id, limit))
@@ -326,38 +571,20 @@ class Database:
     
     def get_user_stats(self, user_id):
         """Get user statistics"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         
-        # Total notes
+        # Counters kept up to date by triggers
         cursor.execute("""
-            SELECT COUNT(*) FROM notes WHERE user_id = ?
-        """, (user_id,))
-        total_notes = cursor.fetchone()[0]
-        
-        # Pinned count
-        cursor.execute("""
-            SELECT COUNT(*) FROM notes 
-            WHERE user_id = ? AND pinned = 1
-        """, (user_id,))
-        pinned_count = cursor.fetchone()[0]
-        
-        # Unique tags
-        cursor.execute("""
-            SELECT COUNT(DISTINCT t.tag)
-            FROM tags t
-            JOIN notes n ON t.note_id = n.note_id
-            WHERE n.user_id = ?
+            SELECT total_notes, pinned_count, unique_tags, first_note_at
+            FROM user_stats
+            WHERE user_id = ?
         """, (user_id,))
-        unique_tags = cursor.fetchone()[0]
+        row = cursor.fetchone()
+        total_notes, pinned_count, unique_tags, first_note = row if row else (0, 0, 0, None)
         
-        # First note date
-        cursor.execute("""
-            SELECT MIN(created_at) FROM notes WHERE user_id = ?
-        """, (user_id,))
-        first_note = cursor.fetchone()[0]
         if first_note:
             try:
-                first_note_date = datetime.fromisoformat(first_note).strftime('%B %d, %Y')
+                first_note_date = datetime.fromtimestamp(first_note, timezone.utc).strftime('%B %d, %Y')
             except:
                 first_note_date = 'N/A'
         else:
@@ -365,11 +592,9 @@ class Database:
         
         # Top tags
         cursor.execute("""
-            SELECT t.tag, COUNT(*) as count
-            FROM tags t
-            JOIN notes n ON t.note_id = n.note_id
-            WHERE n.user_id = ?
-            GROUP BY t.tag
+            SELECT tag, count
+            FROM user_tag_counts
+            WHERE user_id = ?
             ORDER BY count DESC
             LIMIT 5
         """, (user_id,))
@@ -383,33 +608,156 @@ class Database:
             'top_tags': top_tags
         }
     
+    # Export and import
+    def iter_notes_export(self, user_id, chunk_size=EXPORT_CHUNK_SIZE):
+        """Yield all of a user's notes, oldest first
+        
+        Rows are (note_id, content, message_type, file_id, created_at,
+        pinned, source_chat_id, source_chat_title, tags). Notes are read
+        chunk_size at a time by keyset on (created_at, note_id), each chunk
+        a short query of its own, so memory stays flat for any number of
+        notes and no read transaction stays open while the caller writes.
+        """
+        cursor = self.pool.reader().cursor()
+        after = (-1, -1)
+        while True:
+            cursor.execute(f"""
+                SELECT note_id, content, message_type, file_id, created_at, pinned,
+                       source_chat_id, source_chat_title, {TAGS_COLUMN}
+                FROM notes
+                WHERE user_id = ? AND (created_at, note_id) > (?, ?)
+                ORDER BY created_at ASC, note_id ASC
+                LIMIT ?
+            """, (user_id, after[0], after[1], chunk_size))
+            rows = cursor.fetchall()
+            for row in rows:
+                yield tuple(row[:8]) + (split_tags(row[8]),)
+            if len(rows) < chunk_size:
+                return
+            after = (rows[-1][4], rows[-1][0])
+    
+    def start_import_job(self, user_id, source):
+        """(job_id, rows_done, finished) for importing source, resuming a previous run"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT job_id, rows_done, status FROM import_jobs
+                WHERE user_id = ? AND source = ?
+            """, (user_id, source))
+            row = cursor.fetchone()
+            if row:
+                return row[0], row[1], row[2] == 'done'
+            now = epoch_now()
+            cursor.execute("""
+                INSERT INTO import_jobs (user_id, source, created_at, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, source, now, now))
+            return cursor.lastrowid, 0, False
+    
+    def import_notes_batch(self, job_id, user_id, notes, rows_done):
+        """Insert a batch of notes and record the job's progress in one transaction"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO notes (user_id, content, message_type, file_id, created_at,
+                                   pinned, source_chat_id, source_chat_title)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(user_id, *note[:7]) for note in notes])
+            # AUTOINCREMENT hands out ids in order and the writer is held,
+            # so this batch got the last len(notes) ids
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'notes'")
+            first_id = cursor.fetchone()[0] - len(notes) + 1
+            cursor.executemany("""
+                INSERT OR IGNORE INTO tags (note_id, tag) VALUES (?, ?)
+            """, [(first_id + i, tag.lower()) for i, note in enumerate(notes) for tag in note[7]])
+            cursor.execute("""
+                UPDATE import_jobs SET rows_done = ?, updated_at = ? WHERE job_id = ?
+            """, (rows_done, epoch_now(), job_id))
+    
+    def finish_import_job(self, job_id, user_id):
+        """Mark an import as complete"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE import_jobs SET status = 'done', updated_at = ? WHERE job_id = ?
+            """, (epoch_now(), job_id))
+    
+    def verify_user_stats(self, repair=False):
+        """Compare the stats tables against the notes and tags they summarize
+        
+        Returns the ids of users whose counters have drifted. With
+        repair=True their rows are recomputed from scratch.
+        """
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f"""
+            SELECT user_id FROM ({USER_STATS_TRUTH} EXCEPT {USER_STATS_STORED})
+            UNION
+            SELECT user_id FROM ({USER_STATS_STORED} EXCEPT {USER_STATS_TRUTH})
+            UNION
+            SELECT user_id FROM ({TAG_COUNTS_TRUTH} EXCEPT {TAG_COUNTS_STORED})
+            UNION
+            SELECT user_id FROM ({TAG_COUNTS_STORED} EXCEPT {TAG_COUNTS_TRUTH})
+        """)
+        drifted = [row[0] for row in cursor.fetchall()]
+        
+        if drifted and repair:
+            with self.pool.writer() as conn:
+                cursor = conn.cursor()
+                for user_id in drifted:
+                    self._rebuild_user_stats(cursor, user_id)
+            logger.info(f"Repaired stats for {len(drifted)} users")
+        return drifted
+    
+    def _rebuild_user_stats(self, cursor, user_id):
+        cursor.execute("DELETE FROM user_stats WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM user_tag_counts WHERE user_id = ?", (user_id,))
+        cursor.execute(f"""
+            INSERT INTO user_tag_counts (user_id, tag, count)
+            SELECT * FROM ({TAG_COUNTS_TRUTH}) WHERE user_id = ?
+        """, (user_id,))
+        cursor.execute(f"""
+            INSERT INTO user_stats (user_id, total_notes, pinned_count, unique_tags, first_note_at)
+            SELECT * FROM ({USER_STATS_TRUTH}) WHERE user_id = ?
+        """, (user_id,))
+    
     # Analytics methods
     def get_total_users(self):
         """Get total number of users"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("SELECT COUNT(*) FROM users")
         return cursor.fetchone()[0]
     
     def get_active_users(self, days=7):
-        """Get active users in last N days"""
-        cursor = self.conn.cursor()
-        date_threshold = (datetime.now() - timedelta(days=days)).isoformat()
-        cursor.execute("""
-            SELECT COUNT(DISTINCT user_id) 
-            FROM activity_log 
-            WHERE timestamp >= ?
-        """, (date_threshold,))
+        """Get active users in last N days
+        
+        Only the monthly partitions that overlap the window are read.
+        Archived months are not counted.
+        """
+        cursor = self.pool.reader().cursor()
+        now = epoch_now()
+        since = now - days * 86400
+        partitions = self._live_activity_partitions(cursor, activity_month(since))
+        if not partitions:
+            return 0
+        
+        union = " UNION ALL ".join(
+            f"SELECT user_id FROM {name} WHERE timestamp >= ? AND timestamp < ?"
+            for _, name in partitions
+        )
+        cursor.execute(f"""
+            SELECT COUNT(DISTINCT user_id) FROM ({union})
+        """, (since, now + 1) * len(partitions))
         return cursor.fetchone()[0]
     
     def get_total_notes_all_users(self):
         """Get total notes across all users"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("SELECT COUNT(*) FROM notes")
         return cursor.fetchone()[0]
     
     def get_notes_by_type_stats(self):
         """Get note count by message type"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
             SELECT message_type, COUNT(*) as count
             FROM notes
@@ -420,20 +768,20 @@ class Database:
     
     def get_top_users(self, limit=10):
         """Get users with most notes"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT u.user_id, u.first_name, u.username, COUNT(n.note_id) as note_count
-            FROM users u
-            LEFT JOIN notes n ON u.user_id = n.user_id
-            GROUP BY u.user_id
-            ORDER BY note_count DESC
+            SELECT u.user_id, u.first_name, u.username, s.total_notes as note_count
+            FROM user_stats s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.total_notes > 0
+            ORDER BY s.total_notes DESC
             LIMIT ?
         """, (limit,))
         return cursor.fetchall()
     
     def get_language_distribution(self):
         """Get user count by language"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
             SELECT language, COUNT(*) as count
             FROM users
@@ -444,7 +792,7 @@ class Database:
     
     def get_popular_tags_global(self, limit=20):
         """Get most popular tags across all users"""
-        cursor = self.conn.cursor()
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
             SELECT tag, COUNT(*) as count
             FROM tags
@@ -454,26 +802,296 @@ class Database:
         """, (limit,))
         return cursor.fetchall()
     
-    def get_new_users_today(self):
-        """Get number of new users today"""
-        cursor = self.conn.cursor()
+    def compute_analytics_snapshot(self):
+        """Every /analytics dashboard figure, read in one consistent transaction"""
+        conn = self.pool.reader()
+        conn.execute("BEGIN")
+        try:
+            return {
+                'generated_at': epoch_now(),
+                'total_users': self.get_total_users(),
+                'active_7d': self.get_active_users(7),
+                'active_30d': self.get_active_users(30),
+                'total_notes': self.get_total_notes_all_users(),
+                'new_users_today': self.get_new_users_today(),
+                'notes_today': self.get_notes_created_today(),
+                'languages': self.get_language_distribution(),
+                'note_types': self.get_notes_by_type_stats(),
+                'top_users': [tuple(row) for row in self.get_top_users(5)],
+                'popular_tags': [tuple(row) for row in self.get_popular_tags_global(10)],
+            }
+        finally:
+            conn.commit()
+    
+    def save_analytics_snapshot(self, snapshot):
+        """Store a snapshot as the latest one, dropping older ones"""
+        with self.pool.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO analytics_snapshots (generated_at, data) VALUES (?, ?)
+            """, (snapshot['generated_at'], json.dumps(snapshot, ensure_ascii=False)))
+            cursor.execute("DELETE FROM analytics_snapshots WHERE snapshot_id < ?", (cursor.lastrowid,))
+    
+    def get_analytics_snapshot(self):
+        """The latest stored snapshot, or None"""
+        cursor = self.pool.reader().cursor()
         cursor.execute("""
-            SELECT COUNT(*) FROM users 
-            WHERE DATE(created_at) = DATE('now')
+            SELECT data FROM analytics_snapshots ORDER BY snapshot_id DESC LIMIT 1
         """)
-        return cursor.fetchone()[0]
+        row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def get_new_users_today(self):
+        """Get number of new users today"""
+        return self._daily_count('new_users')
     
     def get_notes_created_today(self):
         """Get number of notes created today"""
-        cursor = self.conn.cursor()
+        return self._daily_count('notes_created')
+    
+    def _daily_count(self, column):
+        cursor = self.pool.reader().cursor()
+        cursor.execute(f"SELECT {column} FROM daily_stats WHERE day = DATE('now')")
+        result = cursor.fetchone()
+        return result[0] if result else 0
+    
+    def get_user_growth_stats(self, days=30):
+        """Get (day, new users) for the last N days"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""
+            SELECT day, new_users
+            FROM daily_stats
+            WHERE day >= DATE('now', ?) AND new_users > 0
+            ORDER BY day
+        """, (f'-{days} days',))
+        return cursor.fetchall()
+    
+    def get_daily_notes_stats(self, days=30):
+        """Get (day, notes created) for the last N days"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""
+            SELECT day, notes_created
+            FROM daily_stats
+            WHERE day >= DATE('now', ?) AND notes_created > 0
+            ORDER BY day
+        """, (f'-{days} days',))
+        return cursor.fetchall()
+    
+    def get_daily_notes_by_type(self, days=30):
+        """Get {day: {message_type: notes created}} for the last N days"""
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""
+            SELECT day, message_type, count
+            FROM daily_notes_by_type
+            WHERE day >= DATE('now', ?)
+            ORDER BY day
+        """, (f'-{days} days',))
+        result = {}
+        for day, message_type, count in cursor.fetchall():
+            result.setdefault(day, {})[message_type] = count
+        return result
+    
+    def get_retention_stats(self):
+        """Users seen on more than one day, out of all users with activity
+        
+        Reads the per-user rollup, so call refresh_rollups() first for
+        up-to-date numbers.
+        """
+        cursor = self.pool.reader().cursor()
+        cursor.execute("""
+            SELECT COUNT(*), SUM(CASE WHEN active_days > 1 THEN 1 ELSE 0 END)
+            FROM user_activity
+        """)
+        active, returning = cursor.fetchone()
+        returning = returning or 0
+        return {
+            'active_users': active,
+            'returning_users': returning,
+            'retention_rate': round(returning / active * 100, 1) if active else 0.0,
+        }
+    
+    def refresh_rollups(self, batch_size=ROLLUP_BATCH_SIZE):
+        """Fold activity logged since the last run into the daily rollups
+        
+        Every live partition has its own watermark. Events are read by
+        log_id from the watermark onwards, one batch per transaction, and
+        the watermark moves in the same transaction, so an interrupted run
+        resumes where it stopped and no event is counted twice. Returns
+        the number of events processed.
+        """
+        processed = 0
+        for _, name in self._live_activity_partitions(self.pool.reader().cursor()):
+            while True:
+                with self.pool.writer() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT last_id FROM rollup_watermarks WHERE source = ?", (name,))
+                    last_id = cursor.fetchone()[0]
+                    cursor.execute(f"SELECT MAX(log_id) FROM {name}")
+                    max_id = cursor.fetchone()[0] or 0
+                    if max_id <= last_id:
+                        break
+                    upper = min(max_id, last_id + batch_size)
+                    processed += self._rollup_activity(cursor, name, last_id, upper)
+                    cursor.execute("""
+                        UPDATE rollup_watermarks SET last_id = ? WHERE source = ?
+                    """, (upper, name))
+        
+        if processed:
+            logger.info(f"Rolled up {processed} activity events")
+        return processed
+    
+    def _rollup_activity(self, cursor, partition, after_id, upper_id):
+        """Add partition rows with after_id < log_id <= upper_id to the rollups"""
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS rollup_batch (
+                day TEXT, user_id INTEGER, action TEXT, count INTEGER
+            )
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS rollup_new_active (
+                day TEXT, user_id INTEGER
+            )
+        """)
+        cursor.execute("DELETE FROM rollup_batch")
+        cursor.execute("DELETE FROM rollup_new_active")
+        
+        cursor.execute(f"""
+            INSERT INTO rollup_batch (day, user_id, action, count)
+            SELECT DATE(timestamp, 'unixepoch') AS day, user_id, action, COUNT(*)
+            FROM {partition}
+            WHERE log_id > ? AND log_id <= ? AND timestamp IS NOT NULL
+            GROUP BY day, user_id, action
+        """, (after_id, upper_id))
+        
+        cursor.execute("""
+            INSERT INTO daily_actions (day, action, count)
+            SELECT day, action, SUM(count) FROM rollup_batch
+            GROUP BY day, action
+            ON CONFLICT(day, action) DO UPDATE SET count = count + excluded.count
+        """)
+        cursor.execute("""
+            INSERT INTO daily_stats (day, actions)
+            SELECT day, SUM(count) FROM rollup_batch
+            GROUP BY day
+            ON CONFLICT(day) DO UPDATE SET actions = actions + excluded.actions
+        """)
+        
+        # (day, user) pairs not seen in earlier batches
+        cursor.execute("""
+            INSERT INTO rollup_new_active (day, user_id)
+            SELECT DISTINCT b.day, b.user_id FROM rollup_batch b
+            WHERE b.user_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM daily_active_users d
+                WHERE d.day = b.day AND d.user_id = b.user_id
+            )
+        """)
+        cursor.execute("INSERT INTO daily_active_users (day, user_id) SELECT day, user_id FROM rollup_new_active")
         cursor.execute("""
-            SELECT COUNT(*) FROM notes 
-            WHERE DATE(created_at) = DATE('now')
+            INSERT INTO daily_stats (day, active_users)
+            SELECT day, COUNT(*) FROM rollup_new_active
+            GROUP BY day
+            ON CONFLICT(day) DO UPDATE SET active_users = active_users + excluded.active_users
         """)
+        cursor.execute("""
+            INSERT INTO user_activity (user_id, first_day, last_day, active_days)
+            SELECT user_id, MIN(day), MAX(day), COUNT(*) FROM rollup_new_active
+            GROUP BY user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                first_day = MIN(first_day, excluded.first_day),
+                last_day = MAX(last_day, excluded.last_day),
+                active_days = active_days + excluded.active_days
+        """)
+        
+        cursor.execute("SELECT COALESCE(SUM(count), 0) FROM rollup_batch")
         return cursor.fetchone()[0]
     
+    def archive_activity(self, archive_dir, keep_months=3):
+        """Move old activity partitions into gzip archives and drop them
+        
+        Partitions more than keep_months months older than the current one
+        are written to archive_dir as JSON lines, one file per month. The
+        rollups are refreshed first, so archived events stay counted in
+        the analytics. A partition is only dropped once its file is safely
+        on disk and no event arrived while it was written. Returns
+        [(month, rows, path)] for the archived partitions.
+        """
+        if keep_months < 1:
+            raise ValueError("keep_months must be at least 1")
+        
+        self.refresh_rollups()
+        now = time.gmtime()
+        year, month = divmod(now.tm_year * 12 + now.tm_mon - 1 - keep_months, 12)
+        cutoff = f"{year:04d}{month + 1:02d}"
+        
+        os.makedirs(archive_dir, exist_ok=True)
+        cursor = self.pool.reader().cursor()
+        archived = []
+        for month, name in self._live_activity_partitions(cursor):
+            if month >= cutoff:
+                break
+            path, rows, max_id = self._write_activity_archive(cursor, archive_dir, month, name)
+            
+            with self.pool.writer() as conn:
+                cursor_w = conn.cursor()
+                cursor_w.execute(f"SELECT COUNT(*), COALESCE(MAX(log_id), 0) FROM {name}")
+                current = tuple(cursor_w.fetchone())
+                cursor_w.execute("SELECT last_id FROM rollup_watermarks WHERE source = ?", (name,))
+                watermark = cursor_w.fetchone()[0]
+                if current != (rows, max_id) or watermark < max_id:
+                    logger.warning(f"Activity for {month} changed while archiving, keeping {name}")
+                    os.remove(path)
+                    continue
+                cursor_w.execute("""
+                    UPDATE activity_partitions SET archive = ?, archived_at = ?
+                    WHERE month = ?
+                """, (path, epoch_now(), month))
+                cursor_w.execute("DELETE FROM rollup_watermarks WHERE source = ?", (name,))
+                cursor_w.execute(f"DROP TABLE {name}")
+                self._activity_months.discard(month)
+            
+            logger.info(f"Archived {rows} activity events for {month} to {path}")
+            archived.append((month, rows, path))
+        return archived
+    
+    def _write_activity_archive(self, cursor, archive_dir, month, name):
+        """Stream one partition into a new gzip JSON lines file"""
+        path = os.path.join(archive_dir, f"activity_{month}.jsonl.gz")
+        part = 1
+        while os.path.exists(path):
+            part += 1
+            path = os.path.join(archive_dir, f"activity_{month}_{part}.jsonl.gz")
+        
+        rows = 0
+        max_id = 0
+        tmp_path = path + '.tmp'
+        cursor.execute(f"""
+            SELECT log_id, user_id, action, details, timestamp FROM {name} ORDER BY log_id
+        """)
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as out:
+                for row in cursor:
+                    out.write((json.dumps(dict(row), ensure_ascii=False) + '\n').encode('utf-8'))
+                    rows += 1
+                    max_id = row['log_id']
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+        return path, rows, max_id
+    
+    def backup(self, backup_dir, compress=True, keep=7):
+        """Online backup with the SQLite backup API; see backup.backup_database"""
+        connection, lock = self.pool.backup_source()
+        return [backup_database(self.database_file, backup_dir, compress, keep,
+                                connection=connection, lock=lock)]
+    
+    def vacuum(self):
+        """Rebuild the database file to return space freed by dropped tables"""
+        with self.pool.writer() as conn:
+            conn.execute("VACUUM")
+        logger.info("Database vacuumed")
+    
     def close(self):
         """Close database connection"""
-        if self.conn:
-            self.conn.close()
+        if self.pool:
+            self.pool.close()
             logger.info("Database connection closed")
\ No newline at end of file
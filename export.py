@@ -0,0 +1,112 @@
+import csv
+import json
+from datetime import datetime, timezone
+from storage import epoch_now
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+
+# One column per field; tags are space separated in CSV (tags never contain spaces)
+EXPORT_FIELDS = [
+    'content', 'message_type', 'file_id', 'created_at', 'pinned',
+    'source_chat_id', 'source_chat_title', 'tags',
+]
+
+def format_timestamp(created_at):
+    """Epoch seconds as ISO 8601 UTC, e.g. 2024-01-31T09:30:00Z"""
+    if created_at is None:
+        return None
+    return datetime.fromtimestamp(created_at, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def parse_timestamp(value):
+    """Epoch seconds from an ISO 8601 string or a number; now if empty"""
+    if value in (None, ''):
+        return epoch_now()
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+def export_record(row):
+    """Dict of EXPORT_FIELDS for one iter_notes_export() row"""
+    (_, content, message_type, file_id, created_at, pinned,
+     source_chat_id, source_chat_title, tags) = row
+    return {
+        'content': content,
+        'message_type': message_type,
+        'file_id': file_id,
+        'created_at': format_timestamp(created_at),
+        'pinned': bool(pinned),
+        'source_chat_id': source_chat_id,
+        'source_chat_title': source_chat_title,
+        'tags': list(tags),
+    }
+
+def write_export(rows, path, fmt='jsonl'):
+    """Write notes to path one row at a time; returns the number written"""
+    count = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for row in rows:
+            record = export_record(row)
+            if fmt == 'csv':
+                record['pinned'] = int(record['pinned'])
+                record['tags'] = ' '.join(record['tags'])
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+def import_format(filename):
+    """'jsonl' or 'csv' from a file name, or None if unsupported"""
+    extension = (filename or '').rsplit('.', 1)[-1].lower()
+    if extension in ('jsonl', 'json', 'ndjson'):
+        return 'jsonl'
+    if extension == 'csv':
+        return 'csv'
+    return None
+
+def import_note(record):
+    """Note tuple for StorageBackend.import_notes() from an exported record"""
+    content = record.get('content')
+    if not content:
+        raise ValueError("note without content")
+    tags = record.get('tags') or []
+    if isinstance(tags, str):
+        tags = tags.split()
+    pinned = record.get('pinned')
+    if isinstance(pinned, str):
+        pinned = pinned.strip().lower() in ('1', 'true', 'yes')
+    source_chat_id = record.get('source_chat_id')
+    return (
+        content,
+        record.get('message_type') or 'text',
+        record.get('file_id') or None,
+        parse_timestamp(record.get('created_at')),
+        1 if pinned else 0,
+        int(source_chat_id) if source_chat_id not in (None, '') else None,
+        record.get('source_chat_title') or None,
+        [tag.lstrip('#').lower() for tag in tags if tag.lstrip('#')],
+    )
+
+def read_import(path, fmt='jsonl'):
+    """Yield note tuples from an export file, one line at a time
+
+    Raises ValueError naming the first malformed record.
+    """
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        records = csv.DictReader(f) if fmt == 'csv' else f
+        for number, record in enumerate(records, start=1):
+            try:
+                if fmt != 'csv':
+                    if not record.strip():
+                        continue
+                    record = json.loads(record)
+                note = import_note(record)
+            except (ValueError, TypeError, AttributeError) as e:
+                raise ValueError(f"record {number}: {e}") from e
+            yield note
@@ -1,3 +1,8 @@
+import logging
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+
 # Language translations
 LANGUAGES = {
     'en': {
@@ -72,6 +77,19 @@ LANGUAGES = {
         # Settings
         'settings_title': '⚙️ *Settings*',
         'change_language': '🌐 Change Language',
+        
+        # Export and import
+        'export_started': '📦 Preparing your export...',
+        'export_done': '✅ Exported {} notes',
+        'export_usage': 'Usage: /export for JSON Lines, /export csv for a spreadsheet',
+        'import_prompt': '📥 Send a .jsonl or .csv file made by /export.\n\nIf an import gets interrupted, send the same file again to continue where it stopped.',
+        'import_bad_file': '⚠️ Please send a .jsonl or .csv file',
+        'import_started': '📥 Importing...',
+        'import_progress': '📥 Imported {} notes so far...',
+        'import_done': '✅ Imported {} notes',
+        'import_resumed': '✅ Imported {} more notes, continuing after the first {}',
+        'import_already_done': '✅ This file was already imported',
+        'import_failed': '❌ Import stopped at {}\n\nNotes before it were saved.',
     },
     
     'es': {
@@ -400,18 +418,46 @@ LANGUAGES = {
     }
 }
 
+def placeholder_count(text):
+    """Number of {} fields in a format template, None if it does not parse"""
+    try:
+        return sum(1 for _, field, _, _ in Formatter().parse(text) if field is not None)
+    except ValueError:
+        return None
+
+def compile_catalogs(languages):
+    """Flat {lang: {key: (text, fields)}} tables built once at import
+    
+    Each language gets every English key, its own text where translated.
+    fields is the number of placeholders, 0 when the text is returned as
+    is. A translation whose placeholders differ from the English template
+    is replaced by the English one, so get_text never formats a broken
+    template at runtime.
+    """
+    english = {key: (text, placeholder_count(text) or 0) for key, text in languages['en'].items()}
+    catalogs = {}
+    for code, texts in languages.items():
+        catalog = dict(english)
+        for key, text in texts.items():
+            fields = placeholder_count(text)
+            if key in english and fields != english[key][1] and english[key][1]:
+                logger.warning(f"Placeholders of {code}.{key} differ from English, using English")
+                continue
+            catalog[key] = (text, fields or 0)
+        catalogs[code] = catalog
+    return catalogs
+
+CATALOGS = compile_catalogs(LANGUAGES)
+
 def get_text(lang, key, *args):
     """Get translated text for a language"""
-    if lang not in LANGUAGES:
-        lang = 'en'  # Default to English
-    
-    text = LANGUAGES[lang].get(key, LANGUAGES['en'].get(key, key))
+    text, fields = CATALOGS.get(lang, CATALOGS['en']).get(key, (key, 0))
     
-    # Format with arguments if provided
-    if args:
+    # Format with arguments if the template takes any
+    if args and fields:
         try:
             return text.format(*args)
-        except:
+        except (IndexError, KeyError, ValueError):
             return text
     
     return text
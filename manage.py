@@ -0,0 +1,166 @@
+import argparse
+import logging
+from storage import open_storage
+from backup import restore_backup
+from config import (
+    DATABASE_FILE, DATABASE_URL, DATABASE_SHARDS, ACTIVITY_KEEP_MONTHS, ACTIVITY_ARCHIVE_DIR,
+    BACKUP_DIR, BACKUP_KEEP, BACKUP_COMPRESS
+)
+
+logging.basicConfig(level=logging.INFO)
+
+def rebuild_search_index(db, args):
+    """Backfill the full-text search index from existing notes"""
+    if db.rebuild_search_index():
+        print("✅ Search index rebuilt")
+    else:
+        print("⚠️ FTS5 is not available in this SQLite build")
+
+def check_plans(db, args):
+    """Verify that hot queries use indexes"""
+    problems = db.check_query_plans()
+    if not problems:
+        print("✅ All hot queries use indexes")
+        return
+    for name, steps in problems.items():
+        print(f"❌ {name}: {'; '.join(steps)}")
+    raise SystemExit(1)
+
+def verify_stats(db, args):
+    """Detect (and optionally repair) drift in the materialized user stats"""
+    drifted = db.verify_user_stats(repair=args.repair)
+    if not drifted:
+        print("✅ User stats match the notes and tags tables")
+        return
+    action = "Repaired" if args.repair else "Drift found for"
+    print(f"{'🔧' if args.repair else '❌'} {action} {len(drifted)} users: {drifted[:20]}")
+    if not args.repair:
+        raise SystemExit(1)
+
+def refresh_rollups(db, args):
+    """Fold new activity into the daily analytics rollups"""
+    processed = db.refresh_rollups()
+    print(f"✅ Rolled up {processed} new activity events")
+
+def archive_activity(db, args):
+    """Archive and drop old monthly activity partitions"""
+    if not db.supports_archive:
+        print(f"✅ {type(db).__name__} does not archive activity, nothing to do")
+        return
+    archived = db.archive_activity(args.archive_dir, args.keep_months)
+    for month, rows, path in archived:
+        print(f"📦 {month}: {rows} events -> {path}")
+    if not archived:
+        print("✅ Nothing to archive")
+    elif args.vacuum:
+        db.vacuum()
+        print("✅ Database vacuumed")
+
+def rebalance_shards(db, args):
+    """Move users to the shard their user_id maps to"""
+    if not hasattr(db, 'rebalance'):
+        print("✅ Storage is not sharded, nothing to rebalance")
+        return
+    moved = db.rebalance(dry_run=args.dry_run)
+    for user_id, source, target, notes in moved:
+        print(f"🔀 User {user_id}: shard {source} -> {target} ({notes} notes)")
+    verb = "would move" if args.dry_run else "moved"
+    print(f"✅ {len(moved)} users {verb} across {len(db.shards)} shards")
+
+def backup(db, args):
+    """Back up the live database without stopping the bot"""
+    if not db.supports_backup:
+        print(f"⚠️ {type(db).__name__} has no online backup here; use the server's own tools "
+              "such as pg_dump")
+        return
+    for result in db.backup(args.dir, compress=not args.no_compress, keep=args.keep):
+        print(f"💾 {result['path']}: {result['bytes'] / 1048576:.1f} MB in {result['seconds']:.2f}s "
+              f"({result['pages']} pages, {result['steps']} steps, {result['restarts']} restarts)")
+        for path in result['removed']:
+            print(f"   🗑️ Rotated out {path}")
+
+def restore(db, args):
+    """Verify a backup and restore it over the database file"""
+    try:
+        seconds = restore_backup(args.backup, args.database)
+    except ValueError as e:
+        print(f"❌ {e}")
+        raise SystemExit(1)
+    print(f"✅ Restored {args.database} from {args.backup} in {seconds:.2f}s")
+
+def main():
+    """Database maintenance commands"""
+    parser = argparse.ArgumentParser(description="Note Saver Bot maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    subparsers.add_parser(
+        'rebuild-search', help="Backfill the full-text search index"
+    ).set_defaults(func=rebuild_search_index)
+    
+    subparsers.add_parser(
+        'check-plans', help="Check hot queries with EXPLAIN QUERY PLAN"
+    ).set_defaults(func=check_plans)
+    
+    stats_parser = subparsers.add_parser(
+        'verify-stats', help="Check the user_stats counters against the notes"
+    )
+    stats_parser.add_argument('--repair', action='store_true',
+                              help="Recompute the counters of drifted users")
+    stats_parser.set_defaults(func=verify_stats)
+    
+    subparsers.add_parser(
+        'refresh-rollups', help="Fold new activity into the daily rollups"
+    ).set_defaults(func=refresh_rollups)
+    
+    archive_parser = subparsers.add_parser(
+        'archive-activity', help="Archive old activity partitions to gzip files"
+    )
+    archive_parser.add_argument('--keep-months', type=int, default=ACTIVITY_KEEP_MONTHS,
+                                help="Months of activity to keep besides the current one")
+    archive_parser.add_argument('--archive-dir', default=ACTIVITY_ARCHIVE_DIR,
+                                help="Directory for the archive files")
+    archive_parser.add_argument('--vacuum', action='store_true',
+                                help="Reclaim the freed space afterwards")
+    archive_parser.set_defaults(func=archive_activity)
+    
+    rebalance_parser = subparsers.add_parser(
+        'rebalance-shards',
+        help="Move users to their shard after changing DATABASE_SHARDS; "
+             "restart the bot with the new count first, it may keep running"
+    )
+    rebalance_parser.add_argument('--dry-run', action='store_true',
+                                  help="Only list the users that would move")
+    rebalance_parser.set_defaults(func=rebalance_shards)
+    
+    backup_parser = subparsers.add_parser(
+        'backup', help="Online backup of the database while the bot runs"
+    )
+    backup_parser.add_argument('--dir', default=BACKUP_DIR, help="Directory for the backups")
+    backup_parser.add_argument('--keep', type=int, default=BACKUP_KEEP,
+                               help="Newest backups to keep per database file")
+    backup_parser.add_argument('--no-compress', action='store_true',
+                               help="Write plain .db files instead of .db.gz",
+                               default=not BACKUP_COMPRESS)
+    backup_parser.set_defaults(func=backup)
+    
+    restore_parser = subparsers.add_parser(
+        'restore', help="Restore a backup after an integrity check (stop the bot first)"
+    )
+    restore_parser.add_argument('backup', help="Backup file (.db or .db.gz)")
+    restore_parser.add_argument('--database', default=DATABASE_FILE,
+                                help="Database file to overwrite (a shard file when sharded)")
+    restore_parser.set_defaults(func=restore, open_storage=False)
+    
+    args = parser.parse_args()
+    if not getattr(args, 'open_storage', True):
+        # Opening the storage would migrate the file about to be replaced
+        args.func(None, args)
+        return
+    db = open_storage(DATABASE_FILE, DATABASE_URL, shards=DATABASE_SHARDS)
+    try:
+        args.func(db, args)
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import logging
+from telegram.error import BadRequest
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class MessageEdits:
+    """Edit messages from button clicks only when what they show changes
+
+    The hash of the text, parse mode and buttons each message was last
+    edited to is kept in an LRU, keyed by (chat_id, message_id). An edit
+    to the same content is skipped without a Bot API call. Telegram's
+    "message is not modified" error, for messages whose content the bot
+    no longer remembers, is counted and ignored.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.displayed = LRUCache(maxsize=maxsize)
+        self.sent = 0
+        self.unchanged = 0
+        self.not_modified = 0
+
+    async def edit(self, query, text, parse_mode=None, reply_markup=None):
+        """query.edit_message_text() unless the message already shows this"""
+        message = query.message
+        key = (message.chat_id, message.message_id) if message is not None else None
+        digest = hash((text, parse_mode, reply_markup))
+        if key is not None and self.displayed.get(key) == digest:
+            self.unchanged += 1
+            return
+
+        try:
+            await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            self.sent += 1
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+            self.not_modified += 1
+        if key is not None:
+            self.displayed.set(key, digest)
+
+    def stats(self):
+        """Counters for /metrics"""
+        return {
+            'sent': self.sent,
+            'unchanged': self.unchanged,
+            'not_modified': self.not_modified,
+            'tracked': len(self.displayed),
+        }
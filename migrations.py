@@ -0,0 +1,830 @@
+import sqlite3
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each migration is a function taking a cursor. The schema version is kept in
+# PRAGMA user_version: migration N runs once, when the version is below N, and
+# the version bump commits in the same transaction as the migration itself.
+# Never edit a migration that has shipped; add a new one instead.
+
+def migration_001_base_schema(cursor):
+    """Users, notes, tags and activity log tables"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            language TEXT DEFAULT 'en',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS notes (
+            note_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            content TEXT NOT NULL,
+            message_type TEXT DEFAULT 'text',
+            file_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            pinned INTEGER DEFAULT 0,
+            source_chat_id INTEGER,
+            source_chat_title TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tags (
+            tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id INTEGER,
+            tag TEXT NOT NULL,
+            FOREIGN KEY (note_id) REFERENCES notes(note_id) ON DELETE CASCADE,
+            UNIQUE(note_id, tag)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_log (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT NOT NULL,
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_id ON notes(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_created_at ON notes(created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags(tag)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_note_id ON tags(note_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_activity_user_id ON activity_log(user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_activity_timestamp ON activity_log(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_activity_action ON activity_log(action)")
+
+def migration_002_search_index(cursor):
+    """FTS5 index over note content, kept in sync by triggers"""
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+                content,
+                content='notes',
+                content_rowid='note_id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 not available, using substring search: {e}")
+        return
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, content) VALUES (new.note_id, new.content);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, content)
+            VALUES ('delete', old.note_id, old.content);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF content ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, content)
+            VALUES ('delete', old.note_id, old.content);
+            INSERT INTO notes_fts(rowid, content) VALUES (new.note_id, new.content);
+        END
+    """)
+    # Backfill notes saved before the index existed
+    cursor.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+def migration_003_composite_indexes(cursor):
+    """Indexes shaped like the hot per-user queries"""
+    # WHERE user_id = ? ORDER BY created_at DESC, without a temp sort
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notes_user_created
+        ON notes(user_id, created_at DESC)
+    """)
+    # Pinned list: equality on both columns, then already in date order
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notes_user_pinned
+        ON notes(user_id, pinned, created_at)
+    """)
+    # Active users by date range, answered from the index alone
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_activity_timestamp_user
+        ON activity_log(timestamp, user_id)
+    """)
+
+    # Superseded by the indexes above (or by the UNIQUE(note_id, tag)
+    # autoindex), or not used by any query; each one only slows writes
+    cursor.execute("DROP INDEX IF EXISTS idx_notes_user_id")
+    cursor.execute("DROP INDEX IF EXISTS idx_notes_created_at")
+    cursor.execute("DROP INDEX IF EXISTS idx_tags_note_id")
+    cursor.execute("DROP INDEX IF EXISTS idx_activity_timestamp")
+    cursor.execute("DROP INDEX IF EXISTS idx_activity_action")
+
+def migration_004_keyset_index(cursor):
+    """Ascending (user_id, created_at) index for keyset pagination"""
+    # With an ascending index the implicit rowid tie-breaker sorts the same
+    # way as created_at, so ORDER BY created_at DESC, note_id DESC is one
+    # backward index scan instead of a scan plus a temp sort of the ties.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notes_user_created_id
+        ON notes(user_id, created_at)
+    """)
+    cursor.execute("DROP INDEX IF EXISTS idx_notes_user_created")
+
+def migration_005_note_ordinals(cursor):
+    """Dense per-user note ordinals for constant-time random picks"""
+    # seq numbers each user's notes 1..n with no gaps. Inserts append n+1;
+    # a delete moves the user's last note into the freed slot. Picking a
+    # uniform k in 1..n is then a single index lookup on (user_id, seq).
+    cursor.execute("ALTER TABLE notes ADD COLUMN seq INTEGER")
+    cursor.execute("""
+        UPDATE notes SET seq = ranked.rn
+        FROM (
+            SELECT note_id,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY note_id) AS rn
+            FROM notes
+        ) AS ranked
+        WHERE ranked.note_id = notes.note_id
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notes_user_seq ON notes(user_id, seq)
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_seq_insert AFTER INSERT ON notes
+        WHEN new.seq IS NULL BEGIN
+            UPDATE notes
+            SET seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM notes WHERE user_id = new.user_id)
+            WHERE note_id = new.note_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_seq_delete AFTER DELETE ON notes BEGIN
+            UPDATE notes
+            SET seq = old.seq
+            WHERE user_id = old.user_id
+              AND seq > old.seq
+              AND seq = (SELECT MAX(seq) FROM notes WHERE user_id = old.user_id);
+        END
+    """)
+
+def migration_006_user_stats(cursor):
+    """Per-user note/pin/tag counters maintained by triggers"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            total_notes INTEGER NOT NULL DEFAULT 0,
+            pinned_count INTEGER NOT NULL DEFAULT 0,
+            unique_tags INTEGER NOT NULL DEFAULT 0,
+            first_note_at TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_tag_counts (
+            user_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, tag)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_tag_counts_top
+        ON user_tag_counts(user_id, count)
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_note_insert AFTER INSERT ON notes BEGIN
+            INSERT OR IGNORE INTO user_stats (user_id) VALUES (new.user_id);
+            UPDATE user_stats SET
+                total_notes = total_notes + 1,
+                pinned_count = pinned_count + (CASE WHEN new.pinned = 1 THEN 1 ELSE 0 END),
+                first_note_at = CASE
+                    WHEN first_note_at IS NULL OR new.created_at < first_note_at
+                    THEN new.created_at ELSE first_note_at END
+            WHERE user_id = new.user_id;
+        END
+    """)
+    # Deleting a note also deletes its tags (foreign keys are not enforced),
+    # and takes them out of the per-user tag counts here: by the time the
+    # tags delete trigger runs the note row is gone, so it cannot.
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_note_delete AFTER DELETE ON notes BEGIN
+            UPDATE user_stats SET
+                total_notes = total_notes - 1,
+                pinned_count = pinned_count - (CASE WHEN old.pinned = 1 THEN 1 ELSE 0 END),
+                first_note_at = CASE
+                    WHEN first_note_at = old.created_at
+                    THEN (SELECT MIN(created_at) FROM notes WHERE user_id = old.user_id)
+                    ELSE first_note_at END
+            WHERE user_id = old.user_id;
+            UPDATE user_tag_counts SET count = count - 1
+            WHERE user_id = old.user_id
+              AND tag IN (SELECT tag FROM tags WHERE note_id = old.note_id);
+            UPDATE user_stats SET unique_tags = unique_tags - (
+                SELECT COUNT(*) FROM user_tag_counts
+                WHERE user_id = old.user_id AND count = 0
+                  AND tag IN (SELECT tag FROM tags WHERE note_id = old.note_id)
+            )
+            WHERE user_id = old.user_id;
+            DELETE FROM user_tag_counts
+            WHERE user_id = old.user_id AND count = 0
+              AND tag IN (SELECT tag FROM tags WHERE note_id = old.note_id);
+            DELETE FROM tags WHERE note_id = old.note_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_note_pin AFTER UPDATE OF pinned ON notes
+        WHEN COALESCE(old.pinned, 0) != COALESCE(new.pinned, 0) BEGIN
+            UPDATE user_stats
+            SET pinned_count = pinned_count + (CASE WHEN new.pinned = 1 THEN 1 ELSE -1 END)
+            WHERE user_id = new.user_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_tag_insert AFTER INSERT ON tags BEGIN
+            INSERT OR IGNORE INTO user_tag_counts (user_id, tag, count)
+            SELECT user_id, new.tag, 0 FROM notes WHERE note_id = new.note_id;
+            UPDATE user_tag_counts SET count = count + 1
+            WHERE user_id = (SELECT user_id FROM notes WHERE note_id = new.note_id)
+              AND tag = new.tag;
+            UPDATE user_stats SET unique_tags = unique_tags + 1
+            WHERE user_id = (SELECT user_id FROM notes WHERE note_id = new.note_id)
+              AND (SELECT count FROM user_tag_counts
+                   WHERE user_id = user_stats.user_id AND tag = new.tag) = 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS user_stats_tag_delete AFTER DELETE ON tags BEGIN
+            UPDATE user_tag_counts SET count = count - 1
+            WHERE user_id = (SELECT user_id FROM notes WHERE note_id = old.note_id)
+              AND tag = old.tag;
+            UPDATE user_stats SET unique_tags = unique_tags - 1
+            WHERE user_id = (SELECT user_id FROM notes WHERE note_id = old.note_id)
+              AND (SELECT count FROM user_tag_counts
+                   WHERE user_id = user_stats.user_id AND tag = old.tag) = 0;
+            DELETE FROM user_tag_counts
+            WHERE user_id = (SELECT user_id FROM notes WHERE note_id = old.note_id)
+              AND tag = old.tag AND count = 0;
+        END
+    """)
+
+    # Tags of notes deleted before this migration were left behind
+    cursor.execute("DELETE FROM tags WHERE note_id NOT IN (SELECT note_id FROM notes)")
+    cursor.execute("""
+        INSERT INTO user_stats (user_id, total_notes, pinned_count, first_note_at)
+        SELECT user_id, COUNT(*), SUM(CASE WHEN pinned = 1 THEN 1 ELSE 0 END), MIN(created_at)
+        FROM notes
+        GROUP BY user_id
+    """)
+    cursor.execute("""
+        INSERT INTO user_tag_counts (user_id, tag, count)
+        SELECT n.user_id, t.tag, COUNT(*)
+        FROM tags t
+        JOIN notes n ON n.note_id = t.note_id
+        GROUP BY n.user_id, t.tag
+    """)
+    cursor.execute("""
+        UPDATE user_stats SET unique_tags = (
+            SELECT COUNT(*) FROM user_tag_counts c WHERE c.user_id = user_stats.user_id
+        )
+    """)
+
+def migration_007_daily_rollups(cursor):
+    """Daily rollups of signups, notes and activity for analytics"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            notes_created INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            actions INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_notes_by_type (
+            day TEXT NOT NULL,
+            message_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, message_type)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_actions (
+            day TEXT NOT NULL,
+            action TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, action)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id INTEGER PRIMARY KEY,
+            first_day TEXT NOT NULL,
+            last_day TEXT NOT NULL,
+            active_days INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Highest activity_log.log_id already folded into the rollups
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_watermarks (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("INSERT OR IGNORE INTO rollup_watermarks (source, last_id) VALUES ('activity_log', 0)")
+
+    # Signups and notes are low volume, so triggers keep their daily counts
+    # current. Deleting a note does not undo its "created" count.
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS daily_stats_user_insert AFTER INSERT ON users BEGIN
+            INSERT INTO daily_stats (day, new_users)
+            VALUES (DATE(COALESCE(new.created_at, CURRENT_TIMESTAMP)), 1)
+            ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS daily_stats_note_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO daily_stats (day, notes_created)
+            VALUES (DATE(COALESCE(new.created_at, CURRENT_TIMESTAMP)), 1)
+            ON CONFLICT(day) DO UPDATE SET notes_created = notes_created + 1;
+            INSERT INTO daily_notes_by_type (day, message_type, count)
+            VALUES (DATE(COALESCE(new.created_at, CURRENT_TIMESTAMP)),
+                    COALESCE(new.message_type, 'text'), 1)
+            ON CONFLICT(day, message_type) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+    cursor.execute("""
+        INSERT INTO daily_stats (day, new_users)
+        SELECT DATE(created_at), COUNT(*) FROM users
+        WHERE created_at IS NOT NULL
+        GROUP BY DATE(created_at)
+    """)
+    cursor.execute("""
+        INSERT INTO daily_stats (day, notes_created)
+        SELECT DATE(created_at), COUNT(*) FROM notes
+        WHERE created_at IS NOT NULL
+        GROUP BY DATE(created_at)
+        ON CONFLICT(day) DO UPDATE SET notes_created = excluded.notes_created
+    """)
+    cursor.execute("""
+        INSERT INTO daily_notes_by_type (day, message_type, count)
+        SELECT DATE(created_at), COALESCE(message_type, 'text'), COUNT(*) FROM notes
+        WHERE created_at IS NOT NULL
+        GROUP BY DATE(created_at), COALESCE(message_type, 'text')
+    """)
+    # Activity is folded in by Database.refresh_rollups(), batch by batch,
+    # so a huge activity_log does not hold up the migration.
+
+def activity_partition_name(month):
+    """Table holding the activity of one 'YYYYMM' month"""
+    if not re.fullmatch(r'\d{6}', month):
+        raise ValueError(f"Invalid activity partition month: {month}")
+    return f"activity_log_{month}"
+
+# Column default for epoch seconds, for rows written without a timestamp
+EPOCH_NOW = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+ACTIVITY_PARTITION_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS {{name}} (
+        log_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        action TEXT NOT NULL,
+        details TEXT,
+        timestamp INTEGER NOT NULL DEFAULT {EPOCH_NOW}
+    )
+"""
+
+def create_activity_partition(cursor, month):
+    """Create and register the partition for a month; returns its name"""
+    name = activity_partition_name(month)
+    cursor.execute(ACTIVITY_PARTITION_TABLE.format(name=name))
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_timestamp ON {name}(timestamp, user_id)")
+    cursor.execute("INSERT OR IGNORE INTO activity_partitions (month, name) VALUES (?, ?)", (month, name))
+    cursor.execute("INSERT OR IGNORE INTO rollup_watermarks (source, last_id) VALUES (?, 0)", (name,))
+    return name
+
+def migration_008_activity_partitions(cursor):
+    """Split activity_log into monthly partitions"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_partitions (
+            month TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            archive TEXT,
+            archived_at TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+
+    cursor.execute("SELECT last_id FROM rollup_watermarks WHERE source = 'activity_log'")
+    row = cursor.fetchone()
+    rolled_up = row[0] if row else 0
+
+    cursor.execute("""
+        SELECT DISTINCT strftime('%Y%m', timestamp) FROM activity_log
+        WHERE strftime('%Y%m', timestamp) IS NOT NULL
+    """)
+    for (month,) in cursor.fetchall():
+        name = create_activity_partition(cursor, month)
+        # log_id is kept, so rows up to the old watermark stay rolled up
+        cursor.execute(f"""
+            INSERT INTO {name} (log_id, user_id, action, details, timestamp)
+            SELECT log_id, user_id, action, details, timestamp FROM activity_log
+            WHERE strftime('%Y%m', timestamp) = ?
+        """, (month,))
+        cursor.execute("UPDATE rollup_watermarks SET last_id = ? WHERE source = ?", (rolled_up, name))
+
+    # Events whose timestamp is NULL or unparseable have no month. They go
+    # to the oldest partition, stamped with its first second, instead of
+    # being dropped with the old table.
+    cursor.execute("SELECT COUNT(*) FROM activity_log WHERE strftime('%Y%m', timestamp) IS NULL")
+    undated = cursor.fetchone()[0]
+    if undated:
+        cursor.execute("SELECT COALESCE(MIN(month), strftime('%Y%m', 'now')) FROM activity_partitions")
+        month = cursor.fetchone()[0]
+        name = create_activity_partition(cursor, month)
+        cursor.execute(f"""
+            INSERT INTO {name} (log_id, user_id, action, details, timestamp)
+            SELECT log_id, user_id, action, details, ? FROM activity_log
+            WHERE strftime('%Y%m', timestamp) IS NULL
+        """, (f"{month[:4]}-{month[4:]}-01 00:00:00",))
+        cursor.execute("UPDATE rollup_watermarks SET last_id = ? WHERE source = ?", (rolled_up, name))
+        logger.warning(f"{undated} activity events without a valid timestamp moved to {name}")
+
+    cursor.execute("DROP TABLE activity_log")
+    cursor.execute("DELETE FROM rollup_watermarks WHERE source = 'activity_log'")
+
+def migration_009_analytics_snapshots(cursor):
+    """Stored /analytics dashboard snapshots"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_snapshots (
+            snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            generated_at TIMESTAMP NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    # Top users by note count without grouping the notes table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_total ON user_stats(total_notes)")
+
+def migration_010_epoch_timestamps(cursor):
+    """Store timestamps as integer Unix epoch seconds"""
+    # 'YYYY-MM-DD HH:MM:SS' text only sorted correctly against text in
+    # exactly the same format. Integers compare as ranges on any index
+    # and need no parsing. Writers now always pass explicit epoch values.
+    to_epoch = "CAST(strftime('%s', {0}) AS INTEGER)"
+    for table, column in [
+        ('notes', 'created_at'),
+        ('users', 'created_at'),
+        ('user_stats', 'first_note_at'),
+        ('activity_partitions', 'archived_at'),
+    ]:
+        cursor.execute(f"""
+            UPDATE {table} SET {column} = {to_epoch.format(column)}
+            WHERE typeof({column}) = 'text'
+        """)
+
+    cursor.execute("SELECT name FROM activity_partitions WHERE archive IS NULL")
+    for (name,) in cursor.fetchall():
+        cursor.execute(f"""
+            UPDATE {name} SET timestamp = {to_epoch.format('timestamp')}
+            WHERE typeof(timestamp) = 'text'
+        """)
+
+    # Old snapshots carry text stamps; the bot computes a new one on start
+    cursor.execute("DELETE FROM analytics_snapshots")
+
+    cursor.execute("DROP TRIGGER IF EXISTS daily_stats_user_insert")
+    cursor.execute("DROP TRIGGER IF EXISTS daily_stats_note_insert")
+    cursor.execute("""
+        CREATE TRIGGER daily_stats_user_insert AFTER INSERT ON users BEGIN
+            INSERT INTO daily_stats (day, new_users)
+            VALUES (DATE(COALESCE(new.created_at, strftime('%s', 'now')), 'unixepoch'), 1)
+            ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER daily_stats_note_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO daily_stats (day, notes_created)
+            VALUES (DATE(COALESCE(new.created_at, strftime('%s', 'now')), 'unixepoch'), 1)
+            ON CONFLICT(day) DO UPDATE SET notes_created = notes_created + 1;
+            INSERT INTO daily_notes_by_type (day, message_type, count)
+            VALUES (DATE(COALESCE(new.created_at, strftime('%s', 'now')), 'unixepoch'),
+                    COALESCE(new.message_type, 'text'), 1)
+            ON CONFLICT(day, message_type) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+def migration_011_shard_moves(cursor):
+    """Ledger of users being copied between shards"""
+    # A row exists while a user's notes are in both shards: copied to
+    # this one, not yet deleted from source_shard. A rebalance that was
+    # interrupted there only finishes the delete instead of copying twice.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shard_moves (
+            user_id INTEGER NOT NULL,
+            source_shard INTEGER NOT NULL,
+            moved_at INTEGER NOT NULL,
+            notes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, source_shard)
+        )
+    """)
+
+def migration_012_import_jobs(cursor):
+    """Progress of note imports, so an interrupted import can resume"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            UNIQUE (user_id, source)
+        )
+    """)
+
+def migration_013_search_owner(cursor):
+    """Owner column in the search index, so a search skips other users' entries"""
+    # The index held only the note text, so a MATCH on a common word walked
+    # every user's notes with it back to the notes table before the user_id
+    # filter. Each note now also has an owner token u<user_id>, and queries
+    # AND it with the words, so FTS5 drops other users' rows itself. The
+    # token is built in plain SQL so any SQLite client can still write to
+    # notes.
+    cursor.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'
+    """)
+    if cursor.fetchone() is None:
+        return  # No FTS5 in this SQLite build
+
+    for trigger in ('notes_fts_insert', 'notes_fts_delete', 'notes_fts_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE notes_fts")
+    cursor.execute("""
+        CREATE VIEW IF NOT EXISTS notes_search AS
+        SELECT note_id, content, 'u' || user_id AS owner FROM notes
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE notes_fts USING fts5(
+            content,
+            owner,
+            content='notes_search',
+            content_rowid='note_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, content, owner)
+            VALUES (new.note_id, new.content, 'u' || new.user_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, content, owner)
+            VALUES ('delete', old.note_id, old.content, 'u' || old.user_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER notes_fts_update AFTER UPDATE OF content, user_id ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, content, owner)
+            VALUES ('delete', old.note_id, old.content, 'u' || old.user_id);
+            INSERT INTO notes_fts(rowid, content, owner)
+            VALUES (new.note_id, new.content, 'u' || new.user_id);
+        END
+    """)
+    cursor.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+def rebuild_tables(cursor, tables):
+    """Recreate tables with a new declaration, keeping rows, indexes and ids
+
+    tables maps a table name to (CREATE TABLE statement with {name} for
+    the table name, {column: expression filling it from the old table}).
+    Renaming a table makes SQLite re-check every trigger and view, so
+    all of them are dropped first and created again at the end, as in
+    the ALTER TABLE documentation's procedure for other schema changes.
+    """
+    cursor.execute("""
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('view', 'trigger') AND sql IS NOT NULL
+        ORDER BY type = 'trigger'
+    """)
+    dependents = cursor.fetchall()
+    for kind, name, _ in reversed(dependents):
+        cursor.execute(f"DROP {kind.upper()} {name}")
+
+    for table, (create, columns) in tables.items():
+        cursor.execute("""
+            SELECT sql FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL
+        """, (table,))
+        indexes = [row[0] for row in cursor.fetchall()]
+        # AUTOINCREMENT must not hand out the ids of deleted rows again
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+        sequence = cursor.fetchone()
+
+        rebuilt = f"{table}_rebuilt"
+        cursor.execute(create.format(name=rebuilt))
+        cursor.execute(f"""
+            INSERT INTO {rebuilt} ({', '.join(columns)})
+            SELECT {', '.join(columns.values())} FROM {table}
+        """)
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {rebuilt} RENAME TO {table}")
+        for sql in indexes:
+            cursor.execute(sql)
+        if sequence:
+            cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?",
+                           (sequence[0], table))
+
+    for _, _, sql in dependents:
+        cursor.execute(sql)
+
+def migration_014_epoch_defaults(cursor):
+    """Integer epoch defaults for created_at and activity timestamps"""
+    # Migration 10 converted the values but the columns kept their
+    # TIMESTAMP DEFAULT CURRENT_TIMESTAMP declarations, so a row written
+    # without the column, e.g. from the sqlite3 shell, stored text again.
+    # A stamp migration 10 could not parse was left NULL; it becomes the
+    # time of this migration.
+    stamp = f"COALESCE(CAST({{0}} AS INTEGER), {EPOCH_NOW})"
+    user_columns = ['user_id', 'username', 'first_name', 'language']
+    note_columns = ['note_id', 'user_id', 'content', 'message_type', 'file_id', 'pinned',
+                    'source_chat_id', 'source_chat_title', 'seq']
+    activity_columns = ['log_id', 'user_id', 'action', 'details']
+
+    tables = {
+        'users': (f"""
+            CREATE TABLE {{name}} (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                language TEXT DEFAULT 'en',
+                created_at INTEGER NOT NULL DEFAULT {EPOCH_NOW}
+            )
+        """, {**{column: column for column in user_columns},
+              'created_at': stamp.format('created_at')}),
+        'notes': (f"""
+            CREATE TABLE {{name}} (
+                note_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                content TEXT NOT NULL,
+                message_type TEXT DEFAULT 'text',
+                file_id TEXT,
+                created_at INTEGER NOT NULL DEFAULT {EPOCH_NOW},
+                pinned INTEGER DEFAULT 0,
+                source_chat_id INTEGER,
+                source_chat_title TEXT,
+                seq INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """, {**{column: column for column in note_columns},
+              'created_at': stamp.format('created_at')}),
+    }
+    cursor.execute("SELECT name FROM activity_partitions WHERE archive IS NULL")
+    for (name,) in cursor.fetchall():
+        tables[name] = (ACTIVITY_PARTITION_TABLE,
+                        {**{column: column for column in activity_columns},
+                         'timestamp': stamp.format('timestamp')})
+    rebuild_tables(cursor, tables)
+
+MIGRATIONS = [
+    migration_001_base_schema,
+    migration_002_search_index,
+    migration_003_composite_indexes,
+    migration_004_keyset_index,
+    migration_005_note_ordinals,
+    migration_006_user_stats,
+    migration_007_daily_rollups,
+    migration_008_activity_partitions,
+    migration_009_analytics_snapshots,
+    migration_010_epoch_timestamps,
+    migration_011_shard_moves,
+    migration_012_import_jobs,
+    migration_013_search_owner,
+    migration_014_epoch_defaults,
+]
+
+# Representative shapes of the queries run on every page view. After
+# migrating, none of them may scan a whole table or sort/group in a temp B-tree.
+HOT_QUERIES = {
+    'recent_notes': (
+        "SELECT note_id FROM notes WHERE user_id = ? ORDER BY created_at DESC, note_id DESC LIMIT 5",
+        (1,)
+    ),
+    'notes_page_older': (
+        "SELECT note_id FROM notes WHERE user_id = ? AND (created_at, note_id) < (?, ?) "
+        "ORDER BY created_at DESC, note_id DESC LIMIT 6",
+        (1, 1704067200, 1)
+    ),
+    'notes_page_newer': (
+        "SELECT note_id FROM notes WHERE user_id = ? AND (created_at, note_id) > (?, ?) "
+        "ORDER BY created_at ASC, note_id ASC LIMIT 6",
+        (1, 1704067200, 1)
+    ),
+    'pinned_notes': (
+        "SELECT note_id FROM notes WHERE user_id = ? AND pinned = 1 ORDER BY created_at DESC",
+        (1,)
+    ),
+    'user_stats': (
+        "SELECT total_notes, pinned_count, unique_tags, first_note_at "
+        "FROM user_stats WHERE user_id = ?",
+        (1,)
+    ),
+    'top_tags': (
+        "SELECT tag, count FROM user_tag_counts WHERE user_id = ? ORDER BY count DESC LIMIT 5",
+        (1,)
+    ),
+    'this_week': (
+        "SELECT note_id FROM notes WHERE user_id = ? AND created_at >= ? ORDER BY created_at DESC",
+        (1, 1704067200)
+    ),
+    'notes_by_tag': (
+        "SELECT n.note_id FROM notes n JOIN tags t ON n.note_id = t.note_id "
+        "WHERE n.user_id = ? AND t.tag = ? ORDER BY n.created_at DESC LIMIT 20",
+        (1, 'work')
+    ),
+    'random_note': (
+        "SELECT note_id FROM notes WHERE user_id = ? AND seq = ?",
+        (1, 1)
+    ),
+    'tags_for_note': (
+        "SELECT tag FROM tags WHERE note_id = ?",
+        (1,)
+    ),
+    'daily_stats': (
+        "SELECT day, new_users FROM daily_stats WHERE day >= ? ORDER BY day",
+        ('2024-01-01',)
+    ),
+}
+
+def hot_queries(cursor):
+    """HOT_QUERIES plus the activity query against the newest live partition"""
+    queries = dict(HOT_QUERIES)
+    cursor.execute("""
+        SELECT name FROM activity_partitions WHERE archive IS NULL ORDER BY month DESC LIMIT 1
+    """)
+    row = cursor.fetchone()
+    if row:
+        queries['active_users'] = (
+            f"SELECT user_id FROM {row[0]} WHERE timestamp >= ?",
+            (1704067200,)
+        )
+    return queries
+
+def check_query_plans(cursor):
+    """Return {query name: [bad plan steps]} for hot queries that scan or sort"""
+    problems = {}
+    for name, (sql, params) in hot_queries(cursor).items():
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        details = [row[3] for row in cursor.fetchall()]
+        bad = [
+            detail for detail in details
+            if detail.startswith(('USE TEMP B-TREE FOR ORDER BY', 'USE TEMP B-TREE FOR GROUP BY'))
+            or (detail.startswith('SCAN') and 'USING' not in detail)
+        ]
+        if bad:
+            problems[name] = bad
+    return problems
+
+def get_schema_version(cursor):
+    """Current PRAGMA user_version"""
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+def migrate(conn):
+    """Apply pending migrations in order; returns the new schema version"""
+    cursor = conn.cursor()
+    version = get_schema_version(cursor)
+    target = len(MIGRATIONS)
+
+    if version > target:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this code ({target})"
+        )
+
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info(f"Applying migration {number}: {migration.__doc__}")
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            logger.error(f"Migration {number} failed, schema left at version {number - 1}")
+            raise
+
+    if version < target:
+        for name, steps in check_query_plans(cursor).items():
+            logger.warning(f"Hot query '{name}' is not fully indexed: {'; '.join(steps)}")
+    return target
@@ -0,0 +1,831 @@
+import calendar
+import csv
+import io
+import json
+import re
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from storage import StorageBackend, epoch_now, SNIPPET_START, SNIPPET_END
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        language TEXT DEFAULT 'en',
+        created_at BIGINT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notes (
+        note_id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        content TEXT NOT NULL,
+        message_type TEXT DEFAULT 'text',
+        file_id TEXT,
+        created_at BIGINT NOT NULL,
+        pinned INTEGER DEFAULT 0,
+        source_chat_id BIGINT,
+        source_chat_title TEXT,
+        search TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tags (
+        tag_id BIGSERIAL PRIMARY KEY,
+        note_id BIGINT NOT NULL REFERENCES notes(note_id) ON DELETE CASCADE,
+        tag TEXT NOT NULL,
+        UNIQUE (note_id, tag)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS activity_log (
+        log_id BIGSERIAL,
+        user_id BIGINT,
+        action TEXT NOT NULL,
+        details TEXT,
+        timestamp BIGINT NOT NULL
+    ) PARTITION BY RANGE (timestamp)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_snapshots (
+        snapshot_id BIGSERIAL PRIMARY KEY,
+        generated_at BIGINT NOT NULL,
+        data JSONB NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        job_id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        source TEXT NOT NULL,
+        rows_done INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at BIGINT NOT NULL,
+        updated_at BIGINT NOT NULL,
+        UNIQUE (user_id, source)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_notes_user_created_id ON notes(user_id, created_at, note_id)",
+    "CREATE INDEX IF NOT EXISTS idx_notes_user_pinned ON notes(user_id, created_at) WHERE pinned = 1",
+    "CREATE INDEX IF NOT EXISTS idx_notes_created_at ON notes(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_notes_search ON notes USING GIN (search)",
+    "CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags(tag, note_id)",
+]
+
+# Dense per-user note ordinals, as in the SQLite schema: seq numbers each
+# user's notes 1..n, inserts append n+1 and a delete moves the user's last
+# note into the freed slot. Writers of one user's notes take an advisory
+# lock on the user_id first, so concurrent writers never pick the same seq.
+# Applied once, when the column is missing.
+NOTE_ORDINALS = [
+    "ALTER TABLE notes ADD COLUMN seq INTEGER",
+    """
+    UPDATE notes SET seq = ranked.rn
+    FROM (
+        SELECT note_id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY note_id) AS rn
+        FROM notes
+    ) ranked
+    WHERE ranked.note_id = notes.note_id
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_notes_user_seq ON notes(user_id, seq)",
+    """
+    CREATE OR REPLACE FUNCTION notes_seq_insert() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.seq IS NULL THEN
+            PERFORM pg_advisory_xact_lock(NEW.user_id);
+            SELECT COALESCE(MAX(seq), 0) + 1 INTO NEW.seq FROM notes WHERE user_id = NEW.user_id;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION notes_seq_delete() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(OLD.user_id);
+        UPDATE notes SET seq = OLD.seq
+        WHERE user_id = OLD.user_id
+          AND seq > OLD.seq
+          AND seq = (SELECT MAX(seq) FROM notes WHERE user_id = OLD.user_id);
+        RETURN OLD;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER notes_seq_insert BEFORE INSERT ON notes
+    FOR EACH ROW EXECUTE FUNCTION notes_seq_insert()
+    """,
+    """
+    CREATE TRIGGER notes_seq_delete AFTER DELETE ON notes
+    FOR EACH ROW EXECUTE FUNCTION notes_seq_delete()
+    """,
+]
+
+TAGS_COLUMN = "(SELECT array_agg(t.tag) FROM tags t WHERE t.note_id = notes.note_id)"
+NOTE_COLUMNS = f"note_id, content, created_at, pinned, message_type, file_id, {TAGS_COLUMN}"
+
+# Hot statements, prepared once per connection and then run with EXECUTE,
+# so the server parses and plans them only once.
+PREPARED = {
+    'load_profile': "SELECT language, username FROM users WHERE user_id = $1",
+    'save_note': """
+        INSERT INTO notes (user_id, content, message_type, file_id,
+                           source_chat_id, source_chat_title, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+        RETURNING note_id
+    """,
+    'recent_notes': f"""
+        SELECT {NOTE_COLUMNS} FROM notes
+        WHERE user_id = $1
+        ORDER BY created_at DESC, note_id DESC
+        LIMIT $2 OFFSET $3
+    """,
+    'notes_older': f"""
+        SELECT {NOTE_COLUMNS} FROM notes
+        WHERE user_id = $1 AND (created_at, note_id) < ($2, $3)
+        ORDER BY created_at DESC, note_id DESC
+        LIMIT $4
+    """,
+    'notes_newer': f"""
+        SELECT {NOTE_COLUMNS} FROM notes
+        WHERE user_id = $1 AND (created_at, note_id) > ($2, $3)
+        ORDER BY created_at ASC, note_id ASC
+        LIMIT $4
+    """,
+    'import_note': """
+        INSERT INTO notes (user_id, content, message_type, file_id, created_at,
+                           pinned, source_chat_id, source_chat_title)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        RETURNING note_id
+    """,
+    'note_count': "SELECT COUNT(*) FROM notes WHERE user_id = $1",
+    'get_note': f"""
+        SELECT content, created_at, pinned, message_type, file_id, {TAGS_COLUMN}
+        FROM notes
+        WHERE note_id = $1 AND user_id = $2
+    """,
+    'pinned_notes': f"""
+        SELECT note_id, content, created_at, {TAGS_COLUMN}
+        FROM notes
+        WHERE user_id = $1 AND pinned = 1
+        ORDER BY created_at DESC
+    """,
+}
+
+HEADLINE_OPTIONS = f"StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords=12, MinWords=4"
+
+def build_tsquery(text):
+    """Turn free user text into a to_tsquery expression, last word as a prefix"""
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    terms = [f"'{word}'" for word in words]
+    terms[-1] += ':*'
+    return ' & '.join(terms)
+
+def month_bounds(month):
+    """[start, end) epoch seconds of a 'YYYYMM' month"""
+    year, mon = int(month[:4]), int(month[4:])
+    start = calendar.timegm((year, mon, 1, 0, 0, 0))
+    end = calendar.timegm((year + mon // 12, mon % 12 + 1, 1, 0, 0, 0))
+    return start, end
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements it has prepared"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class PostgresDatabase(StorageBackend):
+    """PostgreSQL storage backend
+
+    Connections come from a thread-safe pool, so reads and writes run
+    concurrently instead of queueing on a single SQLite writer. When every
+    connection is in use, for instance by long exports, callers wait for
+    one to be returned instead of failing. Writes are spread over
+    ``write_lanes`` lanes by user_id (half the pool), so AsyncDatabase runs
+    that many writer threads while each user's writes stay in order. Hot
+    statements are server-side prepared, search uses a generated tsvector
+    column with a GIN index, and activity batches are loaded with COPY
+    into monthly range partitions.
+    """
+
+    def __init__(self, database_url, pool_size=10, profile_cache_size=10000,
+                 profile_cache_ttl=600):
+        super().__init__(profile_cache_size, profile_cache_ttl)
+        self.database_url = database_url
+        self._local = threading.local()
+        # Months whose activity partition is known to exist
+        self._activity_months = set()
+        # ThreadedConnectionPool raises PoolError when it is exhausted;
+        # taking a slot first makes callers wait for a connection instead
+        self._slots = threading.BoundedSemaphore(pool_size)
+        # The other half of the pool is left for reads and bulk jobs
+        self.write_lanes = max(1, pool_size // 2)
+        try:
+            self.pool = ThreadedConnectionPool(
+                1, pool_size, database_url, connection_factory=PreparedConnection
+            )
+            logger.info(f"PostgreSQL pool opened ({pool_size} connections)")
+        except Exception as e:
+            logger.error(f"Database connection failed: {e}")
+            raise
+        self.create_tables()
+
+    def write_lane(self, user_id):
+        """Writes for a user always go through the same lane"""
+        return user_id % self.write_lanes if user_id is not None else 0
+
+    def _getconn(self):
+        """A connection from the pool, waiting while all of them are in use"""
+        self._slots.acquire()
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _putconn(self, conn):
+        try:
+            self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Pooled connection; commits on success, rolls back otherwise
+
+        Inside compute_analytics_snapshot() the thread's snapshot
+        connection is reused so every query sees the same data.
+        """
+        pinned = getattr(self._local, 'conn', None)
+        if pinned is not None:
+            yield pinned
+            return
+
+        conn = self._getconn()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            # Also reached by GeneratorExit when an export is closed early,
+            # which no except clause catches. A no-op after the commit.
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            finally:
+                self._putconn(conn)
+
+    def _execute(self, cursor, name, params):
+        """Run a PREPARED statement, preparing it on first use per connection"""
+        conn = cursor.connection
+        if name not in conn.prepared:
+            cursor.execute(f"PREPARE {name} AS {PREPARED[name]}")
+            conn.prepared.add(name)
+        placeholders = ', '.join(['%s'] * len(params))
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+    def _copy_rows(self, cursor, table, columns, rows):
+        """Bulk load rows with COPY ... FROM STDIN"""
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+
+    def create_tables(self):
+        """Create the schema if it does not exist"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            cursor.execute("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'notes'
+                  AND column_name = 'seq'
+            """)
+            if cursor.fetchone() is None:
+                for statement in NOTE_ORDINALS:
+                    cursor.execute(statement)
+        logger.info("Database tables created/verified")
+
+    # Users
+    def create_user(self, user_id, username, first_name, language='en'):
+        """Insert the user row unless it exists, bypassing the profile cache"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO users (user_id, username, first_name, language, created_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) DO NOTHING
+            """, (user_id, username, first_name, language, epoch_now()))
+        self.profiles.pop(user_id)
+
+    def set_user_language(self, user_id, language):
+        """Set user's preferred language"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE users SET language = %s WHERE user_id = %s
+            """, (language, user_id))
+            updated = cursor.rowcount
+        self._cache_language(user_id, language, updated)
+
+    def load_user_profile(self, user_id):
+        """Read user's profile from the database and cache it"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            self._execute(cursor, 'load_profile', (user_id,))
+            return self._cache_profile(user_id, cursor.fetchone())
+
+    # Activity
+    def log_activity_batch(self, events):
+        """Write many (user_id, action, details, timestamp) events with one COPY"""
+        months = {time.strftime('%Y%m', time.gmtime(event[3])) for event in events}
+        with self.connection() as conn, conn.cursor() as cursor:
+            for month in months - self._activity_months:
+                self._create_activity_partition(cursor, month)
+            self._copy_rows(cursor, 'activity_log',
+                            ('user_id', 'action', 'details', 'timestamp'), events)
+        self._activity_months |= months
+
+    def _create_activity_partition(self, cursor, month):
+        start, end = month_bounds(month)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS activity_log_{month}
+            PARTITION OF activity_log FOR VALUES FROM ({start}) TO ({end})
+        """)
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_activity_log_{month}_timestamp
+            ON activity_log_{month}(timestamp, user_id)
+        """)
+
+    # Notes
+    def save_note(self, user_id, content, message_type='text',
+                  file_id=None, source_chat_id=None, source_chat_title=None):
+        """Save a new note"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            self._execute(cursor, 'save_note', (
+                user_id, content, message_type, file_id,
+                source_chat_id, source_chat_title, epoch_now()
+            ))
+            note_id = cursor.fetchone()[0]
+        logger.info(f"Note {note_id} saved for user {user_id}")
+        return note_id
+
+    def add_tag(self, note_id, tag, user_id):
+        """Add a tag to a user's note"""
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO tags (note_id, tag)
+                    SELECT note_id, %s FROM notes WHERE note_id = %s AND user_id = %s
+                    ON CONFLICT (note_id, tag) DO NOTHING
+                """, (tag.lower(), note_id, user_id))
+        except Exception as e:
+            logger.error(f"Error adding tag: {e}")
+
+    def get_recent_notes(self, user_id, limit=5, offset=0):
+        """Get recent notes with tags, message_type and file_id"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            self._execute(cursor, 'recent_notes', (user_id, limit, offset))
+            return self._page_notes(cursor.fetchall())
+
+    def get_notes_page(self, user_id, limit=5, cursor=None, direction='older'):
+        """Get one page of notes using keyset pagination; see Database.get_notes_page"""
+        with self.connection() as conn, conn.cursor() as db_cursor:
+            if cursor is not None and direction == 'newer':
+                self._execute(db_cursor, 'notes_newer', (user_id, cursor[0], cursor[1], limit + 1))
+                rows = db_cursor.fetchall()
+                if len(rows) > limit:
+                    return self._page_notes(rows[:limit][::-1]), True, True
+                cursor = None
+
+            if cursor is None:
+                self._execute(db_cursor, 'recent_notes', (user_id, limit + 1, 0))
+            else:
+                self._execute(db_cursor, 'notes_older', (user_id, cursor[0], cursor[1], limit + 1))
+            rows = db_cursor.fetchall()
+
+        if not rows and cursor is not None:
+            return self.get_notes_page(user_id, limit)
+        return self._page_notes(rows[:limit]), len(rows) > limit, cursor is not None
+
+    def _page_notes(self, rows):
+        return [row[:6] + (row[6] or [],) for row in rows]
+
+    def get_note_count(self, user_id):
+        """Get total note count for user"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            self._execute(cursor, 'note_count', (user_id,))
+            return cursor.fetchone()[0]
+
+    def get_note(self, note_id, user_id):
+        """Get a single note with tags"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            self._execute(cursor, 'get_note', (note_id, user_id))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        return (row[0], row[1], row[2], row[5] or [], row[3], row[4])
+
+    def toggle_pin(self, note_id, user_id):
+        """Toggle pin status of a user's note"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE notes
+                SET pinned = CASE WHEN pinned = 1 THEN 0 ELSE 1 END
+                WHERE note_id = %s AND user_id = %s
+            """, (note_id, user_id))
+
+    def delete_note(self, note_id, user_id):
+        """Delete a user's note; its tags go with it through the foreign key"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            # Before the row lock the DELETE takes, in the same order as
+            # the seq triggers of other writers of this user
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (user_id,))
+            cursor.execute("DELETE FROM notes WHERE note_id = %s AND user_id = %s",
+                           (note_id, user_id))
+        logger.info(f"Note {note_id} deleted")
+
+    def search_notes(self, user_id, query, mode='fts'):
+        """Search notes by content
+
+        Returns (note_id, content, created_at, snippet) rows. In 'fts' mode
+        the tsvector index is used, results are ranked with ts_rank and the
+        snippet has the matches between SNIPPET_START and SNIPPET_END;
+        'substring' mode uses ILIKE and returns the whole note as the snippet.
+        """
+        tsquery = build_tsquery(query)
+        with self.connection() as conn, conn.cursor() as cursor:
+            if mode == 'fts' and tsquery:
+                cursor.execute("""
+                    SELECT note_id, content, created_at,
+                           ts_headline('simple', content, q, %s)
+                    FROM notes, to_tsquery('simple', %s) q
+                    WHERE user_id = %s AND search @@ q
+                    ORDER BY ts_rank(search, q) DESC
+                    LIMIT 20
+                """, (HEADLINE_OPTIONS, tsquery, user_id))
+            else:
+                cursor.execute("""
+                    SELECT note_id, content, created_at, content
+                    FROM notes
+                    WHERE user_id = %s AND content ILIKE %s
+                    ORDER BY created_at DESC
+                    LIMIT 20
+                """, (user_id, f'%{query}%'))
+            return cursor.fetchall()
+
+    def search_by_tag(self, user_id, tag):
+        """Search notes by tag"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT n.note_id, n.content, n.created_at
+                FROM notes n
+                JOIN tags t ON n.note_id = t.note_id
+                WHERE n.user_id = %s AND t.tag = %s
+                ORDER BY n.created_at DESC
+                LIMIT 20
+            """, (user_id, tag.lower()))
+            return cursor.fetchall()
+
+    def search_this_week(self, user_id):
+        """Get notes from this week"""
+        now = epoch_now()
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT note_id, content, created_at
+                FROM notes
+                WHERE user_id = %s AND created_at >= %s AND created_at < %s
+                ORDER BY created_at DESC
+            """, (user_id, now - 7 * 86400, now + 1))
+            return cursor.fetchall()
+
+    def get_pinned_notes(self, user_id):
+        """Get all pinned notes"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            self._execute(cursor, 'pinned_notes', (user_id,))
+            return [row[:3] + (row[3] or [],) for row in cursor.fetchall()]
+
+    def get_random_note(self, user_id, exclude=()):
+        """Get a random note, skipping ids in exclude while others are left
+
+        Picks an ordinal among the user's dense seq numbers the way
+        Database.get_random_note does, in one statement of index lookups.
+        """
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"""
+                WITH excluded AS (
+                    SELECT seq, ROW_NUMBER() OVER (ORDER BY seq) AS rank
+                    FROM notes
+                    WHERE note_id = ANY(%s) AND user_id = %s
+                ),
+                counts AS (
+                    SELECT total, CASE WHEN skipped < total THEN skipped ELSE 0 END AS skipped
+                    FROM (SELECT (SELECT MAX(seq) FROM notes WHERE user_id = %s) AS total,
+                                 (SELECT COUNT(*) FROM excluded) AS skipped) c
+                ),
+                pick AS MATERIALIZED (
+                    SELECT 1 + floor(random() * (total - skipped))::bigint AS k, skipped
+                    FROM counts
+                )
+                SELECT note_id, content, {TAGS_COLUMN}
+                FROM pick
+                JOIN notes ON notes.user_id = %s AND notes.seq = pick.k + (
+                    SELECT COUNT(*) FROM excluded
+                    WHERE pick.skipped > 0 AND excluded.seq - excluded.rank < pick.k
+                )
+            """, (list(exclude), user_id, user_id, user_id))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        return (row[0], row[1], row[2] or [])
+
+    def get_popular_tags(self, user_id, limit=6):
+        """Get most used tags"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT t.tag
+                FROM tags t
+                JOIN notes n ON n.note_id = t.note_id
+                WHERE n.user_id = %s
+                GROUP BY t.tag
+                ORDER BY COUNT(*) DESC
+                LIMIT %s
+            """, (user_id, limit))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_user_stats(self, user_id):
+        """Get user statistics"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE pinned = 1), MIN(created_at),
+                       (SELECT COUNT(DISTINCT t.tag) FROM tags t
+                        JOIN notes tn ON tn.note_id = t.note_id WHERE tn.user_id = %s)
+                FROM notes
+                WHERE user_id = %s
+            """, (user_id, user_id))
+            total_notes, pinned_count, first_note, unique_tags = cursor.fetchone()
+
+            cursor.execute("""
+                SELECT t.tag, COUNT(*)
+                FROM tags t
+                JOIN notes n ON n.note_id = t.note_id
+                WHERE n.user_id = %s
+                GROUP BY t.tag
+                ORDER BY COUNT(*) DESC
+                LIMIT 5
+            """, (user_id,))
+            top_tags = cursor.fetchall()
+
+        if first_note:
+            first_note_date = datetime.fromtimestamp(first_note, timezone.utc).strftime('%B %d, %Y')
+        else:
+            first_note_date = 'N/A'
+
+        return {
+            'total_notes': total_notes,
+            'pinned_count': pinned_count,
+            'unique_tags': unique_tags,
+            'first_note_date': first_note_date,
+            'top_tags': top_tags
+        }
+
+    # Export and import
+    def iter_notes_export(self, user_id, chunk_size=500):
+        """Yield all of a user's notes, oldest first; see Database.iter_notes_export
+
+        A server-side cursor streams the rows chunk_size at a time, all
+        from one snapshot, while holding a pooled connection.
+        """
+        with self.connection() as conn, conn.cursor(name=f'export_{user_id}') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(f"""
+                SELECT note_id, content, message_type, file_id, created_at, pinned,
+                       source_chat_id, source_chat_title, {TAGS_COLUMN}
+                FROM notes
+                WHERE user_id = %s
+                ORDER BY created_at ASC, note_id ASC
+            """, (user_id,))
+            for row in cursor:
+                yield row[:8] + (row[8] or [],)
+
+    def start_import_job(self, user_id, source):
+        """(job_id, rows_done, finished) for importing source, resuming a previous run"""
+        now = epoch_now()
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO import_jobs (user_id, source, created_at, updated_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id, source) DO UPDATE SET updated_at = EXCLUDED.updated_at
+                RETURNING job_id, rows_done, status
+            """, (user_id, source, now, now))
+            job_id, rows_done, status = cursor.fetchone()
+        return job_id, rows_done, status == 'done'
+
+    def import_notes_batch(self, job_id, user_id, notes, rows_done):
+        """Insert a batch of notes and record the job's progress in one transaction"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            tags = []
+            for note in notes:
+                self._execute(cursor, 'import_note', (user_id, *note[:7]))
+                note_id = cursor.fetchone()[0]
+                tags.extend((note_id, tag.lower()) for tag in note[7])
+            cursor.executemany("""
+                INSERT INTO tags (note_id, tag) VALUES (%s, %s)
+                ON CONFLICT (note_id, tag) DO NOTHING
+            """, tags)
+            cursor.execute("""
+                UPDATE import_jobs SET rows_done = %s, updated_at = %s WHERE job_id = %s
+            """, (rows_done, epoch_now(), job_id))
+
+    def finish_import_job(self, job_id, user_id):
+        """Mark an import as complete"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE import_jobs SET status = 'done', updated_at = %s WHERE job_id = %s
+            """, (epoch_now(), job_id))
+
+    # Analytics
+    def _scalar(self, sql, params=()):
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def _rows(self, sql, params=()):
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def get_total_users(self):
+        """Get total number of users"""
+        return self._scalar("SELECT COUNT(*) FROM users")
+
+    def get_active_users(self, days=7):
+        """Get active users in last N days; only overlapping partitions are scanned"""
+        now = epoch_now()
+        return self._scalar("""
+            SELECT COUNT(DISTINCT user_id) FROM activity_log
+            WHERE timestamp >= %s AND timestamp < %s
+        """, (now - days * 86400, now + 1))
+
+    def get_total_notes_all_users(self):
+        """Get total notes across all users"""
+        return self._scalar("SELECT COUNT(*) FROM notes")
+
+    def get_notes_by_type_stats(self):
+        """Get note count by message type"""
+        return dict(self._rows("""
+            SELECT message_type, COUNT(*) AS count
+            FROM notes
+            GROUP BY message_type
+            ORDER BY count DESC
+        """))
+
+    def get_top_users(self, limit=10):
+        """Get users with most notes"""
+        return self._rows("""
+            SELECT u.user_id, u.first_name, u.username, c.note_count
+            FROM (
+                SELECT user_id, COUNT(*) AS note_count FROM notes
+                GROUP BY user_id ORDER BY note_count DESC LIMIT %s
+            ) c
+            JOIN users u ON u.user_id = c.user_id
+            ORDER BY c.note_count DESC
+        """, (limit,))
+
+    def get_language_distribution(self):
+        """Get user count by language"""
+        return dict(self._rows("""
+            SELECT language, COUNT(*) AS count
+            FROM users
+            GROUP BY language
+            ORDER BY count DESC
+        """))
+
+    def get_popular_tags_global(self, limit=20):
+        """Get most popular tags across all users"""
+        return self._rows("""
+            SELECT tag, COUNT(*) AS count
+            FROM tags
+            GROUP BY tag
+            ORDER BY count DESC
+            LIMIT %s
+        """, (limit,))
+
+    def _today_start(self):
+        now = epoch_now()
+        return now - now % 86400
+
+    def get_new_users_today(self):
+        """Get number of new users today"""
+        start = self._today_start()
+        return self._scalar("""
+            SELECT COUNT(*) FROM users WHERE created_at >= %s AND created_at < %s
+        """, (start, start + 86400))
+
+    def get_notes_created_today(self):
+        """Get number of notes created today"""
+        start = self._today_start()
+        return self._scalar("""
+            SELECT COUNT(*) FROM notes WHERE created_at >= %s AND created_at < %s
+        """, (start, start + 86400))
+
+    def _daily_counts(self, table, days):
+        since = self._today_start() - days * 86400
+        return self._rows(f"""
+            SELECT to_char(to_timestamp(created_at) AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS day,
+                   COUNT(*)
+            FROM {table}
+            WHERE created_at >= %s
+            GROUP BY day
+            ORDER BY day
+        """, (since,))
+
+    def get_user_growth_stats(self, days=30):
+        """Get (day, new users) for the last N days"""
+        return self._daily_counts('users', days)
+
+    def get_daily_notes_stats(self, days=30):
+        """Get (day, notes created) for the last N days"""
+        return self._daily_counts('notes', days)
+
+    def get_retention_stats(self):
+        """Users seen on more than one day, out of all users with activity
+
+        Computed directly from activity_log, which Postgres can scan in
+        parallel without blocking writers.
+        """
+        active, returning = self._rows("""
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE days > 1)
+            FROM (
+                SELECT user_id, COUNT(DISTINCT timestamp / 86400) AS days
+                FROM activity_log
+                GROUP BY user_id
+            ) per_user
+        """)[0]
+        return {
+            'active_users': active,
+            'returning_users': returning,
+            'retention_rate': round(returning / active * 100, 1) if active else 0.0,
+        }
+
+    def compute_analytics_snapshot(self):
+        """Every /analytics dashboard figure, read in one consistent transaction"""
+        conn = self._getconn()
+        self._local.conn = conn
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            return {
+                'generated_at': epoch_now(),
+                'total_users': self.get_total_users(),
+                'active_7d': self.get_active_users(7),
+                'active_30d': self.get_active_users(30),
+                'total_notes': self.get_total_notes_all_users(),
+                'new_users_today': self.get_new_users_today(),
+                'notes_today': self.get_notes_created_today(),
+                'languages': self.get_language_distribution(),
+                'note_types': self.get_notes_by_type_stats(),
+                'top_users': self.get_top_users(5),
+                'popular_tags': self.get_popular_tags_global(10),
+            }
+        finally:
+            self._local.conn = None
+            try:
+                conn.rollback()
+            finally:
+                self._putconn(conn)
+
+    def save_analytics_snapshot(self, snapshot):
+        """Store a snapshot as the latest one, dropping older ones"""
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO analytics_snapshots (generated_at, data) VALUES (%s, %s)
+                RETURNING snapshot_id
+            """, (snapshot['generated_at'], json.dumps(snapshot, ensure_ascii=False)))
+            snapshot_id = cursor.fetchone()[0]
+            cursor.execute("DELETE FROM analytics_snapshots WHERE snapshot_id < %s", (snapshot_id,))
+
+    def get_analytics_snapshot(self):
+        """The latest stored snapshot, or None"""
+        rows = self._rows("""
+            SELECT data FROM analytics_snapshots ORDER BY snapshot_id DESC LIMIT 1
+        """)
+        return rows[0][0] if rows else None
+
+    def close(self):
+        """Close all pooled connections"""
+        if self.pool:
+            self.pool.closeall()
+            logger.info("Database connection closed")
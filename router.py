@@ -0,0 +1,173 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects buttons whose callback_data is longer than this
+CALLBACK_DATA_LIMIT = 64
+
+# Longest text of an int argument: a signed 64-bit integer
+INT_BYTES = 20
+
+class Text:
+    """str callback argument of at most max_bytes UTF-8 bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+    def __call__(self, value):
+        return value
+
+class Int(Text):
+    """int callback argument of at most max_bytes digits"""
+
+    def __call__(self, value):
+        return int(value)
+
+def arg_bytes(kind):
+    """Longest text an argument of this kind takes in callback data"""
+    return INT_BYTES if kind is int else kind.max_bytes
+
+class Route:
+    """One kind of button: its handler, argument types and counters"""
+
+    def __init__(self, name, handler, args, fallback=None, coalesce=False):
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.fallback = fallback
+        self.coalesce = coalesce
+        self.calls = 0
+        self.errors = 0
+        self.invalid = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+class CallbackRouter:
+    """Dispatch callback data such as "view:12" to handlers by route name
+
+    Callback data is a route name followed by its arguments, separated by
+    ':'. Dispatch is one dict lookup on the name. Arguments are converted
+    with the types the route was registered with. Registration fails when
+    the longest possible data would not fit Telegram's 64-byte limit.
+
+    Buttons sent before the router joined everything with '_' (view_12,
+    confirm_delete_12). Such data is resolved by looking up its leading
+    underscore-separated parts as route names, longest first.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.unknown = 0
+        self._name_parts = 1
+
+    def route(self, name, *args, fallback=None, coalesce=False):
+        """Decorator registering handler(*handler_args, *converted_args)
+
+        args are int, Int(max_bytes) or Text(max_bytes). fallback, if
+        given, is awaited with the handler arguments alone when the data
+        does not parse. coalesce marks routes that only redraw the message,
+        whose click may be dropped when a newer click on it is waiting.
+        """
+        if name in self.routes or ':' in name:
+            raise ValueError(f"Invalid or duplicate route {name!r}")
+        longest = len(name.encode()) + sum(1 + arg_bytes(kind) for kind in args)
+        if longest > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"Callback data of route {name!r} can reach {longest} bytes, "
+                             f"over Telegram's limit of {CALLBACK_DATA_LIMIT}")
+
+        def register(handler):
+            self.routes[name] = Route(name, handler, args, fallback, coalesce)
+            self._name_parts = max(self._name_parts, name.count('_') + 1)
+            return handler
+        return register
+
+    def data(self, name, *values):
+        """Callback data for a route; ValueError if a value does not fit"""
+        route = self.routes[name]
+        if len(values) != len(route.args):
+            raise ValueError(f"Route {name!r} takes {len(route.args)} arguments")
+        for kind, value in zip(route.args, values):
+            if len(str(value).encode()) > arg_bytes(kind):
+                raise ValueError(f"{value!r} is too long for route {name!r}")
+        return ':'.join([name, *map(str, values)])
+
+    def fits(self, name, *values):
+        """Whether data() accepts these values"""
+        try:
+            self.data(name, *values)
+            return True
+        except ValueError:
+            return False
+
+    def resolve(self, data):
+        """(route, raw argument strings) for callback data, (None, None) if unknown"""
+        name, separator, rest = data.partition(':')
+        route = self.routes.get(name)
+        if route is not None:
+            if not route.args:
+                return route, []
+            return route, rest.split(':', len(route.args) - 1) if separator else []
+
+        # Data from before the router, e.g. confirm_delete_12 or notes_older_1_1700000000_8
+        parts = data.split('_', self._name_parts)
+        for count in range(min(len(parts) - 1, self._name_parts), 0, -1):
+            name = '_'.join(parts[:count])
+            route = self.routes.get(name)
+            if route is not None and route.args:
+                return route, data[len(name) + 1:].split('_', len(route.args) - 1)
+        return None, None
+
+    def coalesces(self, data):
+        """Whether the route for callback data only redraws the message"""
+        route, _ = self.resolve(data or '')
+        return route is not None and route.coalesce
+
+    async def dispatch(self, data, *handler_args):
+        """Run the handler for callback data; False if no route matched"""
+        route, raw = self.resolve(data or '')
+        if route is None:
+            self.unknown += 1
+            logger.warning(f"No route for callback data {data!r}")
+            return False
+
+        try:
+            if len(raw) != len(route.args):
+                raise ValueError(f"expected {len(route.args)} arguments, got {len(raw)}")
+            values = [kind(value) for kind, value in zip(route.args, raw)]
+        except ValueError as e:
+            route.invalid += 1
+            logger.warning(f"Bad callback data {data!r} for route {route.name}: {e}")
+            if route.fallback is None:
+                return False
+            handler, values = route.fallback, []
+        else:
+            handler = route.handler
+
+        start = time.perf_counter()
+        try:
+            await handler(*handler_args, *values)
+        except Exception:
+            route.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            route.calls += 1
+            route.seconds += elapsed
+            route.max_seconds = max(route.max_seconds, elapsed)
+        return True
+
+    def stats(self):
+        """Per-route counters for /metrics, busiest first"""
+        rows = [
+            {
+                'name': route.name,
+                'calls': route.calls,
+                'errors': route.errors,
+                'invalid': route.invalid,
+                'avg_ms': route.seconds / route.calls * 1000 if route.calls else 0.0,
+                'max_ms': route.max_seconds * 1000,
+            }
+            for route in self.routes.values()
+        ]
+        return sorted(rows, key=lambda row: row['calls'], reverse=True)
@@ -0,0 +1,209 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Pass as rate_limit_args={'priority': ...}; lower values are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Idle per-chat buckets are dropped once there are more than this many
+MAX_CHAT_BUCKETS = 10000
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``capacity`` saved up"""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is now"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        return self.wait_time(now) == 0.0 and self.tokens >= self.capacity
+
+class SendScheduler(BaseRateLimiter):
+    """Outbound Bot API requests under Telegram's flood limits
+
+    Requests with a chat_id wait for a token from a global bucket
+    (``global_rate`` per second, bursts of ``global_burst``; the default
+    of 1 spaces sends evenly so no second exceeds the rate by more than
+    one) and from their chat's bucket
+    (``chat_rate`` per second in private chats, with bursts of up to
+    ``chat_burst``; ``group_rate`` per minute in groups and channels).
+    Waiting requests are granted in priority order, then arrival order,
+    skipping those whose chat has no token yet, so one busy chat does not
+    hold up the others. A RetryAfter from
+    Telegram pauses every request for the time asked and the request is
+    retried up to ``max_retries`` times. Requests without a chat_id, such
+    as answerCallbackQuery, only honour the pause. ``clock`` is the
+    monotonic time source the buckets are filled by.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1.0, group_rate=20, chat_burst=3,
+                 global_burst=1, max_retries=3, clock=time.monotonic):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate / 60
+        self.max_retries = max_retries
+        self.clock = clock
+        self._global = TokenBucket(global_rate, global_burst, clock())
+        self._chats = {}
+        self._waiting = []
+        self._order = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+        self.retries = 0
+        self.max_waiting = 0
+        self._waited = {}
+
+    async def initialize(self):
+        """Start granting tokens on the running loop"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def shutdown(self):
+        """Stop the scheduler and let waiting requests through"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, _, _, future in self._waiting:
+            if not future.done():
+                future.set_result(None)
+        self._waiting.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        options = rate_limit_args or {}
+        priority = options.get('priority', PRIORITY_INTERACTIVE)
+        max_retries = options.get('max_retries', self.max_retries)
+        chat = self._chat_key(data.get('chat_id'))
+        order = next(self._order)
+
+        for attempt in range(max_retries + 1):
+            if chat is None:
+                await self._pause_wait()
+            else:
+                await self._acquire(priority, order, chat)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                self.retries += 1
+                pause = e.retry_after + 0.1
+                logger.warning(f"{endpoint} hit the flood limit, pausing sends for {pause:.1f}s")
+                self._paused_until = max(self._paused_until, self.clock() + pause)
+
+    def _chat_key(self, chat_id):
+        if chat_id is None:
+            return None
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return str(chat_id)  # @channelusername
+
+    def _bucket(self, chat, now):
+        bucket = self._chats.get(chat)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle(now)}
+            # Negative ids and @usernames are groups and channels
+            private = isinstance(chat, int) and chat > 0
+            if private:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            else:
+                bucket = TokenBucket(self.group_rate, 1, now)
+            self._chats[chat] = bucket
+        return bucket
+
+    async def _pause_wait(self):
+        delay = self._paused_until - self.clock()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, priority, order, chat):
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiting, (priority, order, chat, future))
+        self.max_waiting = max(self.max_waiting, len(self._waiting))
+        self._wakeup.set()
+        start = self.clock()
+        await future
+        waited = self._waited.setdefault(priority, [0, 0.0])
+        waited[0] += 1
+        waited[1] += self.clock() - start
+
+    def _grant(self, now):
+        """Grant every waiting request that has tokens; seconds until the next could"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        delay = None
+        waiting = []
+        for index, entry in enumerate(self._waiting):
+            future = entry[3]
+            if future.done():
+                continue  # cancelled while waiting
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                waiting.extend(self._waiting[index:])
+                delay = wait if delay is None else min(delay, wait)
+                break
+            bucket = self._bucket(entry[2], now)
+            wait = bucket.wait_time(now)
+            if wait > 0:
+                waiting.append(entry)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            self._global.take()
+            bucket.take()
+            future.set_result(None)
+        self._waiting = waiting
+        return delay
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._grant(self.clock())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def metrics(self):
+        """Queue and retry counters for /metrics"""
+        waited = {
+            priority: count and seconds / count * 1000
+            for priority, (count, seconds) in self._waited.items()
+        }
+        return {
+            'waiting': len(self._waiting),
+            'max_waiting': self.max_waiting,
+            'sent': self.sent,
+            'retries': self.retries,
+            'paused': max(0.0, self._paused_until - self.clock()),
+            'interactive_wait_ms': waited.get(PRIORITY_INTERACTIVE, 0.0),
+            'background_wait_ms': waited.get(PRIORITY_BACKGROUND, 0.0),
+        }
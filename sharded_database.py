@@ -0,0 +1,579 @@
+import os
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from database import Database
+from migrations import activity_partition_name
+from storage import StorageBackend, epoch_now
+
+logger = logging.getLogger(__name__)
+
+def jump_hash(key, buckets):
+    """Shard in range(buckets) for an integer key (Lamping & Veach jump hash)
+
+    Stable for a given shard count, and going from N to N+1 shards moves
+    only about 1/(N+1) of the keys, all of them onto the new shard.
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def shard_file(database_file, index):
+    """File of one shard: shard 0 is database_file itself, then notes.shard1.db, ..."""
+    if index == 0:
+        return database_file
+    root, ext = os.path.splitext(database_file)
+    return f"{root}.shard{index}{ext}"
+
+def merge_counts(dicts):
+    """Sum {key: count} dicts, largest count first"""
+    total = Counter()
+    for counts in dicts:
+        total.update(counts)
+    return dict(total.most_common())
+
+def merge_daily(results):
+    """Sum [(day, count)] lists into one list ordered by day"""
+    total = Counter()
+    for rows in results:
+        for day, count in rows:
+            total[day] += count
+    return sorted(total.items())
+
+class ShardedDatabase(StorageBackend):
+    """User-sharded SQLite storage over several database files
+
+    Each user lives on one shard, picked by jump_hash(user_id). All of a
+    user's notes, tags and activity go to that shard's Database, and each
+    shard has its own writer, so writes for users on different shards
+    run in parallel (AsyncDatabase gives every shard a writer thread).
+
+    Queries across all users run on every shard in parallel and the
+    per-shard results are merged. Users never span shards, so per-user
+    counts add up exactly.
+
+    After changing the shard count, restart the bot and run rebalance()
+    (``manage.py rebalance-shards``) to move existing users to their new
+    shard. Until then, moved users only see notes written after the change.
+    """
+
+    supports_backup = True
+    supports_archive = True
+
+    def __init__(self, database_file='notes.db', shards=2, profile_cache_size=10000,
+                 profile_cache_ttl=600):
+        super().__init__(profile_cache_size, profile_cache_ttl)
+        # Profiles are cached here, in front of the router; the shards'
+        # own caches only need to hold the odd entry
+        self.shards = [
+            Database(shard_file(database_file, index), profile_cache_size=1,
+                     profile_cache_ttl=profile_cache_ttl)
+            for index in range(shards)
+        ]
+        self.write_lanes = len(self.shards)
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.shards), thread_name_prefix='db-shard'
+        )
+
+    def shard_index(self, user_id):
+        """Index of the shard that holds a user"""
+        return jump_hash(user_id, len(self.shards))
+
+    def shard(self, user_id):
+        """Database that holds a user"""
+        return self.shards[self.shard_index(user_id)]
+
+    def write_lane(self, user_id):
+        """Writes for a user go through their shard's lane"""
+        return self.shard_index(user_id) if user_id is not None else 0
+
+    def _gather(self, name, *args):
+        """Call a method on every shard in parallel; results in shard order"""
+        futures = [self._executor.submit(getattr(shard, name), *args)
+                   for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def create_tables(self):
+        """Create or upgrade the schema on every shard"""
+        self._gather('create_tables')
+
+    # Users
+    def create_user(self, user_id, username, first_name, language='en'):
+        """Insert the user row unless it exists, bypassing the profile cache"""
+        self.shard(user_id).create_user(user_id, username, first_name, language)
+        self.profiles.pop(user_id)
+
+    def set_user_language(self, user_id, language):
+        """Set user's preferred language"""
+        self.shard(user_id).set_user_language(user_id, language)
+        self.profiles.pop(user_id)
+
+    def load_user_profile(self, user_id):
+        """Read user's profile from their shard and cache it"""
+        profile = self.shard(user_id).load_user_profile(user_id)
+        self.profiles.set(user_id, profile)
+        return profile
+
+    # Activity
+    def log_activity_batch(self, events):
+        """Write each user's events to their shard, shards in parallel"""
+        by_shard = {}
+        for event in events:
+            by_shard.setdefault(self.write_lane(event[0]), []).append(event)
+        futures = [self._executor.submit(self.shards[index].log_activity_batch, shard_events)
+                   for index, shard_events in by_shard.items()]
+        for future in futures:
+            future.result()
+
+    # Notes
+    def save_note(self, user_id, content, message_type='text',
+                  file_id=None, source_chat_id=None, source_chat_title=None):
+        """Save a new note on the user's shard and return its id
+
+        Note ids are only unique within a shard, so every note operation
+        takes the owner's user_id too.
+        """
+        return self.shard(user_id).save_note(user_id, content, message_type, file_id,
+                                             source_chat_id, source_chat_title)
+
+    def add_tag(self, note_id, tag, user_id):
+        """Add a tag to a user's note"""
+        self.shard(user_id).add_tag(note_id, tag, user_id)
+
+    def get_recent_notes(self, user_id, limit=5, offset=0):
+        """Newest notes as (note_id, content, created_at, pinned, message_type, file_id, tags)"""
+        return self.shard(user_id).get_recent_notes(user_id, limit, offset)
+
+    def get_notes_page(self, user_id, limit=5, cursor=None, direction='older'):
+        """One keyset page of notes: (notes, has_older, has_newer)"""
+        return self.shard(user_id).get_notes_page(user_id, limit, cursor, direction)
+
+    def get_note_count(self, user_id):
+        """Get total note count for user"""
+        return self.shard(user_id).get_note_count(user_id)
+
+    def get_note(self, note_id, user_id):
+        """(content, created_at, pinned, tags, message_type, file_id) or None"""
+        return self.shard(user_id).get_note(note_id, user_id)
+
+    def toggle_pin(self, note_id, user_id):
+        """Toggle pin status of a user's note"""
+        self.shard(user_id).toggle_pin(note_id, user_id)
+
+    def delete_note(self, note_id, user_id):
+        """Delete a user's note and its tags"""
+        self.shard(user_id).delete_note(note_id, user_id)
+
+    def search_notes(self, user_id, query, mode='fts'):
+        """Ranked (note_id, content, created_at, snippet) matches"""
+        return self.shard(user_id).search_notes(user_id, query, mode)
+
+    def search_by_tag(self, user_id, tag):
+        """Newest (note_id, content, created_at) notes with a tag"""
+        return self.shard(user_id).search_by_tag(user_id, tag)
+
+    def search_this_week(self, user_id):
+        """(note_id, content, created_at) notes from the last 7 days"""
+        return self.shard(user_id).search_this_week(user_id)
+
+    def get_pinned_notes(self, user_id):
+        """Pinned (note_id, content, created_at, tags), newest first"""
+        return self.shard(user_id).get_pinned_notes(user_id)
+
+    def get_random_note(self, user_id, exclude=()):
+        """Uniformly random (note_id, content, tags), avoiding exclude if possible"""
+        return self.shard(user_id).get_random_note(user_id, exclude)
+
+    def get_popular_tags(self, user_id, limit=6):
+        """User's most used tags"""
+        return self.shard(user_id).get_popular_tags(user_id, limit)
+
+    def get_user_stats(self, user_id):
+        """Totals, first note date and top tags for the 📊 Stats screen"""
+        return self.shard(user_id).get_user_stats(user_id)
+
+    # Export and import
+    def iter_notes_export(self, user_id, chunk_size=500):
+        """Yield all of a user's notes, oldest first"""
+        return self.shard(user_id).iter_notes_export(user_id, chunk_size)
+
+    def start_import_job(self, user_id, source):
+        """(job_id, rows_done, finished) for importing source, resuming a previous run"""
+        return self.shard(user_id).start_import_job(user_id, source)
+
+    def import_notes_batch(self, job_id, user_id, notes, rows_done):
+        """Insert a batch of notes and record the job's progress in one transaction"""
+        self.shard(user_id).import_notes_batch(job_id, user_id, notes, rows_done)
+
+    def finish_import_job(self, job_id, user_id):
+        """Mark an import as complete"""
+        self.shard(user_id).finish_import_job(job_id, user_id)
+
+    # Analytics, gathered from every shard
+    def get_total_users(self):
+        """Get total number of users"""
+        return sum(self._gather('get_total_users'))
+
+    def get_active_users(self, days=7):
+        """Get active users in last N days"""
+        return sum(self._gather('get_active_users', days))
+
+    def get_total_notes_all_users(self):
+        """Get total notes across all users"""
+        return sum(self._gather('get_total_notes_all_users'))
+
+    def get_notes_by_type_stats(self):
+        """Get note count by message type"""
+        return merge_counts(self._gather('get_notes_by_type_stats'))
+
+    def get_top_users(self, limit=10):
+        """(user_id, first_name, username, note_count) with most notes
+
+        Every shard's top ``limit`` is enough: a user's count is never
+        split between shards.
+        """
+        rows = [row for result in self._gather('get_top_users', limit) for row in result]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows[:limit]
+
+    def get_language_distribution(self):
+        """Get user count by language"""
+        return merge_counts(self._gather('get_language_distribution'))
+
+    def get_popular_tags_global(self, limit=20):
+        """Get most popular tags across all users
+
+        The same tag is counted on several shards, so a shard's top list
+        is not enough; every shard returns all its tag counts (SQLite
+        treats a negative LIMIT as no limit).
+        """
+        counts = Counter()
+        for rows in self._gather('get_popular_tags_global', -1):
+            for tag, count in rows:
+                counts[tag] += count
+        return counts.most_common(limit)
+
+    def get_new_users_today(self):
+        """Get number of new users today"""
+        return sum(self._gather('get_new_users_today'))
+
+    def get_notes_created_today(self):
+        """Get number of notes created today"""
+        return sum(self._gather('get_notes_created_today'))
+
+    def get_user_growth_stats(self, days=30):
+        """Get (day, new users) for the last N days"""
+        return merge_daily(self._gather('get_user_growth_stats', days))
+
+    def get_daily_notes_stats(self, days=30):
+        """Get (day, notes created) for the last N days"""
+        return merge_daily(self._gather('get_daily_notes_stats', days))
+
+    def get_daily_notes_by_type(self, days=30):
+        """Get {day: {message_type: notes created}} for the last N days"""
+        result = {}
+        for shard_result in self._gather('get_daily_notes_by_type', days):
+            for day, types in shard_result.items():
+                day_types = result.setdefault(day, Counter())
+                day_types.update(types)
+        return {day: dict(result[day]) for day in sorted(result)}
+
+    def get_retention_stats(self):
+        """Users seen on more than one day, out of all users with activity"""
+        results = self._gather('get_retention_stats')
+        active = sum(result['active_users'] for result in results)
+        returning = sum(result['returning_users'] for result in results)
+        return {
+            'active_users': active,
+            'returning_users': returning,
+            'retention_rate': round(returning / active * 100, 1) if active else 0.0,
+        }
+
+    def compute_analytics_snapshot(self):
+        """Merge of every shard's snapshot, each read in one transaction"""
+        snapshots = self._gather('compute_analytics_snapshot')
+        merged = {'generated_at': epoch_now()}
+        for key in ('total_users', 'active_7d', 'active_30d', 'total_notes',
+                    'new_users_today', 'notes_today'):
+            merged[key] = sum(snapshot[key] for snapshot in snapshots)
+        merged['languages'] = merge_counts(snapshot['languages'] for snapshot in snapshots)
+        merged['note_types'] = merge_counts(snapshot['note_types'] for snapshot in snapshots)
+        top_users = [row for snapshot in snapshots for row in snapshot['top_users']]
+        merged['top_users'] = sorted(top_users, key=lambda row: row[3], reverse=True)[:5]
+        merged['popular_tags'] = self.get_popular_tags_global(10)
+        return merged
+
+    def save_analytics_snapshot(self, snapshot):
+        """Store a snapshot as the latest one, on shard 0"""
+        self.shards[0].save_analytics_snapshot(snapshot)
+
+    def get_analytics_snapshot(self):
+        """The latest stored snapshot, or None"""
+        return self.shards[0].get_analytics_snapshot()
+
+    # Maintenance
+    def rebuild_search_index(self):
+        """Rebuild the full-text index of every shard"""
+        return any(self._gather('rebuild_search_index'))
+
+    def check_query_plans(self):
+        """Hot queries whose plan falls back to a scan or a temp sort, per shard"""
+        problems = {}
+        for index, shard_problems in enumerate(self._gather('check_query_plans')):
+            for name, plan in shard_problems.items():
+                problems[f"shard{index}:{name}"] = plan
+        return problems
+
+    def verify_user_stats(self, repair=False):
+        """Ids of users whose materialized stats drifted, on any shard"""
+        return [user_id for result in self._gather('verify_user_stats', repair)
+                for user_id in result]
+
+    def refresh_rollups(self):
+        """Fold new activity into every shard's rollups; returns events processed"""
+        return sum(self._gather('refresh_rollups'))
+
+    def archive_activity(self, archive_dir, keep_months=3):
+        """Archive and drop old activity; shard N archives to archive_dir/shardN"""
+        archived = []
+        for index, shard in enumerate(self.shards):
+            shard_dir = archive_dir if index == 0 else os.path.join(archive_dir, f"shard{index}")
+            archived.extend(shard.archive_activity(shard_dir, keep_months))
+        return archived
+
+    def vacuum(self):
+        """Return free space to the operating system"""
+        for shard in self.shards:
+            shard.vacuum()
+
+    def backup(self, backup_dir, compress=True, keep=7):
+        """Back up every shard, one after another to spread the I/O"""
+        results = []
+        for shard in self.shards:
+            results.extend(shard.backup(backup_dir, compress, keep))
+        return results
+
+    def misplaced_users(self):
+        """[(user_id, current shard, target shard)] for users on the wrong shard"""
+        misplaced = []
+        for index, shard in enumerate(self.shards):
+            cursor = shard.pool.reader().cursor()
+            cursor.execute("SELECT user_id FROM users UNION SELECT DISTINCT user_id FROM notes")
+            for (user_id,) in cursor.fetchall():
+                if user_id is not None and self.shard_index(user_id) != index:
+                    misplaced.append((user_id, index, self.shard_index(user_id)))
+        return misplaced
+
+    def rebalance(self, dry_run=False):
+        """Move users whose shard changed with the shard count
+
+        Returns [(user_id, source, target, notes moved)]. Notes get new ids
+        on their new shard. A user's live activity and rollups move with
+        them, so counts of distinct users add up across shards again.
+        Activity in archived months stays in the source shard's archives.
+
+        Safe to run while the bot runs with the new shard count: each move
+        holds the source shard's write lock from its snapshot to its delete.
+        """
+        misplaced = self.misplaced_users()
+        if misplaced and not dry_run:
+            # Most of the rollup work is done before any lock is held
+            self.refresh_rollups()
+        moved = []
+        for user_id, source, target in misplaced:
+            notes = 0 if dry_run else self._move_user(user_id, source, target)
+            moved.append((user_id, source, target, notes))
+        return moved
+
+    def _move_user(self, user_id, source, target):
+        """Copy a user's rows to target, then delete them from source"""
+        source_db, target_db = self.shards[source], self.shards[target]
+
+        with source_db.pool.writer() as source_conn:
+            # Taking the write lock up front keeps every writer, in this
+            # process or the bot's, out until the delete commits
+            source_conn.execute("BEGIN IMMEDIATE")
+            source_db.refresh_rollups()
+            snapshot = self._read_user(source_db, source_conn.cursor(), user_id)
+
+            with target_db.pool.writer() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT 1 FROM shard_moves WHERE user_id = ? AND source_shard = ?
+                """, (user_id, source))
+                if cursor.fetchone() is None:
+                    target_db.refresh_rollups()
+                    self._copy_user(target_db, cursor, user_id, snapshot)
+                    cursor.execute("""
+                        INSERT INTO shard_moves (user_id, source_shard, moved_at, notes)
+                        VALUES (?, ?, ?, ?)
+                    """, (user_id, source, epoch_now(), len(snapshot['notes'])))
+
+            self._delete_user(source_conn.cursor(), user_id, snapshot)
+
+        with target_db.pool.writer() as conn:
+            conn.execute("""
+                DELETE FROM shard_moves WHERE user_id = ? AND source_shard = ?
+            """, (user_id, source))
+
+        for shard in (source_db, target_db, self):
+            shard.profiles.pop(user_id)
+        notes = len(snapshot['notes'])
+        logger.info(f"User {user_id} moved from shard {source} to {target} ({notes} notes)")
+        return notes
+
+    def _read_user(self, source_db, cursor, user_id):
+        """Everything stored for a user on a shard, read in the caller's transaction"""
+        cursor.execute("""
+            SELECT username, first_name, language, created_at FROM users WHERE user_id = ?
+        """, (user_id,))
+        user = cursor.fetchone()
+        cursor.execute("""
+            SELECT note_id, content, message_type, file_id, created_at, pinned,
+                   source_chat_id, source_chat_title
+            FROM notes WHERE user_id = ? ORDER BY note_id
+        """, (user_id,))
+        notes = cursor.fetchall()
+        cursor.execute("""
+            SELECT t.note_id, t.tag FROM tags t
+            JOIN notes n ON n.note_id = t.note_id
+            WHERE n.user_id = ?
+        """, (user_id,))
+        tags = cursor.fetchall()
+
+        activity = {}
+        for month, name in source_db._live_activity_partitions(cursor):
+            cursor.execute(f"""
+                SELECT user_id, action, details, timestamp FROM {name}
+                WHERE user_id = ? ORDER BY log_id
+            """, (user_id,))
+            rows = cursor.fetchall()
+            if rows:
+                activity[month] = rows
+
+        # user_activity bounds the days, so the (day, user_id) key is
+        # searched by range instead of scanned
+        cursor.execute("""
+            SELECT d.day FROM user_activity u
+            JOIN daily_active_users d
+              ON d.day BETWEEN u.first_day AND u.last_day AND d.user_id = u.user_id
+            WHERE u.user_id = ?
+        """, (user_id,))
+        active_days = [row[0] for row in cursor.fetchall()]
+
+        return {'user': user, 'notes': notes, 'tags': tags,
+                'activity': activity, 'active_days': active_days}
+
+    def _copy_user(self, target_db, cursor, user_id, snapshot):
+        """Insert a user's rows on the target shard without counting them twice"""
+        # The daily_stats triggers count every insert as a new user or
+        # note on its creation day. The source shard already counted
+        # these, so the increments are taken back.
+        user = snapshot['user']
+        if user is not None:
+            # The bot may already have created the user here with default
+            # settings; the source row wins, except for the earlier date
+            cursor.execute("SELECT created_at FROM users WHERE user_id = ?", (user_id,))
+            existing = cursor.fetchone()
+            counted_at = existing[0] if existing else user[3]
+            cursor.execute("""
+                INSERT INTO users (user_id, username, first_name, language, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    language = excluded.language,
+                    created_at = MIN(created_at, excluded.created_at)
+            """, (user_id, *user))
+            cursor.execute("""
+                UPDATE daily_stats SET new_users = new_users - 1
+                WHERE day = DATE(COALESCE(?, strftime('%s', 'now')), 'unixepoch')
+            """, (counted_at,))
+
+        notes = snapshot['notes']
+        note_ids = {}
+        for note in notes:
+            cursor.execute("""
+                INSERT INTO notes (user_id, content, message_type, file_id, created_at,
+                                   pinned, source_chat_id, source_chat_title)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, *note[1:]))
+            note_ids[note[0]] = cursor.lastrowid
+
+        cursor.executemany("""
+            INSERT OR IGNORE INTO tags (note_id, tag) VALUES (?, ?)
+        """, [(note_ids[note_id], tag) for note_id, tag in snapshot['tags']])
+
+        days = [(note[4],) for note in notes]
+        cursor.executemany("""
+            UPDATE daily_stats SET notes_created = notes_created - 1
+            WHERE day = DATE(COALESCE(?, strftime('%s', 'now')), 'unixepoch')
+        """, days)
+        cursor.executemany("""
+            UPDATE daily_notes_by_type SET count = count - 1
+            WHERE day = DATE(COALESCE(?, strftime('%s', 'now')), 'unixepoch')
+              AND message_type = COALESCE(?, 'text')
+        """, [(note[4], note[2]) for note in notes])
+
+        # Both shards' rollups are current, so the moved events are
+        # already counted: the watermark skips over them
+        for month, rows in snapshot['activity'].items():
+            name = target_db._activity_partition(cursor, month)
+            cursor.executemany(f"""
+                INSERT INTO {name} (user_id, action, details, timestamp)
+                VALUES (?, ?, ?, ?)
+            """, rows)
+            cursor.execute(f"""
+                UPDATE rollup_watermarks SET last_id = (SELECT MAX(log_id) FROM {name})
+                WHERE source = ?
+            """, (name,))
+
+        # Daily actions are totals and stay on the source; the active
+        # days move, and a day the user was already active here is
+        # counted once
+        new_days = []
+        for day in snapshot['active_days']:
+            cursor.execute("""
+                INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (?, ?)
+            """, (day, user_id))
+            if cursor.rowcount:
+                new_days.append(day)
+        cursor.executemany("""
+            INSERT INTO daily_stats (day, active_users) VALUES (?, 1)
+            ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1
+        """, [(day,) for day in new_days])
+        if new_days:
+            cursor.execute("""
+                INSERT INTO user_activity (user_id, first_day, last_day, active_days)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    first_day = MIN(first_day, excluded.first_day),
+                    last_day = MAX(last_day, excluded.last_day),
+                    active_days = active_days + excluded.active_days
+            """, (user_id, min(new_days), max(new_days), len(new_days)))
+
+    def _delete_user(self, cursor, user_id, snapshot):
+        """Delete a moved user's rows from the source shard"""
+        cursor.execute("DELETE FROM notes WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        for month in snapshot['activity']:
+            cursor.execute(f"""
+                DELETE FROM {activity_partition_name(month)} WHERE user_id = ?
+            """, (user_id,))
+        cursor.executemany("""
+            UPDATE daily_stats SET active_users = active_users - 1 WHERE day = ?
+        """, [(day,) for day in snapshot['active_days']])
+        cursor.executemany("""
+            DELETE FROM daily_active_users WHERE day = ? AND user_id = ?
+        """, [(day, user_id) for day in snapshot['active_days']])
+        cursor.execute("DELETE FROM user_activity WHERE user_id = ?", (user_id,))
+
+    def close(self):
+        """Close every shard"""
+        self._executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
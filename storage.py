@@ -0,0 +1,358 @@
+import time
+from abc import ABC, abstractmethod
+from cache import LRUCache
+
+# Around the matched words in search_notes() snippets. The snippet is plain
+# note text; the bot shortens and escapes it before turning these into bold.
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def epoch_now():
+    """Current time as integer Unix epoch seconds, the stored timestamp format"""
+    return int(time.time())
+
+class StorageBackend(ABC):
+    """Everything the bot, analytics and maintenance tools need from storage
+
+    Backends implement the abstract methods with the same argument and
+    return shapes as the SQLite Database. The user profile cache and the
+    helpers built on it are shared here.
+
+    Maintenance operations that only make sense for one engine (query
+    plan checks, rollups, archiving, VACUUM, online backup) have defaults
+    that do nothing; supports_backup and supports_archive tell callers
+    whether the last three do anything.
+    """
+
+    # Methods that modify data. AsyncDatabase runs them on a writer
+    # thread; every other method is treated as a read.
+    WRITE_METHODS = frozenset({
+        'create_tables',
+        'rebuild_search_index',
+        'ensure_user',
+        'create_user',
+        'set_user_language',
+        'log_user_activity',
+        'log_activity_batch',
+        'refresh_rollups',
+        'archive_activity',
+        'vacuum',
+        'save_analytics_snapshot',
+        'save_note',
+        'add_tag',
+        'toggle_pin',
+        'delete_note',
+        'start_import_job',
+        'import_notes_batch',
+        'finish_import_job',
+    })
+
+    def __init__(self, profile_cache_size=10000, profile_cache_ttl=600):
+        # Language/existence of users, read on every update
+        self.profiles = LRUCache(maxsize=profile_cache_size, ttl=profile_cache_ttl)
+
+    # Independent writers. AsyncDatabase has one writer thread per lane
+    # and sends each write to the lane of the user_id it is called with.
+    write_lanes = 1
+
+    # Online backup, and activity archives with VACUUM, work on the SQLite
+    # files; other engines leave them to their own tools
+    supports_backup = False
+    supports_archive = False
+
+    def write_lane(self, user_id):
+        """Lane for writes on behalf of a user; writes without one use lane 0"""
+        return 0
+
+    # Users
+    def ensure_user(self, user_id, username, first_name, language='en'):
+        """Create user if doesn't exist"""
+        profile = self.profiles.get(user_id)
+        if profile is None or not profile['exists']:
+            self.create_user(user_id, username, first_name, language)
+
+    def get_user_profile(self, user_id):
+        """Get user's cached profile: exists, language and username"""
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            profile = self.load_user_profile(user_id)
+        return profile
+
+    def get_user_language(self, user_id):
+        """Get user's preferred language"""
+        return self.get_user_profile(user_id)['language']
+
+    def _cache_profile(self, user_id, row):
+        """Cache the profile built from a (language, username) row or None"""
+        profile = {
+            'exists': row is not None,
+            'language': row[0] if row and row[0] else 'en',
+            'username': row[1] if row else None,
+        }
+        self.profiles.set(user_id, profile)
+        return profile
+
+    def _cache_language(self, user_id, language, updated):
+        """Keep a cached profile in step with a language change"""
+        profile = self.profiles.get(user_id)
+        if updated and profile is not None:
+            self.profiles.set(user_id, dict(profile, language=language))
+        else:
+            self.profiles.pop(user_id)
+
+    @abstractmethod
+    def create_tables(self):
+        """Create the schema or upgrade it to the latest version"""
+
+    @abstractmethod
+    def create_user(self, user_id, username, first_name, language='en'):
+        """Insert the user row unless it exists, bypassing the profile cache"""
+
+    @abstractmethod
+    def set_user_language(self, user_id, language):
+        """Set user's preferred language"""
+
+    @abstractmethod
+    def load_user_profile(self, user_id):
+        """Read user's profile from the database and cache it"""
+
+    # Activity
+    def log_user_activity(self, user_id, action, details=None):
+        """Log user activity for analytics"""
+        self.log_activity_batch([(user_id, action, details, epoch_now())])
+
+    @abstractmethod
+    def log_activity_batch(self, events):
+        """Write many (user_id, action, details, timestamp) events in one transaction"""
+
+    # Notes
+    @abstractmethod
+    def save_note(self, user_id, content, message_type='text',
+                  file_id=None, source_chat_id=None, source_chat_title=None):
+        """Save a new note and return its id"""
+
+    @abstractmethod
+    def add_tag(self, note_id, tag, user_id):
+        """Add a tag to a user's note"""
+
+    @abstractmethod
+    def get_recent_notes(self, user_id, limit=5, offset=0):
+        """Newest notes as (note_id, content, created_at, pinned, message_type, file_id, tags)"""
+
+    @abstractmethod
+    def get_notes_page(self, user_id, limit=5, cursor=None, direction='older'):
+        """One keyset page of notes: (notes, has_older, has_newer)"""
+
+    @abstractmethod
+    def get_note_count(self, user_id):
+        """Get total note count for user"""
+
+    @abstractmethod
+    def get_note(self, note_id, user_id):
+        """(content, created_at, pinned, tags, message_type, file_id) or None"""
+
+    @abstractmethod
+    def toggle_pin(self, note_id, user_id):
+        """Toggle pin status of a user's note"""
+
+    @abstractmethod
+    def delete_note(self, note_id, user_id):
+        """Delete a user's note and its tags"""
+
+    @abstractmethod
+    def search_notes(self, user_id, query, mode='fts'):
+        """Ranked (note_id, content, created_at, snippet) matches
+
+        The snippet is an excerpt of the note with matched words between
+        SNIPPET_START and SNIPPET_END.
+        """
+
+    @abstractmethod
+    def search_by_tag(self, user_id, tag):
+        """Newest (note_id, content, created_at) notes with a tag"""
+
+    @abstractmethod
+    def search_this_week(self, user_id):
+        """(note_id, content, created_at) notes from the last 7 days"""
+
+    @abstractmethod
+    def get_pinned_notes(self, user_id):
+        """Pinned (note_id, content, created_at, tags), newest first"""
+
+    @abstractmethod
+    def get_random_note(self, user_id, exclude=()):
+        """Uniformly random (note_id, content, tags), avoiding exclude if possible"""
+
+    @abstractmethod
+    def get_popular_tags(self, user_id, limit=6):
+        """User's most used tags"""
+
+    @abstractmethod
+    def get_user_stats(self, user_id):
+        """Totals, first note date and top tags for the 📊 Stats screen"""
+
+    # Export and import
+    @abstractmethod
+    def iter_notes_export(self, user_id, chunk_size=500):
+        """Yield (note_id, content, message_type, file_id, created_at, pinned,
+        source_chat_id, source_chat_title, tags) for every note, oldest first"""
+
+    @abstractmethod
+    def start_import_job(self, user_id, source):
+        """(job_id, rows_done, finished) for importing source, resuming a previous run"""
+
+    @abstractmethod
+    def import_notes_batch(self, job_id, user_id, notes, rows_done):
+        """Insert a batch of notes and record the job's progress in one transaction"""
+
+    @abstractmethod
+    def finish_import_job(self, job_id, user_id):
+        """Mark an import as complete"""
+
+    def import_notes(self, user_id, notes, source, batch_size=500, progress=None):
+        """Import notes from an iterable in bounded transactions
+
+        notes yields (content, message_type, file_id, created_at, pinned,
+        source_chat_id, source_chat_title, tags). Every batch_size notes
+        are written in one transaction together with the job's progress,
+        so importing the same source again after an interruption skips
+        the rows already committed. progress(rows_done) is called after
+        each batch.
+
+        Returns (imported, resumed_from), or None if source was already
+        imported completely.
+        """
+        job_id, rows_done, finished = self.start_import_job(user_id, source)
+        if finished:
+            return None
+
+        resumed_from = rows_done
+        batch = []
+        for position, note in enumerate(notes):
+            if position < resumed_from:
+                continue
+            batch.append(note)
+            if len(batch) == batch_size:
+                rows_done += len(batch)
+                self.import_notes_batch(job_id, user_id, batch, rows_done)
+                batch = []
+                if progress:
+                    progress(rows_done)
+        if batch:
+            rows_done += len(batch)
+            self.import_notes_batch(job_id, user_id, batch, rows_done)
+        self.finish_import_job(job_id, user_id)
+        return rows_done - resumed_from, resumed_from
+
+    # Analytics
+    @abstractmethod
+    def get_total_users(self):
+        """Get total number of users"""
+
+    @abstractmethod
+    def get_active_users(self, days=7):
+        """Get active users in last N days"""
+
+    @abstractmethod
+    def get_total_notes_all_users(self):
+        """Get total notes across all users"""
+
+    @abstractmethod
+    def get_notes_by_type_stats(self):
+        """Get note count by message type"""
+
+    @abstractmethod
+    def get_top_users(self, limit=10):
+        """(user_id, first_name, username, note_count) with most notes"""
+
+    @abstractmethod
+    def get_language_distribution(self):
+        """Get user count by language"""
+
+    @abstractmethod
+    def get_popular_tags_global(self, limit=20):
+        """Get most popular tags across all users"""
+
+    @abstractmethod
+    def get_new_users_today(self):
+        """Get number of new users today"""
+
+    @abstractmethod
+    def get_notes_created_today(self):
+        """Get number of notes created today"""
+
+    @abstractmethod
+    def get_user_growth_stats(self, days=30):
+        """Get (day, new users) for the last N days"""
+
+    @abstractmethod
+    def get_daily_notes_stats(self, days=30):
+        """Get (day, notes created) for the last N days"""
+
+    @abstractmethod
+    def get_retention_stats(self):
+        """Users seen on more than one day, out of all users with activity"""
+
+    @abstractmethod
+    def compute_analytics_snapshot(self):
+        """Every /analytics dashboard figure, read in one consistent transaction"""
+
+    @abstractmethod
+    def save_analytics_snapshot(self, snapshot):
+        """Store a snapshot as the latest one"""
+
+    @abstractmethod
+    def get_analytics_snapshot(self):
+        """The latest stored snapshot, or None"""
+
+    # Maintenance
+    def rebuild_search_index(self):
+        """Rebuild the full-text index; False when there is nothing to rebuild"""
+        return False
+
+    def check_query_plans(self):
+        """Hot queries whose plan falls back to a scan or a temp sort"""
+        return {}
+
+    def verify_user_stats(self, repair=False):
+        """Ids of users whose materialized stats drifted"""
+        return []
+
+    def refresh_rollups(self):
+        """Fold new activity into precomputed analytics; returns events processed"""
+        return 0
+
+    def archive_activity(self, archive_dir, keep_months=3):
+        """Archive and drop old activity; returns [(month, rows, path)]"""
+        return []
+
+    def vacuum(self):
+        """Return free space to the operating system"""
+
+    def backup(self, backup_dir, compress=True, keep=7):
+        """Online backup into backup_dir; returns stats for each database file"""
+        return []
+
+    @abstractmethod
+    def close(self):
+        """Release all connections"""
+
+def open_storage(database_file='notes.db', database_url=None, pool_size=10, shards=1,
+                 **options):
+    """Postgres when a postgres:// URL is configured, SQLite otherwise
+
+    pool_size only applies to Postgres. With shards > 1, SQLite users are
+    spread over that many files, each with its own writer.
+    """
+    if database_url and database_url.startswith(('postgres://', 'postgresql://')):
+        from postgres_database import PostgresDatabase
+        return PostgresDatabase(database_url, pool_size=pool_size, **options)
+    if database_url:
+        raise ValueError(f"Unsupported DATABASE_URL scheme: {database_url.split(':', 1)[0]}")
+
+    if shards > 1:
+        from sharded_database import ShardedDatabase
+        return ShardedDatabase(database_file, shards, **options)
+
+    from database import Database
+    return Database(database_file, **options)
@@ -0,0 +1,13 @@
+"""AsyncDatabase data versions, the keys of cached renders"""
+from async_database import AsyncDatabase
+
+def test_data_versions_bounded_and_never_reused(tmp_path):
+    db = AsyncDatabase(str(tmp_path / 'notes.db'), version_cache_size=3)
+    seen = {}
+    for user_id in [1, 2, 3, 4, 1, 5, 6, 2, 7, 1]:
+        seen.setdefault(user_id, set()).add(db.data_version(user_id))
+        db.bump_version(user_id)
+        # A write always yields a version this user's views were never keyed by
+        assert db.data_version(user_id) not in seen[user_id]
+    assert len(db._versions) == 3
+    db.close()
@@ -0,0 +1,66 @@
+"""SQL statements issued per rendered screen, as a guard against N+1 queries
+
+Each screen the bot renders reads a fixed number of statements however
+many notes and tags the user has. Statements are counted on the calling
+thread's read connection with set_trace_callback; the statements FTS5
+runs internally against its shadow tables are not counted.
+"""
+import pytest
+
+from database import Database
+
+NOTES = 60
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'notes.db'))
+    db.ensure_user(1, 'user1', 'User 1')
+    for i in range(NOTES):
+        note_id = db.save_note(1, f'meeting notes {i}')
+        db.add_tag(note_id, f'tag{i % 7}', 1)
+        db.add_tag(note_id, 'work', 1)
+        if i % 3 == 0:
+            db.toggle_pin(note_id, 1)
+    yield db
+    db.close()
+
+@pytest.fixture
+def statements(db):
+    statements = []
+
+    def trace(statement):
+        # FTS5 shadow table reads are traced as nested statements or name
+        # their schema explicitly; the bot's own SQL does neither
+        if not statement.startswith('--') and "'main'." not in statement:
+            statements.append(statement)
+
+    db.pool.reader().set_trace_callback(trace)
+    yield statements
+    db.pool.reader().set_trace_callback(None)
+
+def newest_cursor(db):
+    note = db.get_recent_notes(1, limit=1)[0]
+    return note[2], note[0]
+
+# Screen: what it reads, and the most statements that may take
+RENDERS = {
+    'notes page': (lambda db: (db.get_notes_page(1, limit=5), db.get_note_count(1)), 2),
+    # Includes the lookup of the cursor itself
+    'older notes page': (lambda db: (db.get_notes_page(1, limit=5, cursor=newest_cursor(db)),
+                                     db.get_note_count(1)), 3),
+    'pinned notes': (lambda db: db.get_pinned_notes(1), 1),
+    'note view': (lambda db: db.get_note(NOTES // 2, 1), 1),
+    'random note': (lambda db: db.get_random_note(1, exclude=(1, 2, 3)), 1),
+    'stats': (lambda db: db.get_user_stats(1), 2),
+    'tag search': (lambda db: db.search_by_tag(1, 'work'), 1),
+    'this week': (lambda db: db.search_this_week(1), 1),
+    'search': (lambda db: db.search_notes(1, 'meeting'), 1),
+    'popular tags': (lambda db: db.get_popular_tags(1), 1),
+}
+
+@pytest.mark.parametrize('render', RENDERS, ids=list(RENDERS))
+def test_render_query_count(db, statements, render):
+    read, limit = RENDERS[render]
+    statements.clear()
+    read(db)
+    assert len(statements) <= limit, statements
@@ -0,0 +1,101 @@
+"""SendScheduler token buckets, driven by a fake clock
+
+The scheduler's background task is not started. The tests advance the
+clock in small steps themselves and grant tokens at each one, so send
+times are exact up to the step and do not depend on the machine.
+"""
+import asyncio
+
+import pytest
+
+from send_scheduler import SendScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+STEP = 0.001
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def send_times(scheduler, clock, requests, seconds):
+    """Clock time each (chat_id, priority) request was sent at, in request order"""
+    async def run():
+        scheduler._wakeup = asyncio.Event()
+        sent = [None] * len(requests)
+
+        async def send(index):
+            sent[index] = clock.now
+
+        tasks = [
+            asyncio.create_task(scheduler.process_request(
+                send, (index,), {}, 'sendMessage', {'chat_id': chat_id},
+                {'priority': priority},
+            ))
+            for index, (chat_id, priority) in enumerate(requests)
+        ]
+        await asyncio.sleep(0)
+        for tick in range(round(seconds / STEP) + 1):
+            clock.now = tick * STEP
+            scheduler._grant(clock.now)
+            # Let the granted requests run their callback
+            for _ in range(3):
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return sent
+
+    return asyncio.run(run())
+
+def test_chat_rate_after_burst():
+    clock = FakeClock()
+    scheduler = SendScheduler(global_rate=1000, global_burst=10, chat_rate=1, chat_burst=3,
+                              clock=clock)
+    sent = send_times(scheduler, clock, [(42, PRIORITY_INTERACTIVE)] * 8, 6)
+
+    # The burst goes at once, then one message per second
+    assert sent[:3] == [0.0, 0.0, 0.0]
+    for previous, current in zip(sent[2:], sent[3:]):
+        assert current - previous == pytest.approx(1.0, abs=2 * STEP)
+
+def test_chats_do_not_hold_each_other_up():
+    clock = FakeClock()
+    scheduler = SendScheduler(global_rate=1000, global_burst=10, chat_rate=1, chat_burst=1,
+                              clock=clock)
+    requests = [(1, PRIORITY_INTERACTIVE)] * 3 + [(2, PRIORITY_INTERACTIVE)]
+    sent = send_times(scheduler, clock, requests, 3)
+
+    # Chat 2 queued behind chat 1's backlog but had its own token
+    assert sent[3] == 0.0
+    assert sent[:3] == pytest.approx([0.0, 1.0, 2.0], abs=2 * STEP)
+
+def test_group_rate_per_minute():
+    clock = FakeClock()
+    scheduler = SendScheduler(global_rate=1000, global_burst=10, group_rate=20, clock=clock)
+    sent = send_times(scheduler, clock, [(-100, PRIORITY_INTERACTIVE)] * 3, 7)
+
+    assert sent == pytest.approx([0.0, 3.0, 6.0], abs=2 * STEP)
+
+def test_global_rate_spaces_sends():
+    clock = FakeClock()
+    scheduler = SendScheduler(global_rate=30, chat_rate=1, chat_burst=3, clock=clock)
+    requests = [(chat_id, PRIORITY_INTERACTIVE) for chat_id in range(1, 61)]
+    sent = send_times(scheduler, clock, requests, 2.5)
+
+    assert sent == sorted(sent)
+    for previous, current in zip(sent, sent[1:]):
+        assert current - previous == pytest.approx(1 / 30, abs=2 * STEP)
+    # No one-second window holds more than the rate allows
+    assert max(sum(start <= t < start + 1 for t in sent) for start in sent) <= 31
+
+def test_interactive_before_background():
+    clock = FakeClock()
+    scheduler = SendScheduler(global_rate=10, clock=clock)
+    requests = [(chat_id, PRIORITY_BACKGROUND) for chat_id in range(1, 6)]
+    requests.append((99, PRIORITY_INTERACTIVE))
+    sent = send_times(scheduler, clock, requests, 1)
+
+    # The click reply queued last goes first; the backlog follows in order
+    assert sent[5] == 0.0
+    assert sent[:5] == sorted(sent[:5])
+    assert sent[0] == pytest.approx(0.1, abs=2 * STEP)
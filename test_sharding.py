@@ -0,0 +1,73 @@
+"""Moving users between shards after the shard count changes"""
+import pytest
+
+from sharded_database import ShardedDatabase
+from storage import epoch_now
+
+DAY = 86400
+USERS = range(1, 21)
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'notes.db')
+
+def fill_one_shard(path):
+    """Users with notes and activity on two days, all on a single shard"""
+    db = ShardedDatabase(path, shards=1)
+    now = epoch_now()
+    for user_id in USERS:
+        db.ensure_user(user_id, f'user{user_id}', f'User {user_id}')
+        db.set_user_language(user_id, 'de')
+        note_id = db.save_note(user_id, f'note of {user_id}')
+        db.add_tag(note_id, 'moved', user_id)
+        db.log_activity_batch([(user_id, 'start', None, now - DAY),
+                               (user_id, 'save_note', None, now)])
+    db.log_activity_batch([(None, 'inline_query', None, now)])
+    db.refresh_rollups()
+    totals = (db.get_active_users(7), db.get_retention_stats(),
+              db.get_new_users_today(), db.get_user_growth_stats(7))
+    db.close()
+    return totals
+
+def test_rebalance_keeps_distinct_user_counts(path):
+    active, retention, new_today, growth = fill_one_shard(path)
+    assert active == len(USERS)
+
+    db = ShardedDatabase(path, shards=3)
+    # The bot already runs with three shards: a moved user is back
+    # before the rebalance and gets a fresh row on the new shard
+    returning = next(user_id for user_id in USERS if db.shard_index(user_id) != 0)
+    db.ensure_user(returning, f'user{returning}', f'User {returning}')
+    db.log_user_activity(returning, 'start')
+
+    moved = db.rebalance()
+    assert moved and db.misplaced_users() == []
+    assert all(notes == 1 for _, _, _, notes in moved)
+
+    db.refresh_rollups()
+    assert db.get_active_users(7) == active
+    assert db.get_retention_stats() == retention
+    assert db.get_new_users_today() == new_today
+    assert db.get_user_growth_stats(7) == growth
+    assert db.get_total_users() == len(USERS)
+
+    for user_id in USERS:
+        assert db.get_user_language(user_id) == 'de'
+        assert [row[1] for row in db.search_by_tag(user_id, 'moved')] == [f'note of {user_id}']
+    # The moved events are not rolled up a second time
+    assert db.refresh_rollups() == 0
+    db.close()
+
+def test_rebalance_dry_run_moves_nothing(path):
+    fill_one_shard(path)
+    db = ShardedDatabase(path, shards=3)
+    planned = db.rebalance(dry_run=True)
+    assert planned and db.misplaced_users() == [row[:3] for row in planned]
+    db.close()
+
+def test_anonymous_activity_goes_to_shard_zero(path):
+    db = ShardedDatabase(path, shards=3)
+    db.log_activity_batch([(None, 'inline_query', None, epoch_now())])
+    assert db.refresh_rollups() == 1
+    assert db.shards[0].refresh_rollups() == 0
+    db.close()
@@ -0,0 +1,319 @@
+"""Behaviour every StorageBackend must share
+
+The same tests run against each backend. SQLite, sharded or not, always
+runs; Postgres runs when TEST_POSTGRES_DSN points at a scratch database
+whose public schema may be dropped, e.g.
+
+    TEST_POSTGRES_DSN=postgresql://postgres@localhost/scratch python -m pytest
+"""
+import asyncio
+import collections
+import os
+import threading
+import time
+
+import pytest
+
+from storage import SNIPPET_START, SNIPPET_END
+
+POSTGRES_DSN = os.getenv('TEST_POSTGRES_DSN')
+
+def open_sqlite(tmp_path):
+    from database import Database
+    return Database(str(tmp_path / 'notes.db'))
+
+def open_sharded(tmp_path):
+    from sharded_database import ShardedDatabase
+    return ShardedDatabase(str(tmp_path / 'notes.db'), shards=2)
+
+def open_postgres(tmp_path):
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(POSTGRES_DSN)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+    conn.close()
+
+    from postgres_database import PostgresDatabase
+    return PostgresDatabase(POSTGRES_DSN, pool_size=4)
+
+BACKENDS = [
+    pytest.param(open_sqlite, id='sqlite'),
+    pytest.param(open_sharded, id='sharded'),
+    pytest.param(open_postgres, id='postgres', marks=pytest.mark.skipif(
+        not POSTGRES_DSN, reason='TEST_POSTGRES_DSN is not set')),
+]
+
+@pytest.fixture(params=BACKENDS)
+def db(request, tmp_path):
+    backend = request.param(tmp_path)
+    for user_id in (1, 2, 3):
+        backend.ensure_user(user_id, f'user{user_id}', f'User {user_id}')
+    yield backend
+    backend.close()
+
+def save_notes(db, user_id, contents):
+    return [db.save_note(user_id, content) for content in contents]
+
+# Users
+def test_user_profile_and_language(db):
+    assert db.get_user_profile(1)['exists']
+    assert db.get_user_language(1) == 'en'
+    db.set_user_language(1, 'de')
+    assert db.get_user_language(1) == 'de'
+    assert not db.get_user_profile(99)['exists']
+
+def test_write_lane_in_range(db):
+    lanes = {db.write_lane(user_id) for user_id in range(100)}
+    assert lanes <= set(range(db.write_lanes))
+    assert db.write_lane(None) == 0
+    assert all(db.write_lane(user_id) == db.write_lane(user_id) for user_id in range(10))
+
+# Notes
+def test_save_and_get_note(db):
+    note_id = db.save_note(1, 'hello world')
+    db.add_tag(note_id, 'Greeting', 1)
+    content, created_at, pinned, tags, message_type, file_id = db.get_note(note_id, 1)
+    assert content == 'hello world'
+    assert created_at > 0
+    assert not pinned
+    assert tags == ['greeting']
+    assert message_type == 'text'
+    assert file_id is None
+    assert db.get_note(note_id, 2) is None
+
+def test_notes_are_private(db):
+    note_id = db.save_note(1, 'mine')
+    db.add_tag(note_id, 'secret', 2)
+    db.toggle_pin(note_id, 2)
+    db.delete_note(note_id, 2)
+    content, _, pinned, tags, _, _ = db.get_note(note_id, 1)
+    assert (content, pinned, tags) == ('mine', 0, [])
+
+def test_pin_and_delete(db):
+    first, second = save_notes(db, 1, ['first', 'second'])
+    db.toggle_pin(second, 1)
+    assert [row[0] for row in db.get_pinned_notes(1)] == [second]
+    db.toggle_pin(second, 1)
+    assert db.get_pinned_notes(1) == []
+
+    db.delete_note(first, 1)
+    assert db.get_note(first, 1) is None
+    assert db.get_note_count(1) == 1
+
+def test_recent_notes_and_pages(db):
+    note_ids = save_notes(db, 1, [f'note {i}' for i in range(7)])
+    newest_first = note_ids[::-1]
+    assert [row[0] for row in db.get_recent_notes(1, limit=3)] == newest_first[:3]
+    assert [row[0] for row in db.get_recent_notes(1, limit=3, offset=3)] == newest_first[3:6]
+
+    notes, has_older, has_newer = db.get_notes_page(1, limit=3)
+    assert [row[0] for row in notes] == newest_first[:3]
+    assert (has_older, has_newer) == (True, False)
+
+    last = notes[-1]
+    notes, has_older, has_newer = db.get_notes_page(1, limit=3, cursor=(last[2], last[0]))
+    assert [row[0] for row in notes] == newest_first[3:6]
+    assert (has_older, has_newer) == (True, True)
+
+    first = notes[0]
+    notes, _, has_newer = db.get_notes_page(1, limit=3, cursor=(first[2], first[0]),
+                                            direction='newer')
+    assert [row[0] for row in notes] == newest_first[:3]
+    assert not has_newer
+
+def test_user_stats(db):
+    first, second = save_notes(db, 1, ['a', 'b'])
+    db.add_tag(first, 'work', 1)
+    db.add_tag(second, 'work', 1)
+    db.toggle_pin(first, 1)
+    stats = db.get_user_stats(1)
+    assert stats['total_notes'] == 2
+    assert stats['pinned_count'] == 1
+    assert stats['unique_tags'] == 1
+    assert [tuple(row) for row in stats['top_tags']] == [('work', 2)]
+    assert db.get_popular_tags(1) == ['work']
+    assert db.get_user_stats(3)['total_notes'] == 0
+
+# Search
+def test_search_is_scoped_to_user(db):
+    mine = db.save_note(1, 'Planning meeting notes for Monday')
+    db.save_note(2, 'meeting with the bank')
+    results = db.search_notes(1, 'meeting')
+    assert [row[0] for row in results] == [mine]
+    assert db.search_notes(3, 'meeting') == []
+
+def test_search_snippet_marks_matches(db):
+    db.save_note(1, 'Booked the travel to Lisbon')
+    results = db.search_notes(1, 'travel')
+    assert len(results) == 1
+    snippet = results[0][3]
+    assert f'{SNIPPET_START}travel{SNIPPET_END}' in snippet.lower()
+    assert snippet.count(SNIPPET_START) == snippet.count(SNIPPET_END)
+
+def test_search_substring_mode(db):
+    note_id = db.save_note(1, 'order #4411 shipped')
+    results = db.search_notes(1, '#4411', mode='substring')
+    assert [row[0] for row in results] == [note_id]
+
+def test_search_by_tag_and_this_week(db):
+    tagged, untagged = save_notes(db, 1, ['tagged', 'untagged'])
+    db.add_tag(tagged, 'idea', 1)
+    assert [row[0] for row in db.search_by_tag(1, 'idea')] == [tagged]
+    assert {row[0] for row in db.search_this_week(1)} == {tagged, untagged}
+    assert db.search_by_tag(2, 'idea') == []
+
+# Random note
+def test_random_note_empty(db):
+    assert db.get_random_note(3) is None
+    assert db.get_random_note(3, [1, 2]) is None
+
+def test_random_note_skips_excluded(db):
+    note_ids = save_notes(db, 1, [f'note {i}' for i in range(6)])
+    db.delete_note(note_ids[1], 1)
+    left = [note_ids[2], note_ids[4]]
+    exclude = [note_id for note_id in note_ids if note_id not in left]
+    picks = collections.Counter(db.get_random_note(1, exclude)[0] for _ in range(400))
+    assert set(picks) == set(left)
+    # Both remaining notes come up about equally often
+    assert min(picks.values()) > 130
+
+def test_random_note_all_excluded(db):
+    note_ids = save_notes(db, 1, ['a', 'b', 'c'])
+    note_id, content, tags = db.get_random_note(1, note_ids)
+    assert note_id in note_ids
+    assert tags == []
+
+def test_random_note_ignores_other_users_ids(db):
+    mine = db.save_note(1, 'mine')
+    other = db.save_note(2, 'theirs')
+    for _ in range(20):
+        assert db.get_random_note(1, [other])[0] == mine
+
+# Export and import
+def test_export_oldest_first(db):
+    note_ids = save_notes(db, 1, [f'note {i}' for i in range(5)])
+    db.add_tag(note_ids[0], 'x', 1)
+    rows = list(db.iter_notes_export(1, chunk_size=2))
+    assert [row[0] for row in rows] == note_ids
+    assert rows[0][8] == ['x']
+    assert list(db.iter_notes_export(2)) == []
+
+def test_abandoned_export_releases_connection(db):
+    save_notes(db, 1, [f'note {i}' for i in range(5)])
+    for _ in range(10):
+        export = db.iter_notes_export(1, chunk_size=2)
+        next(export)
+        export.close()
+    # A writer must not be stuck behind a read left open
+    assert db.save_note(1, 'after') is not None
+    assert db.get_note_count(1) == 6
+
+def test_import_resumes(db):
+    notes = [(f'imported {i}', 'text', None, 1000 + i, 0, None, None, ['old'])
+             for i in range(5)]
+    assert db.import_notes(1, notes, 'backup.json', batch_size=2) == (5, 0)
+    assert db.import_notes(1, notes, 'backup.json', batch_size=2) is None
+    assert db.get_note_count(1) == 5
+    assert [row[1] for row in db.iter_notes_export(1)] == [note[0] for note in notes]
+
+# Concurrency
+def test_concurrent_writers(db):
+    errors = []
+
+    def write(user_id):
+        try:
+            for i in range(30):
+                note_id = db.save_note(user_id, f'note {i}')
+                if i % 3 == 0:
+                    db.delete_note(note_id, user_id)
+                db.get_random_note(user_id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(user_id,)) for user_id in (1, 1, 2, 2, 3, 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for user_id in (1, 2, 3):
+        assert db.get_note_count(user_id) == 40
+        assert len(list(db.iter_notes_export(user_id))) == 40
+
+# Analytics
+def test_analytics(db):
+    save_notes(db, 1, ['a', 'b'])
+    db.save_note(2, 'c')
+    db.log_user_activity(1, 'start')
+    assert db.get_total_users() == 3
+    assert db.get_total_notes_all_users() == 3
+    assert db.get_notes_created_today() == 3
+    assert db.get_top_users(1)[0][0] == 1
+    snapshot = db.compute_analytics_snapshot()
+    db.save_analytics_snapshot(snapshot)
+    assert db.get_analytics_snapshot() is not None
+
+# Maintenance
+def test_backup_waits_for_open_write(db, tmp_path):
+    if not hasattr(db, 'pool') or not hasattr(db.pool, 'backup_source'):
+        pytest.skip(f'{type(db).__name__} has no online backup through its writer')
+    save_notes(db, 1, [f'note {i}' for i in range(50)])
+    committed = threading.Event()
+
+    def write():
+        with db.pool.writer() as conn:
+            conn.execute("UPDATE notes SET content = 'changed' WHERE user_id = 1")
+            time.sleep(0.2)
+        committed.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    time.sleep(0.05)
+    result, = db.backup(str(tmp_path / 'backups'), compress=False)
+    assert committed.is_set()
+    writer.join()
+
+    import sqlite3
+    copy = sqlite3.connect(result['path'])
+    assert copy.execute("SELECT DISTINCT content FROM notes").fetchall() == [('changed',)]
+    copy.close()
+
+def test_unsupported_maintenance_is_skipped(db, tmp_path):
+    from backup import BackupScheduler
+    scheduler = BackupScheduler(db, str(tmp_path / 'backups'), interval=60)
+
+    async def started():
+        scheduler.start()
+        running = scheduler._task is not None
+        await scheduler.stop()
+        return running
+
+    assert asyncio.run(started()) == db.supports_backup
+    if not db.supports_backup:
+        assert db.backup(str(tmp_path / 'backups')) == []
+    if not db.supports_archive:
+        assert db.archive_activity(str(tmp_path / 'archive')) == []
+        db.vacuum()
+
+def test_writable_without_the_bot(db, tmp_path):
+    if not hasattr(db, 'database_file'):
+        pytest.skip(f'{type(db).__name__} is not a single SQLite file')
+    note_id = db.save_note(1, 'written by the bot')
+
+    # The schema needs nothing registered on the connection, so plain
+    # SQLite clients such as the sqlite3 shell can still change notes
+    import sqlite3
+    conn = sqlite3.connect(db.database_file)
+    conn.execute("UPDATE notes SET content = 'edited by hand' WHERE note_id = ?", (note_id,))
+    conn.execute("INSERT INTO notes (user_id, content) VALUES (1, 'added by hand')")
+    conn.execute("INSERT INTO users (user_id) VALUES (4)")
+    conn.commit()
+    # Omitted stamps default to epoch seconds like the bot's own
+    assert conn.execute("""
+        SELECT DISTINCT typeof(created_at) FROM notes UNION SELECT typeof(created_at) FROM users
+    """).fetchall() == [('integer',)]
+    conn.close()
+
+    assert {row[1] for row in db.search_notes(1, 'hand')} == {'edited by hand', 'added by hand'}
+    assert db.get_notes_created_today() == 2
@@ -0,0 +1,114 @@
+"""PerUserUpdateProcessor: per-user ordering and superseded button clicks"""
+import asyncio
+import random
+
+from telegram import Update
+
+from update_processor import PerUserUpdateProcessor
+
+def text_update(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': f'note {update_id}',
+            'chat': {'id': user_id, 'type': 'private'}, 'from': user,
+        },
+    }, None)
+
+def click_update(update_id, user_id, message_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+            'data': 'menu_notes',
+            'message': {
+                'message_id': message_id, 'date': 0, 'text': 'menu',
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'},
+            },
+        },
+    }, None)
+
+async def process_all(processor, updates, handle):
+    """Feed updates the way Application does and wait until all are handled"""
+    done = asyncio.Event()
+    handled = [0]
+
+    async def counted(update):
+        try:
+            await handle(update)
+        finally:
+            handled[0] += 1
+            if handled[0] == len(updates):
+                done.set()
+
+    await asyncio.gather(*[
+        processor.process_update(update, counted(update)) for update in updates
+    ])
+    # A user's queued updates return before they are handled
+    await asyncio.wait_for(done.wait(), 5)
+
+def test_each_user_in_arrival_order():
+    rng = random.Random(1)
+    updates = [text_update(update_id, rng.randint(1, 4)) for update_id in range(1, 101)]
+    processor = PerUserUpdateProcessor(8)
+    seen = {}
+    running = set()
+    overlaps = []
+
+    async def handle(update):
+        user_id = update.effective_user.id
+        if user_id in running:
+            overlaps.append(update.update_id)
+        running.add(user_id)
+        await asyncio.sleep(rng.uniform(0, 0.003))
+        running.discard(user_id)
+        seen.setdefault(user_id, []).append(update.update_id)
+
+    asyncio.run(process_all(processor, updates, handle))
+
+    for user_id, update_ids in seen.items():
+        arrived = [u.update_id for u in updates if u.effective_user.id == user_id]
+        assert update_ids == arrived
+    assert overlaps == []
+    # Different users still ran at the same time
+    assert processor.max_active > 1
+    assert processor.metrics()['users'] == 0
+
+def test_superseded_click_is_dropped():
+    # Three clicks on message 10, then one on message 11, all by one user
+    updates = [click_update(1, 7, 10), click_update(2, 7, 10), click_update(3, 7, 10),
+               click_update(4, 7, 11)]
+    processor = PerUserUpdateProcessor(8, coalesce=lambda update: True)
+    handled, dropped = [], []
+
+    async def handle(update):
+        if processor.superseded(update):
+            dropped.append(update.update_id)
+            return
+        await asyncio.sleep(0.01)
+        handled.append(update.update_id)
+
+    asyncio.run(process_all(processor, updates, handle))
+
+    # Click 1 was handled before the others arrived; click 2 was waiting
+    # behind it when click 3 on the same message came in
+    assert handled == [1, 3, 4]
+    assert dropped == [2]
+    assert processor.metrics()['superseded'] == 1
+    assert processor._latest_clicks == {}
+
+def test_clicks_not_coalesced_all_run():
+    updates = [click_update(update_id, 7, 10) for update_id in range(1, 4)]
+    processor = PerUserUpdateProcessor(8, coalesce=lambda update: False)
+    handled = []
+
+    async def handle(update):
+        if not processor.superseded(update):
+            await asyncio.sleep(0.01)
+            handled.append(update.update_id)
+
+    asyncio.run(process_all(processor, updates, handle))
+    assert handled == [1, 2, 3]
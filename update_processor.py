@@ -0,0 +1,124 @@
+import logging
+from collections import deque
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+def message_key(update):
+    """(chat_id, message_id) of the message a button click was on, else None"""
+    query = getattr(update, 'callback_query', None)
+    if query is None or query.message is None:
+        return None
+    return query.message.chat_id, query.message.message_id
+
+def update_key(update):
+    """User an update belongs to (its chat without a user), None for neither"""
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, 'effective_chat', None)
+    return chat.id if chat is not None else None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process different users' updates concurrently, each user's in order
+
+    Up to ``max_concurrent_updates`` updates run at once. The first update
+    of a user starts a queue for that user and processes it until it is
+    empty; later updates of the same user are appended to it and return
+    right away, so they never hold one of the concurrency slots while they
+    wait. Updates enter through the processor's FIFO semaphore, so a user's
+    queue is in the order the updates arrived.
+
+    For clicks that ``coalesce(update)`` accepts, buttons that only redraw
+    the message, the newest pending one per message is remembered. A
+    handler can then tell with superseded() that a later such click on
+    the same message is already waiting and would overwrite its edit.
+    """
+
+    def __init__(self, max_concurrent_updates, coalesce=None):
+        super().__init__(max_concurrent_updates)
+        self.coalesce = coalesce
+        self._queues = {}
+        self._latest_clicks = {}
+        self.processed = 0
+        self.superseded_clicks = 0
+        self.queued = 0
+        self.max_queue = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def do_process_update(self, update, coroutine):
+        clicked = message_key(update)
+        if clicked is not None and self.coalesce is not None and self.coalesce(update):
+            self._latest_clicks[clicked] = update.update_id
+            coroutine = self._clicked(clicked, update.update_id, coroutine)
+
+        key = update_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            self.queued += 1
+            self.max_queue = max(self.max_queue, len(queue))
+            return
+
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await self._run(queue[0])
+                finally:
+                    queue.popleft()
+        finally:
+            del self._queues[key]
+            if queue:
+                # Only reached when the task was cancelled, e.g. on shutdown
+                logger.warning(f"Dropped {len(queue)} queued updates of {key}")
+                for pending in queue:
+                    pending.close()
+
+    async def _clicked(self, clicked, update_id, coroutine):
+        try:
+            await coroutine
+        finally:
+            if self._latest_clicks.get(clicked) == update_id:
+                del self._latest_clicks[clicked]
+
+    def superseded(self, update):
+        """Whether a newer click on the same message is waiting; counted when True"""
+        clicked = message_key(update)
+        if clicked is None or self._latest_clicks.get(clicked, update.update_id) <= update.update_id:
+            return False
+        self.superseded_clicks += 1
+        return True
+
+    async def _run(self, coroutine):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+
+    async def initialize(self):
+        """Nothing to set up"""
+
+    async def shutdown(self):
+        """Nothing to release; queued updates finish with their runner"""
+
+    def metrics(self):
+        """Counters for /metrics"""
+        return {
+            'limit': self.max_concurrent_updates,
+            'processed': self.processed,
+            'active': self.active,
+            'max_active': self.max_active,
+            'users': len(self._queues),
+            'queued': self.queued,
+            'max_queue': self.max_queue,
+            'superseded': self.superseded_clicks,
+        }